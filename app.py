@@ -1,18 +1,6 @@
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
-try:
-    from google_service import GoogleService
-except Exception:
-    GoogleService = None
-try:
-    from elevenlabs import VoiceSettings
-    from elevenlabs.client import ElevenLabs
-except Exception:
-    VoiceSettings = None
-    ElevenLabs = None
-from flask import Flask, jsonify, request, send_from_directory, send_file
+import time
+_IMPORT_STARTED = time.perf_counter()
+from flask import Flask, jsonify, request, send_from_directory, send_file, stream_with_context
 from dotenv import load_dotenv
 import os
 import json
@@ -20,7 +8,34 @@ import logging
 import io
 import datetime
 import sqlite3
+import threading
+import importlib
 import re
+import uuid
+import functools
+import hmac
+import rollup_service
+import lead_service
+import retention_service
+import search_service
+import outbox_service
+import sheets_mirror_service
+import report_service
+import availability_service
+import booking_service
+import knowledge_service
+import exam_index_service
+import whatsapp_service
+import webhook_service
+import reminder_service
+import campaign_service
+import phone_service
+import conversation_service
+import metrics_service
+import handover_service
+import session_stats_service
+from cache_service import ResponseCache
+from notify_service import Notifier
 try:
     from edge_service import get_edge_audio_bytes, get_available_voices as get_edge_voices
 except Exception:
@@ -47,9 +62,51 @@ except Exception:
 # --- CONFIGURAÇÃO DB ---
 DB_NAME = "vizo_chat.db"
 
+# --- INICIALIZAÇÃO SOB DEMANDA ---
+# openai, google-api-python-client e elevenlabs levam quase um segundo para
+# importar e o GoogleService pode abrir o fluxo OAuth; nada disso acontece no
+# import do app. As classes são importadas por _lazy() no primeiro uso e os
+# clientes criados por get_google_service()/get_tts_client(). Os nomes abaixo
+# continuam no módulo para poderem ser substituídos (testes, WSGI).
+_NOT_LOADED = object()
+OpenAI = GoogleService = ElevenLabs = VoiceSettings = _NOT_LOADED
+_LAZY_IMPORTS = {
+    "OpenAI": ("openai", "OpenAI"),
+    "GoogleService": ("google_service", "GoogleService"),
+    "ElevenLabs": ("elevenlabs.client", "ElevenLabs"),
+    "VoiceSettings": ("elevenlabs", "VoiceSettings"),
+}
+_lazy_lock = threading.RLock()
+
+# Tempos (ms) do import e de cada etapa de inicialização; GET /api/startup
+STARTUP_REPORT = {}
+
+def _record_startup(step, started):
+    STARTUP_REPORT[step] = round((time.perf_counter() - started) * 1000, 1)
+
+def _lazy(name):
+    """Classe opcional, importada no primeiro uso; None se a biblioteca não estiver instalada."""
+    if globals()[name] is _NOT_LOADED:
+        with _lazy_lock:
+            if globals()[name] is _NOT_LOADED:
+                started = time.perf_counter()
+                module, attr = _LAZY_IMPORTS[name]
+                try:
+                    globals()[name] = getattr(importlib.import_module(module), attr)
+                except Exception as e:
+                    logging.getLogger(__name__).warning(f"{module} indisponível: {e}")
+                    globals()[name] = None
+                _record_startup(f"import_{module}", started)
+    return globals()[name]
+
 def init_db():
     with sqlite3.connect(DB_NAME) as conn:
         cursor = conn.cursor()
+        # Só tem efeito em bancos novos; bancos antigos usam
+        # 'python retention_service.py enable-vacuum' uma vez.
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL: leitores não bloqueiam (nem são bloqueados por) os lotes de escrita
+        cursor.execute("PRAGMA journal_mode = WAL")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chat_logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -106,7 +163,28 @@ def init_db():
                 interest TEXT
             )
         ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_session ON chat_logs (session_id, id)")
+        rollup_service.init_rollup_tables(cursor)
+        retention_service.init_retention_tables(cursor)
+        search_service.init_search_index(cursor)
+        outbox_service.init_outbox_tables(cursor)
+        sheets_mirror_service.init_mirror_tables(cursor)
+        report_service.init_report_tables(cursor)
+        booking_service.init_booking_tables(cursor)
+        knowledge_service.init_knowledge_tables(cursor)
+        exam_index_service.init_exam_index_tables(cursor)
+        whatsapp_service.init_whatsapp_tables(cursor)
+        webhook_service.init_webhook_tables(cursor)
+        reminder_service.init_reminder_tables(cursor)
+        campaign_service.init_campaign_tables(cursor)
+        phone_service.init_phone_tables(cursor)
+        conversation_service.init_conversation_tables(cursor)
+        metrics_service.init_metrics_tables(cursor)
+        handover_service.init_handover_tables(cursor)
+        session_stats_service.init_session_stats_tables(cursor)
         conn.commit()
+        rollup_service.ensure_rollups(conn)
+        search_service.ensure_search_index(conn)
     try:
         with sqlite3.connect(DB_NAME) as conn:
             cursor = conn.cursor()
@@ -118,7 +196,6 @@ def init_db():
     except Exception:
         pass
 
-init_db()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -140,6 +217,11 @@ ZAPI_INSTANCE_ID = os.getenv("ZAPI_INSTANCE_ID")
 ZAPI_TOKEN = os.getenv("ZAPI_TOKEN")
 ZAPI_BASE_URL = os.getenv("ZAPI_BASE_URL", "https://api.z-api.io")
 ZAPI_ENABLED = bool(ZAPI_INSTANCE_ID and ZAPI_TOKEN)
+# Autenticação do webhook: o Client-Token da conta Z-API (header Client-Token)
+# e/ou um segredo próprio passado na URL configurada no painel (?secret=...).
+# Sem nenhum dos dois configurado, o webhook recusa tudo.
+ZAPI_CLIENT_TOKEN = os.getenv("ZAPI_CLIENT_TOKEN")
+ZAPI_WEBHOOK_SECRET = os.getenv("ZAPI_WEBHOOK_SECRET")
 
 def _get_env_bool(name, default=False):
     v = os.getenv(name)
@@ -455,13 +537,27 @@ def format_base_knowledge_for_prompt(data):
     return "\n".join(parts)
 
 
-# Initialize Google Service (Native Path A)
+# Google Service (Native Path A), criado no primeiro uso
 # Nota: O arquivo 'client_secret.json' deve estar presente na raiz.
-try:
-    google_service = GoogleService()
-except Exception as e:
-    logger.error(f"Google Service failed to init: {e}")
-    google_service = None
+google_service = _NOT_LOADED
+
+def get_google_service():
+    global google_service
+    if google_service is _NOT_LOADED:
+        with _lazy_lock:
+            if google_service is _NOT_LOADED:
+                started = time.perf_counter()
+                service_class = _lazy("GoogleService")
+                try:
+                    google_service = service_class() if service_class else None
+                except Exception as e:
+                    logger.error(f"Google Service failed to init: {e}")
+                    google_service = None
+                _record_startup("google_service", started)
+    return google_service
+
+# Escritas no Sheets passam pelo outbox (sheets_outbox) e são enviadas em lote
+sheets_outbox = outbox_service.SheetsOutboxWorker(lambda: DB_NAME, get_google_service)
 
 # Planilhas e Drive configurados
 SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_ID", "18VOultWSr7ee1IAxei8poYxMb-EdQKelyXSf6HXxFZE")
@@ -469,9 +565,39 @@ KNOWLEDGE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID", "digite_o_id_da_pasta_
 # Planilha de Contatos do Vizô (padrão para o ID fornecido pelo usuário)
 CONTACTS_SHEET_ID = os.getenv("GOOGLE_CONTACTS_SHEET_ID") or "1Imm13AnmD0xjmEowlAGC4qialmFDs-ikW7Y6H4NLojs"
 
+# Espelho local da planilha de usuários, usado no login no lugar de reler o Sheets
+sheets_mirror = sheets_mirror_service.SheetsMirrorWorker(
+    lambda: DB_NAME, get_google_service, lambda: [SPREADSHEET_ID] if SPREADSHEET_ID else []
+)
+
+# Horários livres por médico (free/busy do Google + agendamentos locais)
+availability = availability_service.AvailabilityCache(lambda: DB_NAME, get_google_service, lambda: BASE_KNOWLEDGE)
+
+def user_in_sheet(username):
+    """Consulta o espelho local; enquanto ele não tiver a primeira leitura completa, cai no Sheets."""
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        if sheets_mirror_service.is_synced(cursor, SPREADSHEET_ID):
+            return sheets_mirror_service.user_exists(cursor, SPREADSHEET_ID, username)
+    service = get_google_service()
+    if service:
+        sheets_mirror.wake()
+        return service.check_user_exists(SPREADSHEET_ID, username)
+    return False
+
 
 api_key = ELEVENLABS_API_KEY
-client = ElevenLabs(api_key=api_key) if (api_key and ElevenLabs) else None
+# Cliente ElevenLabs, criado no primeiro uso (None sem chave ou sem a biblioteca)
+client = _NOT_LOADED
+
+def get_tts_client():
+    global client
+    if client is _NOT_LOADED:
+        with _lazy_lock:
+            if client is _NOT_LOADED:
+                eleven_class = _lazy("ElevenLabs") if api_key else None
+                client = eleven_class(api_key=api_key) if eleven_class else None
+    return client
 
 def load_settings():
     try:
@@ -597,45 +723,55 @@ def seed_default_user():
             else:
                 cursor.execute("INSERT INTO users (email, name, password_hash, must_change) VALUES (?, ?, ?, 0)", (fh_email, fh_name, fh_pwd_hash))
 
-            conn.commit()
-        try:
-            if google_service and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
-                google_service.add_lead_to_sheets(CONTACTS_SHEET_ID, [
+            if get_google_service() and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
+                outbox_service.enqueue_row(cursor, CONTACTS_SHEET_ID, [
                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     name,
                     email,
                     "Seed de usuário",
                     "Criado/Atualizado"
                 ], "Página1!A1")
-        except Exception as e:
-            logger.error(f"Falha ao registrar seed no Sheets: {e}")
+            conn.commit()
+        sheets_outbox.wake()
         logger.info(f"Seed verificado para usuário {email}")
     except Exception as e:
         logger.error(f"Erro no seed de usuário: {e}")
 
+# Usuários padrão do painel. Só são criados com SEED_DEFAULT_USERS=1 (na
+# startup()) e só os que ainda não existem: ninguém é apagado e senhas já
+# trocadas não voltam ao padrão.
+SEED_DEFAULT_USERS = _get_env_bool("SEED_DEFAULT_USERS", False)
+DEFAULT_USERS = (
+    ("FOURHANDS", "FOURHANDS", "Bruneles"),
+    ("Mylla Cardoso", "Mylla Cardoso", "Iran123"),
+    ("Iran Lima", "Iran Lima", "Iran3791"),
+    ("Visitante", "Visitante", "QDSynapse"),
+)
+
 def seed_default_users():
+    """Cria os usuários padrão que faltam. Retorna quantos foram criados."""
     try:
         with sqlite3.connect(DB_NAME) as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM users")
-
-            def add_user(email, name, password):
-                pwd_hash = _hash_password(password)
-                cursor.execute(
-                    "INSERT INTO users (email, name, password_hash, must_change) VALUES (?, ?, ?, 0)",
-                    (email, name, pwd_hash),
-                )
-
-            add_user("FOURHANDS", "FOURHANDS", "Bruneles")
-            add_user("Mylla Cardoso", "Mylla Cardoso", "Iran123")
-            add_user("Iran Lima", "Iran Lima", "Iran3791")
-            add_user("Visitante", "Visitante", "QDSynapse")
-
+            cursor.execute(
+                f"SELECT email FROM users WHERE email IN ({', '.join('?' for _ in DEFAULT_USERS)})",
+                [u[0] for u in DEFAULT_USERS]
+            )
+            existing = {r[0] for r in cursor.fetchall()}
+            missing = [u for u in DEFAULT_USERS if u[0] not in existing]
+            # Só os que faltam passam pelo hash
+            cursor.executemany(
+                "INSERT OR IGNORE INTO users (email, name, password_hash, must_change) VALUES (?, ?, ?, 0)",
+                [(email, name, _hash_password(password)) for email, name, password in missing]
+            )
             conn.commit()
+        if missing:
+            logger.info(f"Seed: {len(missing)} usuário(s) padrão criado(s)")
+        return len(missing)
     except Exception as e:
         logger.error(f"Erro ao fazer seed de usuários: {e}")
+        return 0
 
-seed_default_users()
 def _send_email(to_email: str, subject: str, body: str) -> bool:
     if not (SMTP_HOST and SMTP_USER and SMTP_PASS):
         logger.warning("SMTP não configurado. E-mail não enviado.")
@@ -699,15 +835,63 @@ def handle_campaigns():
         else:
             return jsonify({"error": "Failed to save campaign settings"}), 500
 
+@app.route('/api/campaigns/broadcasts', methods=['GET', 'POST'])
+def campaign_broadcasts():
+    if request.method == 'GET':
+        with sqlite3.connect(DB_NAME) as conn:
+            return jsonify(campaign_service.list_campaigns(conn.cursor()))
+
+    data = request.json or {}
+    settings = load_campaign_settings()
+    message = (data.get('message') or settings.get('campaign_message') or '').strip()
+    if not message:
+        return jsonify({"error": "Mensagem da campanha é obrigatória"}), 400
+    try:
+        filters = lead_service.parse_filters(data.get('filters') or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    name = data.get('name') or settings.get('active_campaign') or 'Campanha'
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        campaign_id = campaign_service.create_campaign(cursor, name, message, filters)
+        conn.commit()
+        result = campaign_service.progress(cursor, campaign_id)
+    campaign_runner.wake()
+    return jsonify(result), 201
+
+@app.route('/api/campaigns/broadcasts/<int:campaign_id>', methods=['GET'])
+def campaign_broadcast_progress(campaign_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        result = campaign_service.progress(conn.cursor(), campaign_id)
+    if not result:
+        return jsonify({"error": "Campanha não encontrada"}), 404
+    return jsonify(result)
+
+@app.route('/api/campaigns/broadcasts/<int:campaign_id>/<action>', methods=['POST'])
+def campaign_broadcast_action(campaign_id, action):
+    status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}.get(action)
+    if not status:
+        return jsonify({"error": "Ação inválida"}), 400
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        if not campaign_service.set_status(cursor, campaign_id, status):
+            return jsonify({"error": "Campanha não encontrada ou em outro estado"}), 409
+        conn.commit()
+        result = campaign_service.progress(cursor, campaign_id)
+    if status == "running":
+        campaign_runner.wake()
+    return jsonify(result)
+
 @app.route('/api/voices', methods=['GET'])
 def get_voices():
     all_voices = []
-    premium_enabled = bool(client)
+    tts_client = get_tts_client()
+    premium_enabled = bool(tts_client)
     
     # 1. Tentar pegar vozes da ElevenLabs
-    if client:
+    if tts_client:
         try:
-            response = client.voices.get_all()
+            response = tts_client.voices.get_all()
             for voice in response.voices:
                 all_voices.append({
                     "voice_id": voice.voice_id,
@@ -791,7 +975,8 @@ def generate_preview():
             return jsonify({"error": f"Edge TTS Error: {msg}{hint}"}), 500
 
     # VERIFICAÇÃO 2: Tenta ElevenLabs (Paga)
-    if not client:
+    tts_client = get_tts_client()
+    if not tts_client:
         # Se não tiver client configurado, fallback para Edge direto
         try:
             fallback_voice = "pt-BR-FranciscaNeural"
@@ -809,12 +994,12 @@ def generate_preview():
     use_speaker_boost = data.get('use_speaker_boost', True)
 
     try:
-        audio_generator = client.text_to_speech.convert(
+        audio_generator = tts_client.text_to_speech.convert(
             text=text,
             voice_id=voice_id,
             model_id=model_id,
             output_format="mp3_44100_128",
-            voice_settings=VoiceSettings(
+            voice_settings=_lazy("VoiceSettings")(
                 stability=stability,
                 similarity_boost=similarity_boost,
                 style=style,
@@ -876,6 +1061,25 @@ def generate_preview():
 
 # --- NOVOS ENDPOINTS GOOGLE ---
 
+def _insert_patient_lead(cursor, name, phone, status, source, medium=None, campaign=None, context=None,
+                         interest=None, consent=0):
+    """Grava o lead (rollup, merge por telefone e linha para o Sheets) na transação de quem chama."""
+    cursor.execute('''
+        INSERT INTO patient_leads (name, phone, phone_e164, status, source, medium, campaign, context, interest, consent)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (name, phone, phone_service.to_e164(phone), status, source, medium, campaign, context, interest, consent))
+    lead_id = cursor.lastrowid
+    rollup_service.record_lead_insert(cursor, lead_id)
+    # Paciente que já era lead: o contato novo entra no histórico do lead existente
+    if phone_service.to_e164(phone):
+        phone_service.merge_phone(cursor, phone_service.to_e164(phone))
+    if get_google_service() and SPREADSHEET_ID:
+        outbox_service.enqueue_row(cursor, SPREADSHEET_ID, [
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            name, phone, "-", status
+        ])
+    return lead_id
+
 @app.route('/api/lead/save', methods=['POST'])
 def save_lead():
     data = request.json or {}
@@ -887,6 +1091,8 @@ def save_lead():
     campaign = data.get('campaign')
     context = data.get('context')
     interest = data.get('interest')
+    # Aceite para receber campanhas pelo WhatsApp
+    consent = 1 if data.get('consent') else 0
 
     try:
         with sqlite3.connect(DB_NAME) as conn:
@@ -905,54 +1111,239 @@ def save_lead():
                     interest TEXT
                 )
             ''')
-            cursor.execute('''
-                INSERT INTO patient_leads (name, phone, status, source, medium, campaign, context, interest)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (name, phone, status, source, medium, campaign, context, interest))
+            _insert_patient_lead(cursor, name, phone, status, source, medium, campaign, context, interest, consent)
             conn.commit()
+        sheets_outbox.wake()
     except Exception as e:
         logger.error(f"Erro ao salvar lead em SQLite: {e}")
 
-    if google_service and SPREADSHEET_ID:
-        try:
-            google_service.add_lead_to_sheets(SPREADSHEET_ID, [
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                name, phone, "-", status
-            ])
-        except Exception as e:
-            logger.error(f"Failed to save lead in Google Sheets: {e}")
-
     return jsonify({"status": "success"})
 
+@app.route('/api/lead/status', methods=['POST'])
+def update_lead_status():
+    data = request.json or {}
+    lead_id = data.get('id')
+    status = (data.get('status') or '').strip()
+    if not lead_id or not status:
+        return jsonify({"error": "id e status são obrigatórios"}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            cursor = conn.cursor()
+            found = rollup_service.update_lead_status(cursor, lead_id, status)
+            if not found:
+                return jsonify({"error": "Lead não encontrado"}), 404
+            conn.commit()
+        return jsonify({"status": "success"})
+    except Exception as e:
+        logger.error(f"Erro ao atualizar status do lead: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# --- FILA DE ATENDIMENTO HUMANO ---
+# Consoles de atendimento (atendimento.html) recebem as mudanças da fila por
+# SSE; handover_notifier acorda os streams depois de cada commit.
+handover_notifier = Notifier(slots=1)
+HANDOVER_WHATSAPP_NOTIFY = _get_env_bool("HANDOVER_WHATSAPP_NOTIFY", ZAPI_ENABLED)
+
+def _handover_changed(notified_whatsapp=False):
+    handover_notifier.notify(handover_service.HANDOVER_TOPIC)
+    if notified_whatsapp:
+        whatsapp_outbox.wake()
+
 @app.route('/api/notify_attendant', methods=['POST'])
 def notify_attendant():
-    data = request.json
-    name = data.get('name', 'Cliente Anônimo')
-    phone = data.get('phone', 'Sem telefone')
-    
-    # Simula envio de mensagem para o atendente
-    attendant_number = "96 99160-3396"
-    
-    logger.info(f"--- NOTIFICAÇÃO PARA ATENDENTE ({attendant_number}) ---")
-    logger.info(f"Mensagem enviada: 'Cliente {name} ({phone}) está aguardando atendimento.'")
-    logger.info(f"Opções enviadas para atendente: 1. Atender | 2. Não atender")
-    logger.info("-------------------------------------------------------")
-    
-    # Se tivesse integração real (Twilio/WPPConnect), o código de envio estaria aqui.
-    
-    return jsonify({"status": "success", "message": "Atendente notificado"})
+    """Coloca o paciente na fila de atendimento humano e avisa os consoles."""
+    data = request.get_json(silent=True) or {}
+    name = data.get('name') or 'Cliente Anônimo'
+    phone = data.get('phone') or None
+    channel = data.get('channel') or 'web'
+    session_id = data.get('session_id') or (f"{channel}:{phone}" if phone else None)
+    if not session_id:
+        return jsonify({"error": "Informe session_id ou phone"}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            cursor = conn.cursor()
+            ticket_id, created = handover_service.open_ticket(
+                cursor, session_id, channel, name, phone, notify_whatsapp=HANDOVER_WHATSAPP_NOTIFY
+            )
+            position = handover_service.position(cursor, ticket_id)
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Erro ao abrir ticket de atendimento: {e}")
+        return jsonify({"error": str(e)}), 500
+    if created:
+        logger.info(f"Ticket #{ticket_id}: {name} ({channel}) aguardando atendente")
+        _handover_changed(HANDOVER_WHATSAPP_NOTIFY)
+    return jsonify({
+        "status": "success",
+        "message": "Atendente notificado",
+        "ticket_id": ticket_id,
+        "position": position,
+        "duplicate": not created,
+    })
+
+@app.route('/api/handover/queue', methods=['GET'])
+def handover_queue():
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        return jsonify({
+            "tickets": handover_service.open_tickets(cursor),
+            "stats": handover_service.wait_stats(cursor, datetime.date.today(), datetime.date.today()),
+        })
+
+@app.route('/api/handover/stream', methods=['GET'])
+def handover_stream():
+    """SSE para os consoles: um 'snapshot' da fila ao conectar e um 'ticket' por mudança."""
+    try:
+        since_id = int(request.headers.get('Last-Event-ID') or request.args.get('since_id') or -1)
+    except ValueError:
+        return jsonify({"error": "since_id deve ser numérico"}), 400
+
+    def generate():
+        last_id = since_id
+        if last_id < 0:
+            with sqlite3.connect(DB_NAME) as conn:
+                cursor = conn.cursor()
+                last_id = handover_service.last_event_id(cursor)
+                tickets = handover_service.open_tickets(cursor)
+            yield f"id: {last_id}\nevent: snapshot\ndata: {json.dumps(tickets, ensure_ascii=False)}\n\n"
+        while True:
+            token = handover_notifier.token(handover_service.HANDOVER_TOPIC)
+            try:
+                with sqlite3.connect(DB_NAME) as conn:
+                    events = handover_service.events_after(conn.cursor(), last_id, HISTORY_MAX_PAGE)
+            except Exception as e:
+                logger.error(f"Handover stream error: {e}")
+                return
+            for event in events:
+                last_id = event["id"]
+                yield f"id: {last_id}\nevent: ticket\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if len(events) == HISTORY_MAX_PAGE:
+                continue
+            if not handover_notifier.wait(handover_service.HANDOVER_TOPIC, token, HISTORY_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _handover_attendant():
+    attendant = ((request.get_json(silent=True) or {}).get('attendant') or '').strip()
+    if not attendant:
+        raise ValueError("Informe o atendente")
+    return attendant
+
+@app.route('/api/handover/next', methods=['POST'])
+def handover_claim_next():
+    try:
+        attendant = _handover_attendant()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            ticket = handover_service.claim_next(conn.cursor(), attendant)
+            conn.commit()
+    except handover_service.TicketConflict as e:
+        # Outro console pegou o mesmo ticket entre o SELECT e o UPDATE
+        return jsonify({"error": str(e)}), 409
+    if not ticket:
+        return jsonify({"error": "Fila vazia"}), 404
+    _handover_changed()
+    return jsonify(ticket)
+
+@app.route('/api/handover/<int:ticket_id>/<action>', methods=['POST'])
+def handover_ticket_action(ticket_id, action):
+    handlers = {"claim": handover_service.claim, "release": handover_service.release, "close": handover_service.close}
+    if action not in handlers:
+        return jsonify({"error": "Ação inválida"}), 404
+    try:
+        attendant = _handover_attendant()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            cursor = conn.cursor()
+            if not handover_service.get_ticket(cursor, ticket_id):
+                return jsonify({"error": "Ticket não encontrado"}), 404
+            ticket = handlers[action](cursor, ticket_id, attendant)
+            bot_phone = None
+            if action == "close" and (ticket.get("session_id") or "").startswith("whatsapp:"):
+                # Fim do atendimento: o bot volta a responder esse telefone
+                bot_phone = ticket["session_id"].split(":", 1)[1]
+                conversation_service.end_handover(cursor, bot_phone, time.time())
+            conn.commit()
+    except handover_service.TicketConflict as e:
+        return jsonify({"error": str(e)}), 409
+    if bot_phone:
+        whatsapp_bot.forget(bot_phone)
+    _handover_changed()
+    return jsonify(ticket)
+
+@app.route('/api/calendar/slots', methods=['GET'])
+def calendar_slots():
+    doctor = request.args.get('doctor', 'Qualquer especialista')
+    try:
+        day_from = (datetime.date.fromisoformat(request.args['date']) if request.args.get('date')
+                    else datetime.datetime.now(availability_service.CLINIC_TZ).date())
+        days = min(max(int(request.args.get('days', 7)), 1), availability_service.MAX_DAYS)
+    except ValueError:
+        return jsonify({"error": "Parâmetros inválidos: use date=AAAA-MM-DD e days inteiro"}), 400
+    try:
+        slots = availability.slots(doctor, day_from, days)
+        # Tira os horários segurados/reservados no livro local que o cache ainda não viu
+        with sqlite3.connect(DB_NAME) as conn:
+            taken = booking_service.taken_slots(
+                conn.cursor(), availability_service.doctor_key(doctor),
+                day_from.isoformat(), (day_from + datetime.timedelta(days=days)).isoformat()
+            )
+        for slot in taken:
+            day, hour = slot.split(" ")
+            if hour in slots.get(day, []):
+                slots[day].remove(hour)
+                if not slots[day]:
+                    del slots[day]
+    except Exception as e:
+        logger.error(f"Erro ao calcular horários livres: {e}")
+        return jsonify({"error": "Agenda indisponível no momento"}), 503
+    return jsonify({
+        "doctor": doctor,
+        "slot_minutes": availability_service.SLOT_MINUTES,
+        "slots": slots
+    })
+
+@app.route('/api/calendar/hold', methods=['POST'])
+def hold_appointment_slot():
+    data = request.json or {}
+    doctor = data.get('doctor', 'Qualquer especialista')
+    try:
+        start_dt = datetime.datetime.strptime(f"{data.get('date')} {data.get('time')}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        return jsonify({"error": "Informe date (AAAA-MM-DD) e time (HH:MM)"}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            token = booking_service.hold_slot(conn.cursor(), availability_service.doctor_key(doctor), start_dt)
+            conn.commit()
+    except booking_service.SlotUnavailable:
+        return jsonify({"error": "Horário indisponível"}), 409
+    return jsonify({"status": "held", "hold_token": token, "expires_in": booking_service.HOLD_SECONDS})
+
+@app.route('/api/calendar/hold/<token>', methods=['DELETE'])
+def release_appointment_slot(token):
+    with sqlite3.connect(DB_NAME) as conn:
+        released = booking_service.release_hold(conn.cursor(), token)
+        conn.commit()
+    return jsonify({"status": "released" if released else "not_found"})
 
 @app.route('/api/calendar/book', methods=['POST'])
 def book_appointment():
-    if not google_service:
-        return jsonify({"error": "Google Service not available"}), 500
-    
     data = request.json
     name = data.get('name')
     phone = data.get('phone')
     doctor = data.get('doctor', 'Qualquer especialista')
     date_str = data.get('date') # Format: YYYY-MM-DD
     time_str = data.get('time') # Format: HH:MM
+    hold_token = data.get('hold_token')
     
     summary = f"Consulta Optométrica: {name}"
     description = f"Paciente: {name}\nWhatsApp: {phone}\nDoutor(a): {doctor}\nOrigem: Vizô Chatbot"
@@ -960,46 +1351,81 @@ def book_appointment():
     # Define start time
     confirmed_date = date_str
     confirmed_time = time_str
+    start_dt = None
     
     if date_str and time_str:
         try:
             # Parse provided date and time
             dt_str = f"{date_str} {time_str}"
             start_dt = datetime.datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-            start_time = start_dt.isoformat() + 'Z' # UTC-ish (simple isoformat)
+            # Horário local da clínica com o offset explícito (mesmo fuso do free/busy)
+            start_time = start_dt.replace(tzinfo=availability_service.CLINIC_TZ).isoformat()
             
             # Formatação bonita para retorno
             confirmed_date = start_dt.strftime("%d/%m/%Y")
             confirmed_time = start_dt.strftime("%H:%M")
         except ValueError:
              # Fallback if parse fails
-             start_time = (datetime.datetime.now() + datetime.timedelta(hours=1)).isoformat() + 'Z'
+             start_time = (datetime.datetime.now(availability_service.CLINIC_TZ) + datetime.timedelta(hours=1)).isoformat(timespec='seconds')
              confirmed_time = "Horário a definir"
     else:
         # Simula agendamento para daqui a 1 hora se não especificado
-        start_time = (datetime.datetime.now() + datetime.timedelta(hours=1)).isoformat() + 'Z'
-        confirmed_date = datetime.datetime.now().strftime("%d/%m/%Y")
+        start_time = (datetime.datetime.now(availability_service.CLINIC_TZ) + datetime.timedelta(hours=1)).isoformat(timespec='seconds')
+        confirmed_date = datetime.datetime.now(availability_service.CLINIC_TZ).strftime("%d/%m/%Y")
         confirmed_time = "Horário a definir"
     
-    link = google_service.create_appointment(summary, description, start_time)
-    
-    # Salva na planilha (Banco de Dados)
-    if SPREADSHEET_ID:
-        google_service.add_lead_to_sheets(SPREADSHEET_ID, [
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            name, phone, doctor, f"Confirmado via Google ({confirmed_date} {confirmed_time})"
-        ])
+    # Só o que já está em memória: o agendamento não espera o free/busy. A
+    # reserva local (UNIQUE) barra a duplicidade e o job do Calendar acerta o resto
+    if start_dt and not hold_token and not availability.is_free(doctor, start_dt, load=False):
+        return jsonify({"error": "Horário indisponível", "message": "Horário indisponível"}), 409
+
+    # Reserva, agenda local e tarefas externas na mesma transação: ou tudo ou nada
+    calendar_key = uuid.uuid4().hex
+    scheduled_reminders = []
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            cursor = conn.cursor()
+            reservation_id = None
+            if start_dt:
+                reservation_id = booking_service.reserve_slot(
+                    cursor, availability_service.doctor_key(doctor), start_dt, hold_token)
+            appointment_id = report_service.record_appointment(cursor, name, phone, doctor, start_dt)
+            if reservation_id:
+                booking_service.attach_appointment(cursor, reservation_id, appointment_id)
+            booking_service.enqueue_job(cursor, 'calendar', {
+                "appointment_id": appointment_id,
+                "summary": summary,
+                "description": description,
+                "start_time": start_time,
+                "doctor_calendar": availability.calendars().get(availability_service.doctor_key(doctor)),
+            }, calendar_key)
+            if phone and APPOINTMENT_REMINDER_ENABLED:
+                whatsapp_service.enqueue_message(cursor, phone, (
+                    f"Olá, aqui é o Vizô da Pró-Visão Saúde Ocular Macapá. "
+                    f"Sua consulta foi agendada para {confirmed_date} às {confirmed_time} com {doctor}. "
+                    "Este é um lembrete automático gerado pelo nosso assistente virtual."
+                ), f"reminder-{appointment_id}")
+                if start_dt:
+                    scheduled_reminders = reminder_service.schedule_reminders(cursor, appointment_id, start_dt)
+            # Salva na planilha (Banco de Dados)
+            if SPREADSHEET_ID:
+                outbox_service.enqueue_row(cursor, SPREADSHEET_ID, [
+                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    name, phone, doctor, f"Confirmado via Vizô ({confirmed_date} {confirmed_time})"
+                ])
+            conn.commit()
+    except booking_service.SlotUnavailable:
+        return jsonify({"error": "Horário indisponível", "message": "Horário indisponível"}), 409
+    except Exception as e:
+        logger.error(f"Erro ao registrar agendamento: {e}")
+        return jsonify({"error": "Failed to create appointment"}), 500
 
-    if phone and APPOINTMENT_REMINDER_ENABLED:
-        try:
-            reminder_msg = (
-                f"Olá, aqui é o Vizô da Pró-Visão Saúde Ocular Macapá. "
-                f"Sua consulta foi agendada para {confirmed_date} às {confirmed_time} com {doctor}. "
-                "Este é um lembrete automático gerado pelo nosso assistente virtual."
-            )
-            send_whatsapp_text(phone, reminder_msg)
-        except Exception as e:
-            logger.error(f"Erro ao enviar lembrete automático via WhatsApp: {e}")
+    if start_dt:
+        availability.add_busy(doctor, start_dt)
+    appointment_reminders.add(scheduled_reminders)
+    booking_jobs.wake()
+    sheets_outbox.wake()
+    whatsapp_outbox.wake()
 
     # Simula envio de relatório se solicitado (feature request)
     # "mande o relatorio para 96 991503360"
@@ -1008,16 +1434,62 @@ def book_appointment():
     logger.info(f"Nova consulta agendada: {name} | {phone} | {doctor} | {start_time}")
     logger.info("-----------------------------------------------")
 
-    if link:
-        return jsonify({
-            "status": "success", 
-            "link": link,
-            "date_formatted": confirmed_date,
-            "time_formatted": confirmed_time
-        })
-    return jsonify({"error": "Failed to create appointment"}), 500
+    # O evento no Calendar é criado em segundo plano; o link aparece em /api/calendar/appointment/<id>
+    return jsonify({
+        "status": "success", 
+        "appointment_id": appointment_id,
+        "link": None,
+        "date_formatted": confirmed_date,
+        "time_formatted": confirmed_time
+    })
+
+@app.route('/api/calendar/appointment/<int:appointment_id>', methods=['GET'])
+def get_appointment(appointment_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, start_at, name, doctor, status, calendar_link FROM appointments WHERE id = ?",
+            (appointment_id,)
+        )
+        row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "Agendamento não encontrado"}), 404
+    return jsonify({
+        "id": row[0], "start_at": row[1], "name": row[2], "doctor": row[3],
+        "status": row[4], "link": row[5]
+    })
+
+def _create_calendar_event(payload, key):
+    """Tarefa 'calendar': a chave vira o id do evento, então repetir não duplica a consulta."""
+    service = get_google_service()
+    if not service:
+        raise RuntimeError("Google Service not available")
+    link = service.create_appointment(
+        payload["summary"], payload["description"], payload["start_time"],
+        doctor_email=payload.get("doctor_calendar"), event_id=key
+    )
+    if not link:
+        raise RuntimeError("Falha ao criar evento no Google Calendar")
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("UPDATE appointments SET calendar_link = ? WHERE id = ?", (link, payload["appointment_id"]))
+        conn.commit()
+
+def _send_booking_whatsapp(payload, key):
+    # Tarefas antigas de lembrete: repassa para a fila do WhatsApp com a mesma chave
+    queue_whatsapp_text(payload["phone"], payload["message"], key)
+
+booking_jobs = booking_service.BookingJobWorker(lambda: DB_NAME, {
+    'calendar': _create_calendar_event,
+    'whatsapp': _send_booking_whatsapp,
+})
 
 # --- CHAT LOGGING ENDPOINTS ---
+chat_notifier = Notifier()
+
+HISTORY_MAX_PAGE = 500
+HISTORY_MAX_WAIT = 30
+HISTORY_KEEPALIVE = 15
+
 @app.route('/api/log/message', methods=['POST'])
 def log_message():
     try:
@@ -1035,139 +1507,232 @@ def log_message():
                 "INSERT INTO chat_logs (session_id, sender, message) VALUES (?, ?, ?)",
                 (session_id, sender, message)
             )
+            message_id = cursor.lastrowid
             conn.commit()
+        chat_notifier.notify(session_id)
             
-        return jsonify({"status": "success"})
+        return jsonify({"status": "success", "id": message_id})
     except Exception as e:
         logger.error(f"Log Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET', 'POST'])
+def metrics_events():
+    if request.method == 'GET':
+        since = request.args.get('since')
+        if since:
+            try:
+                datetime.date.fromisoformat(since)
+            except ValueError:
+                return jsonify({"error": "since deve ser YYYY-MM-DD"}), 400
+        with sqlite3.connect(DB_NAME) as conn:
+            return jsonify({"events": metrics_service.event_counts(conn.cursor(), since)})
+
+    # Lotes do MetricsLogger (terminal) e do VizoMetrics (chat web); o sendBeacon
+    # do chat pode chegar sem Content-Type JSON
+    data = request.get_json(force=True, silent=True)
+    try:
+        rows, rejected = metrics_service.parse_batch(data)
+    except metrics_service.InvalidBatch as e:
+        return jsonify({"error": str(e)}), 400
+    if rows:
+        try:
+            with sqlite3.connect(DB_NAME) as conn:
+                metrics_service.insert_events(conn.cursor(), rows)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Erro ao gravar métricas: {e}")
+            return jsonify({"error": str(e)}), 500
+    return jsonify({"status": "success", "accepted": len(rows), "rejected": rejected})
+
+def _fetch_history(session_id, since_id=0, limit=None):
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        sql = "SELECT id, sender, message, timestamp FROM chat_logs WHERE session_id = ? AND id > ? ORDER BY id ASC"
+        params = [session_id, since_id]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+def _history_args():
+    """Lê since_id, limit e wait da URL. Levanta ValueError se algum não for inteiro."""
+    try:
+        since_id = max(0, int(request.args.get('since_id') or 0))
+        limit = request.args.get('limit')
+        limit = min(max(1, int(limit)), HISTORY_MAX_PAGE) if limit else None
+        wait = min(max(0.0, float(request.args.get('wait') or 0)), HISTORY_MAX_WAIT)
+    except ValueError:
+        raise ValueError("since_id, limit e wait devem ser numéricos")
+    return since_id, limit, wait
+
 @app.route('/api/history/<session_id>', methods=['GET'])
 def get_chat_history(session_id):
+    """Histórico da sessão a partir de since_id.
+
+    Sem parâmetros devolve a conversa inteira, como antes. Com `wait=N` a
+    requisição fica aberta até N segundos esperando mensagens novas
+    (long-poll) e volta assim que log_message gravar algo na sessão.
+    """
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT sender, message, timestamp FROM chat_logs WHERE session_id = ? ORDER BY id ASC",
-                (session_id,)
-            )
-            rows = cursor.fetchall()
-            
-        history = [dict(row) for row in rows]
+        since_id, limit, wait = _history_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            token = chat_notifier.token(session_id)
+            history = _fetch_history(session_id, since_id, limit)
+            remaining = deadline - time.monotonic()
+            if history or remaining <= 0:
+                break
+            if not chat_notifier.wait(session_id, token, remaining):
+                break
         return jsonify(history)
     except Exception as e:
         logger.error(f"History Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/history/<session_id>/stream', methods=['GET'])
+def stream_chat_history(session_id):
+    """Server-Sent Events com as mensagens novas da sessão (id do evento = id da mensagem)."""
+    try:
+        since_id = max(0, int(request.headers.get('Last-Event-ID') or request.args.get('since_id') or 0))
+    except ValueError:
+        return jsonify({"error": "since_id deve ser numérico"}), 400
+
+    def generate():
+        last_id = since_id
+        while True:
+            token = chat_notifier.token(session_id)
+            try:
+                rows = _fetch_history(session_id, last_id, HISTORY_MAX_PAGE)
+            except Exception as e:
+                logger.error(f"History stream error: {e}")
+                return
+            for row in rows:
+                last_id = row["id"]
+                yield f"id: {last_id}\ndata: {json.dumps(row, ensure_ascii=False)}\n\n"
+            if len(rows) == HISTORY_MAX_PAGE:
+                continue
+            if not chat_notifier.wait(session_id, token, HISTORY_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/api/search/messages', methods=['GET'])
+def search_messages():
+    """Busca nas conversas (q, from, to, limit, offset), agrupada por sessão."""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "Parâmetro 'q' é obrigatório"}), 400
+    try:
+        filters = lead_service.parse_filters(request.args)
+        limit = min(max(1, int(request.args.get('limit') or search_service.DEFAULT_PAGE_SIZE)), search_service.MAX_PAGE_SIZE)
+        offset = max(0, int(request.args.get('offset') or 0))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            result = search_service.search_messages(
+                conn.cursor(), query, filters.get('from'), filters.get('to'), limit, offset
+            )
+        result.update({"query": query, "limit": limit, "offset": offset})
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Erro na busca de mensagens: {e}")
+        return jsonify({"error": str(e)}), 500
+
+response_cache = ResponseCache(lambda: DB_NAME)
+
+def cached_json_response(view):
+    """Serve a resposta JSON do cache enquanto o banco não mudar.
+
+    A chave é o caminho + parâmetros da URL (+ a data UTC, pois "hoje" entra
+    em alguns números). A resposta leva um ETag forte e responde 304 quando o
+    navegador manda If-None-Match igual.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (
+            request.path,
+            tuple(sorted(request.args.items(multi=True))),
+            datetime.datetime.utcnow().date().isoformat(),
+        )
+        version = response_cache.version()
+        cached = response_cache.get(key, version)
+        if cached is not None:
+            body, etag = cached
+            resp = app.response_class(body, mimetype='application/json')
+            resp.headers['X-Cache'] = 'HIT'
+        else:
+            resp = app.make_response(view(*args, **kwargs))
+            if resp.status_code != 200 or resp.mimetype != 'application/json':
+                return resp
+            etag = response_cache.put(key, version, resp.get_data())
+            resp.headers['X-Cache'] = 'MISS'
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp.make_conditional(request)
+    return wrapper
+
+def _dashboard_range_args():
+    return rollup_service.parse_range(
+        request.args.get('from'),
+        request.args.get('to'),
+        request.args.get('granularity'),
+    )
+
 @app.route('/api/dashboard/overview', methods=['GET'])
+@cached_json_response
 def dashboard_overview():
+    try:
+        date_from, date_to, granularity = _dashboard_range_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
         with sqlite3.connect(DB_NAME) as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS patient_leads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    name TEXT,
-                    phone TEXT,
-                    status TEXT,
-                    source TEXT,
-                    medium TEXT,
-                    campaign TEXT,
-                    context TEXT,
-                    interest TEXT
-                )
-            ''')
-
-            cursor.execute("SELECT COUNT(*) AS c FROM patient_leads")
-            total_leads = cursor.fetchone()["c"]
-
-            cursor.execute("""
-                SELECT COUNT(*) AS c FROM patient_leads
-                WHERE LOWER(COALESCE(status, '')) LIKE 'agendado%%'
-                   OR LOWER(COALESCE(status, '')) LIKE 'confirmado%%'
-            """)
-            conversions = cursor.fetchone()["c"]
 
+            total_leads, conversions = rollup_service.query_totals(cursor, date_from, date_to)
             conversion_rate = round((conversions / total_leads) * 100.0, 1) if total_leads else 0.0
 
-            cursor.execute("""
-                SELECT DATE(created_at) AS day,
-                       COUNT(*) AS leads,
-                       SUM(
-                           CASE
-                               WHEN LOWER(COALESCE(status, '')) LIKE 'agendado%%'
-                                 OR LOWER(COALESCE(status, '')) LIKE 'confirmado%%'
-                               THEN 1 ELSE 0
-                           END
-                       ) AS conversions
-                FROM patient_leads
-                GROUP BY DATE(created_at)
-                ORDER BY DATE(created_at) ASC
-            """)
-            daily_rows = cursor.fetchall()
-
             daily_labels = []
             daily_leads = []
             daily_conversions = []
-            for row in daily_rows:
-                day = row["day"]
-                daily_labels.append(day)
-                daily_leads.append(row["leads"])
-                daily_conversions.append(row["conversions"] or 0)
-
-            cursor.execute("""
-                SELECT LOWER(COALESCE(source, 'direct')) AS src, COUNT(*) AS c
-                FROM patient_leads
-                GROUP BY LOWER(COALESCE(source, 'direct'))
-            """)
-            src_rows = cursor.fetchall()
-
-            def normalize_source(raw):
-                s = (raw or '').lower()
-                if 'insta' in s:
-                    return 'Instagram'
-                if 'whats' in s or 'zap' in s:
-                    return 'WhatsApp'
-                if 'face' in s:
-                    return 'Facebook'
-                if 'google' in s:
-                    return 'Google Ads'
-                if 'site' in s or 'direct' in s:
-                    return 'Site Direto'
-                return 'Outros'
-
-            color_map = {
-                'Instagram': '#E1306C',
-                'WhatsApp': '#25D366',
-                'Facebook': '#1877F2',
-                'Site Direto': '#2e70ce',
-                'Google Ads': '#FBBC05',
-                'Outros': '#6b7280'
-            }
+            for period, leads, conv in rollup_service.query_series(cursor, date_from, date_to, granularity):
+                daily_labels.append(period)
+                daily_leads.append(leads)
+                daily_conversions.append(conv or 0)
 
             lead_labels = []
             lead_data = []
             lead_colors = []
-            agg_sources = {}
-            for row in src_rows:
-                label = normalize_source(row["src"])
-                agg_sources[label] = agg_sources.get(label, 0) + row["c"]
-            for label, count in agg_sources.items():
+            for label, count in rollup_service.query_sources(cursor, date_from, date_to).items():
                 lead_labels.append(label)
                 lead_data.append(count)
-                lead_colors.append(color_map.get(label, '#6b7280'))
+                lead_colors.append(rollup_service.SOURCE_COLORS.get(label, '#6b7280'))
 
             cursor.execute("""
                 SELECT created_at, name, phone, status, source, interest
                 FROM patient_leads
-                ORDER BY datetime(created_at) DESC
+                ORDER BY created_at DESC, id DESC
                 LIMIT 50
             """)
             recent_rows = cursor.fetchall()
 
+            # Tempos reais da fila de atendimento humano no período
+            handover = handover_service.wait_stats(cursor, date_from, date_to)
+            # Sessões de chat resumidas pelo job de sessionização
+            sessions = session_stats_service.kpis(cursor, date_from, date_to)
+
             recent_leads = []
             for row in recent_rows:
                 created_at = row["created_at"]
@@ -1177,22 +1742,28 @@ def dashboard_overview():
                     "status": row["status"] or "Novo Lead",
                     "phone": row["phone"],
                     "type": row["interest"] or "Consulta",
-                    "source": normalize_source(row["source"])
+                    "source": rollup_service.source_label(rollup_service.source_key(row["source"]))
                 })
 
         overview = {
             "totalLeads": total_leads,
             "conversions": conversions,
             "conversionRate": conversion_rate,
-            "avgWaitTime": "45s",
-            "avgHandleTime": "3m 12s",
-            "activeChats": 0
+            "avgWaitTime": handover_service.format_duration(handover["avg_wait"]),
+            "avgHandleTime": handover_service.format_duration(handover["avg_handle"]),
+            "activeChats": sessions["active_chats"],
+            "waitingForAttendant": handover["waiting"],
+            "chatSessions": sessions["sessions"],
+            "avgFirstResponseTime": handover_service.format_duration(sessions["avg_first_response"]),
+            "avgSessionDuration": handover_service.format_duration(sessions["avg_duration"]),
+            "leadCaptureRate": sessions["lead_rate"]
         }
 
         daily_performance = {
             "labels": daily_labels,
             "leads": daily_leads,
-            "conversions": daily_conversions
+            "conversions": daily_conversions,
+            "granularity": granularity
         }
 
         lead_sources = {
@@ -1212,78 +1783,50 @@ def dashboard_overview():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/dashboard/social/<channel>', methods=['GET'])
+@cached_json_response
 def dashboard_social(channel):
     channel = (channel or '').lower()
+    try:
+        date_from, date_to, granularity = _dashboard_range_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
         with sqlite3.connect(DB_NAME) as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS patient_leads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    name TEXT,
-                    phone TEXT,
-                    status TEXT,
-                    source TEXT,
-                    medium TEXT,
-                    campaign TEXT,
-                    context TEXT,
-                    interest TEXT
-                )
-            ''')
-
-            cursor.execute("""
-                SELECT COUNT(*) AS c FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-            """, (channel,))
-            total_leads = cursor.fetchone()["c"]
-
-            cursor.execute("""
-                SELECT COUNT(*) AS c FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-                  AND (LOWER(COALESCE(status, '')) LIKE 'agendado%%'
-                       OR LOWER(COALESCE(status, '')) LIKE 'confirmado%%')
-            """, (channel,))
-            conversions = cursor.fetchone()["c"]
 
+            summary = rollup_service.query_channel_summary(cursor, channel, date_from, date_to, granularity)
+            total_leads = summary["total"]
+            conversions = summary["conversions"]
             conversion_rate = round((conversions / total_leads) * 100.0, 1) if total_leads else 0.0
 
-            cursor.execute("""
-                SELECT COUNT(*) AS c FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-                  AND DATE(created_at) = DATE('now')
-            """, (channel,))
-            leads_today = cursor.fetchone()["c"]
-
-            cursor.execute("""
-                SELECT COUNT(*) AS c FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-                  AND DATE(created_at) = DATE('now', '-1 day')
-            """, (channel,))
-            leads_yesterday = cursor.fetchone()["c"]
-
+            leads_today = summary["today"]
+            leads_yesterday = summary["yesterday"]
             daily_growth = leads_today
             if leads_yesterday:
                 daily_growth = leads_today - leads_yesterday
 
-            cursor.execute("""
-                SELECT interest, COUNT(*) AS c
-                FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-                  AND COALESCE(interest, '') != ''
-                GROUP BY interest
-                ORDER BY c DESC
-                LIMIT 1
-            """, (channel,))
-            row = cursor.fetchone()
-            top_interest = row["interest"] if row else "-"
+            interests = summary["interests"]
+            ranked = sorted(((c, b) for b, c in interests.items() if b and c), reverse=True)
+            top_interest = ranked[0][1] if ranked else "-"
+
+            buckets = {b: 0 for b in rollup_service.INTEREST_BUCKETS}
+            for bucket, count in interests.items():
+                buckets[bucket or "Outros"] += count or 0
+            chart_data = [buckets[b] for b in rollup_service.INTEREST_BUCKETS]
+
+            performance = {
+                "labels": list(summary["series"].keys()),
+                "leads": [p[0] for p in summary["series"].values()],
+                "conversions": [p[1] for p in summary["series"].values()],
+                "granularity": granularity
+            }
 
             cursor.execute("""
                 SELECT created_at, name, phone, status, interest
                 FROM patient_leads
                 WHERE LOWER(COALESCE(source, '')) = ?
-                ORDER BY datetime(created_at) DESC
+                ORDER BY created_at DESC
                 LIMIT 20
             """, (channel,))
             recent_rows = cursor.fetchall()
@@ -1299,45 +1842,14 @@ def dashboard_social(channel):
                     "status": r["status"] or "Novo Lead"
                 })
 
-            cursor.execute("""
-                SELECT interest, COUNT(*) AS c
-                FROM patient_leads
-                WHERE LOWER(COALESCE(source, '')) = ?
-                GROUP BY interest
-            """, (channel,))
-            interest_rows = cursor.fetchall()
-
-            def classify_interest(label):
-                if not label:
-                    return "Outros"
-                l = label.lower()
-                if "consulta" in l:
-                    return "Consulta"
-                if "exame" in l or "exames" in l:
-                    return "Exames"
-                if "cirurg" in l:
-                    return "Cirurgia"
-                return "Outros"
-
-            buckets = {"Consulta": 0, "Exames": 0, "Cirurgia": 0, "Outros": 0}
-            for r in interest_rows:
-                bucket = classify_interest(r["interest"])
-                buckets[bucket] += r["c"]
-
-            chart_data = [
-                buckets["Consulta"],
-                buckets["Exames"],
-                buckets["Cirurgia"],
-                buckets["Outros"]
-            ]
-
         return jsonify({
             "totalLeads": total_leads,
             "conversionRate": conversion_rate,
             "dailyGrowth": daily_growth,
             "topInterest": top_interest,
             "recentLeads": recent_leads,
-            "chartData": chart_data
+            "chartData": chart_data,
+            "performance": performance
         })
     except Exception as e:
         logger.error(f"Dashboard social error ({channel}): {e}")
@@ -1345,20 +1857,33 @@ def dashboard_social(channel):
 
 @app.route('/api/drive/knowledge', methods=['GET'])
 def get_knowledge():
-    if not google_service:
+    service = get_google_service()
+    if not service:
         return jsonify({"error": "Google Drive not connected"}), 500
     
-    files = google_service.list_knowledge_files(KNOWLEDGE_FOLDER_ID)
+    files = service.list_knowledge_files(KNOWLEDGE_FOLDER_ID)
     return jsonify(files)
 
 @app.route('/api/sheets/report', methods=['GET'])
 def trigger_report():
-    if not google_service:
-        return jsonify({"error": "Google Sheets not connected"}), 500
-    
-    report = google_service.get_morning_report(SPREADSHEET_ID)
-    # Aqui dispararia para o WhatsApp real via Webhook ou similar
-    return jsonify({"report": report})
+    # Só leitura: o texto vem de daily_reports ou é montado na hora; quem grava e envia é o morning_report
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            report = report_service.get_report(conn, report_service.today())
+        return jsonify({"report": report})
+    except Exception as e:
+        logger.error(f"Erro ao gerar relatório: {e}")
+        return jsonify({"error": "Erro ao gerar relatório"}), 500
+
+@app.route('/api/sheets/outbox', methods=['GET'])
+def sheets_outbox_status():
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            stats = outbox_service.backlog(conn.cursor())
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"Erro ao consultar outbox do Sheets: {e}")
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/api/sales_lead', methods=['POST'])
 def save_sales_lead():
@@ -1406,137 +1931,319 @@ def save_sales_lead():
         logger.error(f"Erro ao salvar sales_lead: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/leads/by-phone/<phone>', methods=['GET'])
+def lead_by_phone(phone):
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        lead = phone_service.find_lead(cursor, phone)
+        if not lead:
+            return jsonify({"error": "Lead não encontrado"}), 404
+        lead["history"] = phone_service.attribution_history(cursor, lead["id"])
+    return jsonify(lead)
+
 @app.route('/api/leads', methods=['GET'])
+@cached_json_response
 def get_patient_leads():
     try:
+        filters = lead_service.parse_filters(request.args)
+        limit = lead_service.parse_limit(request.args.get('limit'))
+        cursor_token = request.args.get('cursor') or None
         with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS patient_leads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    name TEXT,
-                    phone TEXT,
-                    status TEXT,
-                    source TEXT,
-                    medium TEXT,
-                    campaign TEXT,
-                    context TEXT,
-                    interest TEXT
-                )
-            ''')
-            cursor.execute("""
-                SELECT created_at, name, phone, status, source, interest
-                FROM patient_leads
-                ORDER BY datetime(created_at) DESC
-                LIMIT 500
-            """)
-            rows = cursor.fetchall()
-
-        leads = []
-        for row in rows:
-            leads.append({
-                "created_at": row["created_at"],
-                "name": row["name"] or "Paciente",
-                "phone": row["phone"],
-                "status": row["status"] or "Novo Lead",
-                "source": row["source"],
-                "interest": row["interest"] or "Consulta"
-            })
-
-        return jsonify(leads)
+            rows, next_cursor = lead_service.fetch_page(cursor, filters, cursor_token, limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Erro ao buscar patient_leads: {e}")
         return jsonify({"error": str(e)}), 500
 
-def send_whatsapp_text(phone: str, message: str) -> bool:
-    if not ZAPI_ENABLED:
-        logger.warning("Z-API não configurado. Mensagem não enviada.")
-        return False
-    if not requests:
-        logger.error("Biblioteca 'requests' não disponível para envio via Z-API.")
-        return False
+    leads = []
+    for row in rows:
+        leads.append({
+            "id": row["id"],
+            "created_at": row["created_at"],
+            "name": row["name"] or "Paciente",
+            "phone": row["phone"],
+            "status": row["status"] or "Novo Lead",
+            "source": row["source"],
+            "campaign": row["campaign"],
+            "interest": row["interest"] or "Consulta"
+        })
 
-    def _normalize_phone(p: str) -> str:
-        digits = re.sub(r"\D+", "", str(p or ""))
-        if not digits:
-            return ""
-        if digits.startswith("55") and len(digits) >= 12:
-            return digits
-        if len(digits) in (10, 11) and not digits.startswith("55"):
-            return "55" + digits
-        if not digits.startswith("55"):
-            digits = "55" + digits
-        return digits
+    return jsonify({"leads": leads, "next_cursor": next_cursor})
 
+@app.route('/api/leads/export', methods=['GET'])
+def export_patient_leads():
+    fmt = (request.args.get('format') or 'csv').lower()
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({"error": "format deve ser csv ou ndjson"}), 400
     try:
-        norm_phone = _normalize_phone(phone)
-        if not norm_phone:
-            logger.error(f"Telefone inválido para Z-API: {phone!r}")
-            return False
+        filters = lead_service.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        # A conexão fica aberta só enquanto o download é transmitido;
+        # as linhas saem direto do cursor do SQLite.
+        conn = sqlite3.connect(DB_NAME)
+        try:
+            rows = lead_service.iter_leads(conn.cursor(), filters)
+            if fmt == 'csv':
+                yield from lead_service.stream_csv(rows)
+            else:
+                yield from lead_service.stream_ndjson(rows)
+        except Exception as e:
+            logger.error(f"Erro ao exportar patient_leads: {e}")
+        finally:
+            conn.close()
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f"pacientes_provisao_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+def zapi_send_text(phone: str, message: str) -> dict:
+    """Envia uma mensagem pelo Z-API agora. Retorna {ok, message_id, status, error}."""
+    if not ZAPI_ENABLED:
+        return {"ok": False, "status": None, "error": "Z-API não configurado"}
+    if not requests:
+        return {"ok": False, "status": None, "error": "Biblioteca 'requests' não disponível"}
 
+    norm_phone = whatsapp_service.normalize_phone(phone)
+    if not norm_phone:
+        return {"ok": False, "status": 400, "error": f"Telefone inválido: {phone!r}"}
+    try:
         base = (ZAPI_BASE_URL or "https://api.z-api.io").rstrip("/")
         url = f"{base}/instances/{ZAPI_INSTANCE_ID}/token/{ZAPI_TOKEN}/send-text"
-        payload = {
-            "phone": norm_phone,
-            "message": str(message or "")
-        }
-        safe_token_suffix = (ZAPI_TOKEN or "")[-4:]
-        logger.info(
-            "Enviando via Z-API",
-        )
-        logger.info(
-            json.dumps(
-                {
-                    "instance": ZAPI_INSTANCE_ID,
-                    "token_suffix": safe_token_suffix,
-                    "payload": payload,
-                },
-                ensure_ascii=False,
-            )
-        )
-        resp = requests.post(url, json=payload, timeout=20)
-        logger.info(f"Resposta Z-API {resp.status_code}")
+        resp = requests.post(url, json={"phone": norm_phone, "message": str(message or "")}, timeout=20)
         if 200 <= resp.status_code < 300:
-            return True
-        logger.error(f"Falha Z-API {resp.status_code}: {resp.text}")
-        return False
+            try:
+                body = resp.json()
+            except ValueError:
+                body = {}
+            message_id = body.get("messageId") or body.get("zaapId") or body.get("id")
+            logger.info(f"Z-API {resp.status_code}: mensagem para ...{norm_phone[-4:]} ({message_id})")
+            return {"ok": True, "status": resp.status_code, "message_id": message_id}
+        return {"ok": False, "status": resp.status_code, "error": resp.text[:500]}
     except Exception as e:
-        logger.error(f"Erro ao enviar mensagem via Z-API: {e}")
-        return False
+        return {"ok": False, "status": None, "error": str(e)}
+
+# Fila persistente de saída do WhatsApp (whatsapp_outbox), com token bucket por instância
+whatsapp_outbox = whatsapp_service.WhatsAppOutboxWorker(
+    lambda: DB_NAME, zapi_send_text, lambda: ZAPI_ENABLED, lambda: ZAPI_INSTANCE_ID or "default"
+)
+
+def queue_whatsapp_text(phone, message, dedupe_key=None):
+    """Coloca a mensagem na fila e devolve o id local na hora."""
+    with sqlite3.connect(DB_NAME) as conn:
+        message_id = whatsapp_service.enqueue_message(conn.cursor(), phone, message, dedupe_key)
+        conn.commit()
+    whatsapp_outbox.wake()
+    return message_id
+
+@app.route('/api/whatsapp/messages/<int:message_id>', methods=['GET'])
+def whatsapp_message_status(message_id):
+    with sqlite3.connect(DB_NAME) as conn:
+        message = whatsapp_service.get_message(conn.cursor(), message_id)
+    if not message:
+        return jsonify({"error": "Mensagem não encontrada"}), 404
+    return jsonify(message)
+
+@app.route('/api/whatsapp/outbox', methods=['GET'])
+def whatsapp_outbox_status():
+    with sqlite3.connect(DB_NAME) as conn:
+        return jsonify(whatsapp_service.backlog(conn.cursor()))
 
 @app.route('/api/exam/send', methods=['POST'])
 def send_exam_result():
-    data = request.json
-    phone = data.get('phone')
-    exam_link = data.get('link')
-    
-    if not phone:
-        return jsonify({"error": "Phone number required"}), 400
-    message = f"Aqui está o link para o seu exame: {exam_link}"
+    """Envia o link do exame para o WhatsApp cadastrado do paciente.
+
+    Só resolve o exame para um lead verificado pelo telefone (phone_service)
+    cujo nome bate com o digitado, busca os arquivos pelo nome do cadastro
+    (busca aproximada, com score mínimo) e só envia para esse telefone. A
+    resposta é sempre a mesma e nunca traz link ou nome de arquivo, para não
+    revelar se alguém tem exame na clínica.
+    """
+    data = request.get_json(silent=True) or {}
+    phone = (data.get('phone') or '').strip()
+    name = (data.get('name') or '').strip()
+    if not phone or not name:
+        return jsonify({"error": "Informe 'phone' e 'name'"}), 400
+    accepted = jsonify({
+        "status": "accepted",
+        "message": "Se houver um exame disponível no seu nome, o link será enviado para o seu WhatsApp cadastrado."
+    }), 202
 
-    enviado = send_whatsapp_text(phone, message)
-    if not enviado:
+    with sqlite3.connect(DB_NAME) as conn:
+        cursor = conn.cursor()
+        lead = phone_service.find_lead(cursor, phone)
+        if not lead or exam_index_service.similarity(name, lead["name"]) < exam_index_service.MATCH_SCORE:
+            return accepted
+        exams = exam_index_service.exams_for_patient(
+            cursor, lead["name"], exam_index_service.parse_date(data.get('date')))
+    if not exams or not exams[0]["link"]:
+        return accepted
+
+    exam = exams[0]
+    try:
+        queue_whatsapp_text(
+            lead["phone"], f"Aqui está o link para o seu exame: {exam['link']}",
+            # No máximo um envio por exame, telefone e dia
+            f"exam-{exam['file_id']}-{whatsapp_service.normalize_phone(lead['phone'])}-{datetime.date.today()}"
+        )
+    except Exception as e:
+        logger.error(f"Erro ao enfileirar exame para o WhatsApp: {e}")
         return jsonify({"error": "Falha ao enviar mensagem via WhatsApp (Z-API)."}), 500
-    
-    return jsonify({
-        "status": "success",
-        "channel": "z-api",
-        "message": f"Exame enviado para {phone}"
-    })
+    return accepted
+
+def _zapi_webhook_authorized():
+    checks = (
+        (ZAPI_CLIENT_TOKEN, request.headers.get("Client-Token")),
+        (ZAPI_WEBHOOK_SECRET, request.args.get("secret")),
+    )
+    return any(
+        expected and provided and hmac.compare_digest(provided.encode("utf-8"), expected.encode("utf-8"))
+        for expected, provided in checks
+    )
 
 @app.route('/api/webhook/zapi', methods=['POST'])
 def zapi_webhook():
+    # Só valida e grava na caixa de entrada; o processamento é do zapi_inbox
+    if not (ZAPI_CLIENT_TOKEN or ZAPI_WEBHOOK_SECRET):
+        logger.warning("Webhook Z-API recusado: configure ZAPI_CLIENT_TOKEN ou ZAPI_WEBHOOK_SECRET")
+        return jsonify({"error": "Webhook não configurado"}), 401
+    if not _zapi_webhook_authorized():
+        return jsonify({"error": "Não autorizado"}), 401
     try:
-        data = request.get_json(silent=True) or {}
-        event_type = str(data.get("event") or data.get("type") or "unknown")
-        logger.info(f"Z-API webhook recebido: {event_type}")
-        logger.info(json.dumps(data, ensure_ascii=False))
-        return jsonify({"status": "ok"}), 200
+        with sqlite3.connect(DB_NAME) as conn:
+            event_id, duplicate = webhook_service.ingest(conn.cursor(), request.get_data())
+            conn.commit()
+    except webhook_service.InvalidPayload as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Erro no webhook Z-API: {e}")
-        return jsonify({"error": "invalid payload"}), 400
+        return jsonify({"error": "Falha ao registrar evento"}), 500
+    if not duplicate:
+        zapi_inbox.wake()
+    return jsonify({"status": "ok", "id": event_id, "duplicate": duplicate}), 200
+
+def _zapi_inbound_text(payload):
+    for field, key in (("text", "message"), ("image", "caption"), ("document", "fileName"), ("buttonsResponseMessage", "message")):
+        value = payload.get(field)
+        if isinstance(value, dict) and value.get(key):
+            return str(value[key])
+    return "[mídia]"
+
+def _bot_booking_requested(cursor, session):
+    _insert_patient_lead(cursor, session.name, session.contact or session.phone, 'Em atendimento', 'whatsapp',
+                         interest=f"Consulta - {session.doctor}", consent=session.consent)
+
+# Marca, na thread do worker, que a mensagem em andamento mexeu na fila de atendimento
+_handover_turn = threading.local()
+
+def _bot_event(cursor, session, name, details):
+    """Eventos do funil do WhatsApp vão para funnel_events, como os do chat web."""
+    metrics_service.insert_events(cursor, [(
+        f"whatsapp:{session.phone}", name, "whatsapp", None, json.dumps(details, ensure_ascii=False)
+    )])
+
+def _bot_handover_requested(cursor, session):
+    ticket_id, created = handover_service.open_ticket(
+        cursor, f"whatsapp:{session.phone}", "whatsapp", session.name, session.contact or session.phone,
+        notify_whatsapp=HANDOVER_WHATSAPP_NOTIFY
+    )
+    if created:
+        logger.info(f"Ticket #{ticket_id}: {session.name or session.phone} pediu atendente humano pelo WhatsApp")
+        _handover_turn.changed = True
+
+def _bot_handover_cancelled(cursor, session):
+    if handover_service.cancel(cursor, f"whatsapp:{session.phone}"):
+        _handover_turn.changed = True
+
+def _bot_ask_ai(text):
+    if not has_llm_provider():
+        return None
+    return llm_chat([
+        {"role": "system", "content": "Você é o Vizô da Pró-Visão Macapá. Responda curto e amigável."},
+        {"role": "user", "content": text},
+    ], max_tokens=300)
+
+def _bot_campaign_message():
+    settings = load_campaign_settings()
+    return settings.get('campaign_message') if settings.get('active_campaign') else None
+
+# Vizô no WhatsApp: uma sessão por telefone, respostas pela fila de saída
+WHATSAPP_BOT_ENABLED = _get_env_bool("WHATSAPP_BOT_ENABLED", True)
+whatsapp_bot = conversation_service.ConversationEngine(
+    on_event=_bot_event,
+    on_booking=_bot_booking_requested,
+    on_handover=_bot_handover_requested,
+    on_handover_cancel=_bot_handover_cancelled,
+    ask_ai=_bot_ask_ai,
+    campaign_getter=_bot_campaign_message,
+)
+
+def _on_zapi_received(conn, payload):
+    """Mensagem recebida: entra no histórico da sessão whatsapp:<telefone> e passa pelo bot."""
+    if payload.get("isGroup") or not payload.get("phone"):
+        return
+    phone = whatsapp_service.normalize_phone(payload['phone'])
+    session_id = f"whatsapp:{phone}"
+    sender = 'attendant' if payload.get("fromMe") else 'user'
+    text = _zapi_inbound_text(payload)
+    cursor = conn.cursor()
+    opt_out = sender == 'user' and campaign_service.is_opt_out(text)
+    session, replies = None, []
+    _handover_turn.changed = False
+    if sender == 'user' and not opt_out and WHATSAPP_BOT_ENABLED and payload.get("text"):
+        # Antes das outras escritas: a IA pode demorar e não deve segurar o lock do banco
+        session, replies = whatsapp_bot.handle(cursor, phone, text)
+    cursor.execute(
+        "INSERT INTO chat_logs (session_id, sender, message) VALUES (?, ?, ?)",
+        (session_id, sender, text)
+    )
+    if opt_out:
+        campaign_service.record_opt_out(cursor, payload['phone'])
+        lead = phone_service.find_lead(cursor, payload['phone'])
+        if lead:
+            cursor.execute("UPDATE patient_leads SET consent = 0 WHERE id = ?", (lead["id"],))
+    message_id = payload.get("messageId")
+    for i, reply in enumerate(replies):
+        # Chave pela mensagem recebida: reprocessar o webhook não duplica a resposta
+        whatsapp_service.enqueue_message(cursor, phone, reply, f"bot-{message_id}-{i}" if message_id else None)
+        cursor.execute(
+            "INSERT INTO chat_logs (session_id, sender, message) VALUES (?, ?, ?)",
+            (session_id, 'bot', reply)
+        )
+
+    handover_changed = _handover_turn.changed
+
+    def after_commit():
+        if session is not None:
+            whatsapp_bot.remember(session)
+        if replies:
+            whatsapp_outbox.wake()
+        chat_notifier.notify(session_id)
+        if handover_changed:
+            _handover_changed(HANDOVER_WHATSAPP_NOTIFY)
+    return after_commit
+
+def _on_zapi_status(conn, payload):
+    whatsapp_service.update_delivery_status(conn.cursor(), payload.get("ids") or [], payload.get("status"))
+
+def _on_zapi_delivery(conn, payload):
+    # Confirmação de envio do próprio Z-API (mensagem saiu da instância)
+    if not payload.get("error"):
+        whatsapp_service.update_delivery_status(conn.cursor(), [payload.get("messageId")], "SENT")
+
+zapi_inbox = webhook_service.WebhookInboxProcessor(lambda: DB_NAME, {
+    'received': _on_zapi_received,
+    'status': _on_zapi_status,
+    'delivery': _on_zapi_delivery,
+})
 
 
 # --- ENDPOINT DEEPSEEK (Cérebro do Vizô) ---
@@ -1573,14 +2280,19 @@ def ai_chat():
     except Exception as e:
         logger.error(f"Erro ao carregar settings no chat: {e}")
 
-    if google_service:
-        try:
-            docs = google_service.list_knowledge_files(KNOWLEDGE_FOLDER_ID)
-            if docs:
-                docs_list = "\n".join([f"- {d['name']}: {d.get('webViewLink')}" for d in docs])
-                system_prompt += f"\n\n[DOCUMENTOS DISPONÍVEIS]\nVocê tem acesso aos seguintes arquivos no Google Drive. Se o usuário solicitar algum desses documentos, forneça o link correspondente:\n{docs_list}"
-        except Exception as e:
-            logger.error(f"Erro ao injetar docs do Drive: {e}")
+    # Documentos e trechos vêm do espelho local do Drive (knowledge_service), sem chamadas externas
+    try:
+        with sqlite3.connect(DB_NAME) as conn:
+            cursor = conn.cursor()
+            docs = knowledge_service.list_documents(cursor)
+            chunks = knowledge_service.search_chunks(cursor, user_message)
+        if docs:
+            docs_list = "\n".join([f"- {d['name']}: {d.get('webViewLink')}" for d in docs])
+            system_prompt += f"\n\n[DOCUMENTOS DISPONÍVEIS]\nVocê tem acesso aos seguintes arquivos no Google Drive. Se o usuário solicitar algum desses documentos, forneça o link correspondente:\n{docs_list}"
+        if chunks:
+            system_prompt += "\n\n[TRECHOS DOS DOCUMENTOS]\nUse estes trechos para responder perguntas sobre o conteúdo dos documentos e cite o nome do arquivo:\n" + knowledge_service.format_chunks_for_prompt(chunks)
+    except Exception as e:
+        logger.error(f"Erro ao injetar docs do Drive: {e}")
 
     system_prompt += "\n\n[DOCUMENTO BASE DE CONHECIMENTO]\nBase institucional Pró-Visão (Google Drive): https://drive.google.com/file/d/1Bsmg9UTmCAgfkQrlwBBfBP6vIdBPppXw/view?usp=sharing"
 
@@ -1645,20 +2357,24 @@ def auth_login():
         
     # Verifica Super Usuário
     if SUPER_USERS.get(username) == password:
-        # Autenticado com sucesso. Agora verificar planilha.
-        if google_service and SPREADSHEET_ID:
+        # Autenticado com sucesso. Agora verificar planilha (sem Google o espelho
+        # nunca sincroniza e a linha ficaria presa na fila do Sheets)
+        if get_google_service() and SPREADSHEET_ID:
             try:
-                exists = google_service.check_user_exists(SPREADSHEET_ID, username)
+                exists = user_in_sheet(username)
                 
                 if not exists:
                     # Adiciona na planilha
-                    google_service.add_lead_to_sheets(SPREADSHEET_ID, [
-                        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        username, 
-                        "Super Usuário", 
-                        "-", 
-                        "Acesso Admin Liberado"
-                    ])
+                    with sqlite3.connect(DB_NAME) as conn:
+                        outbox_service.enqueue_row(conn.cursor(), SPREADSHEET_ID, [
+                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            username, 
+                            "Super Usuário", 
+                            "-", 
+                            "Acesso Admin Liberado"
+                        ])
+                        conn.commit()
+                    sheets_outbox.wake()
                     logger.info(f"Super Usuário {username} registrado na planilha.")
                 else:
                     logger.info(f"Super Usuário {username} já existe na planilha.")
@@ -1714,19 +2430,17 @@ def auth_register():
             if cursor.fetchone():
                 return jsonify({"error": "E-mail já cadastrado. Faça login ou recupere a senha."}), 409
             cursor.execute("INSERT INTO users (email, name, password_hash, must_change) VALUES (?, ?, ?, 1)", (email, name, password_hash))
-            conn.commit()
-        # Registrar também no Google Sheets de contatos
-        try:
-            if google_service and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
-                google_service.add_lead_to_sheets(CONTACTS_SHEET_ID, [
+            # Registrar também no Google Sheets de contatos
+            if get_google_service() and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
+                outbox_service.enqueue_row(cursor, CONTACTS_SHEET_ID, [
                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     name,
                     email,
                     "Cadastro Vizô",
                     "Senha provisória enviada"
                 ], "Página1!A1")
-        except Exception as e:
-            logger.error(f"Falha ao registrar contato no Sheets: {e}")
+            conn.commit()
+        sheets_outbox.wake()
     except Exception as e:
         logger.error(f"Erro ao registrar usuário: {e}")
         return jsonify({"error": "Erro ao registrar usuário"}), 500
@@ -1783,14 +2497,16 @@ def auth_forgot():
                     f"Olá {name or email},\n\nSua nova senha provisória é: {provisional}\nFaça login e altere sua senha.\n\nAtenciosamente,\nEquipe Vizô"
                 )
                 try:
-                    if google_service and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
-                        google_service.add_lead_to_sheets(CONTACTS_SHEET_ID, [
+                    if get_google_service() and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
+                        outbox_service.enqueue_row(cursor, CONTACTS_SHEET_ID, [
                             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                             name or "",
                             email,
                             "Recuperação de senha",
                             "Senha provisória enviada" if sent else "Senha provisória gerada (sem envio)"
                         ], "Página1!A1")
+                        conn.commit()
+                        sheets_outbox.wake()
                 except Exception as e:
                     logger.error(f"Falha ao registrar recuperação no Sheets: {e}")
                 resp = {"status": "success", "message": "Se o e-mail existe, a senha foi enviada."}
@@ -1824,24 +2540,120 @@ def change_password():
                 return jsonify({"error": "Senha atual inválida"}), 401
             new_hash = _hash_password(new_password)
             cursor.execute("UPDATE users SET password_hash = ?, must_change = 0 WHERE email = ?", (new_hash, email))
-            conn.commit()
-        try:
-            if google_service and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
-                google_service.add_lead_to_sheets(CONTACTS_SHEET_ID, [
+            if get_google_service() and CONTACTS_SHEET_ID and "digite_o_id" not in CONTACTS_SHEET_ID:
+                outbox_service.enqueue_row(cursor, CONTACTS_SHEET_ID, [
                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     row[1] if row else "",
                     email,
                     "Troca de senha",
                     "Concluída"
                 ], "Página1!A1")
-        except Exception as e:
-            logger.error(f"Falha ao registrar troca no Sheets: {e}")
+            conn.commit()
+        sheets_outbox.wake()
         return jsonify({"status": "success"})
     except Exception as e:
         logger.error(f"Erro na troca de senha: {e}")
         return jsonify({"error": "Erro ao trocar a senha"}), 500
 
+# --- BACKGROUND WORKERS ---
+retention_worker = retention_service.RetentionWorker(lambda: DB_NAME)
+
+# Pasta dos exames (padrão: a mesma pasta de conhecimento)
+EXAMS_FOLDER_ID = os.getenv("GOOGLE_DRIVE_EXAMS_FOLDER_ID") or KNOWLEDGE_FOLDER_ID
+exam_index = exam_index_service.ExamIndexWorker(
+    lambda: DB_NAME, get_google_service,
+    lambda: None if "digite_o_id" in EXAMS_FOLDER_ID else EXAMS_FOLDER_ID
+)
+
+knowledge_sync = knowledge_service.KnowledgeSyncWorker(
+    lambda: DB_NAME, get_google_service,
+    lambda: None if "digite_o_id" in KNOWLEDGE_FOLDER_ID else KNOWLEDGE_FOLDER_ID
+)
+
+# Relatório matinal: destinatários separados por vírgula em MORNING_REPORT_PHONES
+MORNING_REPORT_PHONES = [p.strip() for p in os.getenv("MORNING_REPORT_PHONES", "96 991503360").split(",") if p.strip()]
+morning_report = report_service.MorningReportScheduler(
+    lambda: DB_NAME, lambda phone, text: bool(queue_whatsapp_text(phone, text)), lambda: MORNING_REPORT_PHONES
+)
+
+# Lembretes 24 h e 2 h antes da consulta, pela fila do WhatsApp
+appointment_reminders = reminder_service.ReminderScheduler(
+    lambda: DB_NAME, lambda: whatsapp_outbox.wake(), lambda: APPOINTMENT_REMINDER_ENABLED
+)
+
+# Campanhas: alimenta a fila do WhatsApp aos poucos, com prioridade baixa
+campaign_runner = campaign_service.CampaignRunner(lambda: DB_NAME, lambda: whatsapp_outbox.wake())
+
+phone_maintenance = phone_service.PhoneMaintenanceWorker(lambda: DB_NAME)
+
+# Resumos por sessão de chat_logs para os KPIs do dashboard
+session_stats = session_stats_service.SessionStatsWorker(lambda: DB_NAME)
+
+# --- STARTUP ---
+# O import do app não toca no banco. startup() cria/migra o schema do DB_NAME
+# atual (e faz o seed, se ligado) uma vez; o before_request garante que isso
+# aconteceu antes da primeira requisição mesmo quando ninguém chamou startup().
+_started_dbs = set()
+_startup_lock = threading.Lock()
+
+def startup(seed_users=None):
+    """Fase de inicialização explícita. Retorna o STARTUP_REPORT."""
+    if DB_NAME in _started_dbs:
+        return STARTUP_REPORT
+    with _startup_lock:
+        if DB_NAME not in _started_dbs:
+            started = time.perf_counter()
+            init_db()
+            _record_startup("init_db", started)
+            if SEED_DEFAULT_USERS if seed_users is None else seed_users:
+                started = time.perf_counter()
+                seed_default_users()
+                _record_startup("seed_default_users", started)
+            _started_dbs.add(DB_NAME)
+    return STARTUP_REPORT
+
+@app.before_request
+def _ensure_startup():
+    if DB_NAME not in _started_dbs:
+        startup()
+
+@app.route('/api/startup', methods=['GET'])
+def startup_report():
+    return jsonify(STARTUP_REPORT)
+
+def start_background_workers():
+    """Inicia os jobs de segundo plano. Chamado no __main__; em WSGI, chame após importar o app."""
+    startup()
+    started = time.perf_counter()
+    if _get_env_bool("RETENTION_ENABLED", True):
+        retention_worker.start()
+    sheets_outbox.start()
+    sheets_mirror.start()
+    booking_jobs.start()
+    availability.prefetch()
+    whatsapp_outbox.start()
+    zapi_inbox.start()
+    appointment_reminders.start()
+    campaign_runner.start()
+    phone_maintenance.start()
+    session_stats.start()
+    if _get_env_bool("KNOWLEDGE_SYNC_ENABLED", True):
+        knowledge_sync.start()
+    exam_index.start()
+    if _get_env_bool("MORNING_REPORT_ENABLED", True):
+        morning_report.start()
+    _record_startup("start_workers", started)
+
+_record_startup("import", _IMPORT_STARTED)
+
 if __name__ == "__main__":
+    debug = _get_env_bool("FLASK_DEBUG", True)
+    # Com o reloader, este script roda duas vezes: no processo que vigia os
+    # arquivos e no filho que atende (WERKZEUG_RUN_MAIN=true). Os workers só
+    # sobem no filho, senão filas e jobs rodariam em dobro.
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_workers()
+        logger.info("Startup (ms): " + ", ".join(f"{k}={v}" for k, v in STARTUP_REPORT.items()))
     port = int(os.environ.get("PORT", 5000))
     print(f"Iniciando servidor Vizô Dashboard em http://localhost:{port}")
-    app.run(host='0.0.0.0', port=port, debug=True)
+    app.run(host='0.0.0.0', port=port, debug=debug)
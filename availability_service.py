@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import bisect
+import sqlite3
+import datetime
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Disponibilidade da agenda por médico. Os intervalos ocupados vêm do
+# free/busy do Google Calendar (uma chamada para até 50 agendas) somados aos
+# agendamentos locais, e ficam em memória em um BusyIntervals por médico.
+# Os horários livres são calculados a partir do horário de funcionamento do
+# base_conhecimento.json, em passos de SLOT_MINUTES.
+
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "30"))
+CACHE_TTL = float(os.getenv("AVAILABILITY_TTL", "300"))
+FREEBUSY_BATCH = 50
+MAX_DAYS = 31
+# Macapá/Fortaleza: UTC-3, sem horário de verão
+CLINIC_TZ = datetime.timezone(datetime.timedelta(hours=-3))
+
+DEFAULT_HOURS = {
+    0: (datetime.time(7, 0), datetime.time(18, 0)),
+    1: (datetime.time(7, 0), datetime.time(18, 0)),
+    2: (datetime.time(7, 0), datetime.time(18, 0)),
+    3: (datetime.time(7, 0), datetime.time(18, 0)),
+    4: (datetime.time(7, 0), datetime.time(18, 0)),
+}
+
+_TIME_RE = re.compile(r"(\d{1,2})\s*(?:h|:)\s*(\d{2})?")
+
+
+def _parse_window(text):
+    """'07h00 às 18h00' -> (time(7), time(18)); 'Fechado'/vazio -> None."""
+    found = _TIME_RE.findall(str(text or ""))
+    if len(found) < 2:
+        return None
+    (h1, m1), (h2, m2) = found[0], found[1]
+    return datetime.time(int(h1), int(m1 or 0)), datetime.time(int(h2), int(m2 or 0))
+
+
+def clinic_hours(base_knowledge):
+    """Janela de atendimento por dia da semana (0 = segunda) a partir do base_conhecimento.json."""
+    horarios = ((base_knowledge or {}).get("contato") or {}).get("horario_funcionamento") or {}
+    if not horarios:
+        return dict(DEFAULT_HOURS)
+    hours = {}
+    weekday = _parse_window(horarios.get("segunda_a_sexta"))
+    if weekday:
+        hours.update({d: weekday for d in range(5)})
+    for day, key in ((5, "sabado"), (6, "domingo")):
+        window = _parse_window(horarios.get(key))
+        if window:
+            hours[day] = window
+    return hours
+
+
+def doctor_key(name):
+    return " ".join(str(name or "").lower().split())
+
+
+def doctor_calendars(base_knowledge):
+    """Médico (chave normalizada) -> id da agenda no Google, ou None se não houver agenda própria.
+
+    A agenda vem do campo 'calendar_id' (ou 'email') de cada item do
+    corpo_clinico; DOCTOR_CALENDARS (JSON nome -> agenda) tem precedência.
+    """
+    calendars = {}
+    for m in (base_knowledge or {}).get("corpo_clinico") or []:
+        if m.get("nome"):
+            calendars[doctor_key(m["nome"])] = m.get("calendar_id") or m.get("email")
+    try:
+        overrides = json.loads(os.getenv("DOCTOR_CALENDARS") or "{}")
+    except ValueError:
+        logger.error("DOCTOR_CALENDARS não é um JSON válido; ignorando")
+        overrides = {}
+    for name, calendar_id in overrides.items():
+        calendars[doctor_key(name)] = calendar_id
+    return calendars
+
+
+def to_local(value):
+    """RFC 3339 (ex.: '2026-03-02T13:00:00Z') -> datetime ingênuo no horário da clínica."""
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo:
+        dt = dt.astimezone(CLINIC_TZ).replace(tzinfo=None)
+    return dt
+
+
+class BusyIntervals:
+    """Intervalos ocupados de um médico, ordenados pelo início.
+
+    Guarda junto o maior fim visto até cada posição, então "existe conflito
+    com [início, fim)?" é uma busca binária. Inserir é O(n), o que é
+    irrelevante para as dezenas de consultas por semana de um médico.
+    """
+
+    __slots__ = ("_starts", "_ends", "_max_end")
+
+    def __init__(self, intervals=()):
+        pairs = sorted((s, e) for s, e in intervals if e > s)
+        self._starts = [s for s, _ in pairs]
+        self._ends = [e for _, e in pairs]
+        self._max_end = []
+        self._rebuild_from(0)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _rebuild_from(self, i):
+        del self._max_end[i:]
+        current = self._max_end[i - 1] if i else None
+        for end in self._ends[i:]:
+            current = end if current is None or end > current else current
+            self._max_end.append(current)
+
+    def add(self, start, end):
+        if end <= start:
+            return
+        i = bisect.bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._rebuild_from(i)
+
+    def overlaps(self, start, end):
+        i = bisect.bisect_left(self._starts, end)
+        return i > 0 and self._max_end[i - 1] > start
+
+
+def compute_slots(busy, day_from, days, hours, now=None, slot_minutes=SLOT_MINUTES):
+    """Horários livres ({'AAAA-MM-DD': ['HH:MM', ...]}) de `days` dias a partir de `day_from`."""
+    now = now or datetime.datetime.now(CLINIC_TZ).replace(tzinfo=None)
+    step = datetime.timedelta(minutes=slot_minutes)
+    result = {}
+    for offset in range(days):
+        day = day_from + datetime.timedelta(days=offset)
+        window = hours.get(day.weekday())
+        if not window:
+            continue
+        start = datetime.datetime.combine(day, window[0])
+        close = datetime.datetime.combine(day, window[1])
+        free = []
+        while start + step <= close:
+            if start >= now and not busy.overlaps(start, start + step):
+                free.append(start.strftime("%H:%M"))
+            start += step
+        if free:
+            result[day.isoformat()] = free
+    return result
+
+
+class AvailabilityCache:
+    """Intervalos ocupados por médico, com recarga em lote do free/busy.
+
+    O cache cobre uma ou mais janelas de dias, que são somadas (uma recarga
+    só troca os dados dos dias dela). Nenhuma requisição espera o Google:
+    dias fora do cache e janelas com mais de CACHE_TTL são servidos com o que
+    houver em memória e recarregados em segundo plano.
+    """
+
+    def __init__(self, db_path_getter, google_service_getter, base_knowledge_getter):
+        self._db_path_getter = db_path_getter
+        self._google_service_getter = google_service_getter
+        self._base_knowledge_getter = base_knowledge_getter
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._busy = {}
+        # [(primeiro dia, último dia, carregado em)], ordenadas e sem sobreposição
+        self._windows = []
+
+    def calendars(self):
+        return doctor_calendars(self._base_knowledge_getter())
+
+    def hours(self):
+        return clinic_hours(self._base_knowledge_getter())
+
+    def refresh(self, day_from, day_to):
+        """Recarrega os intervalos ocupados de todos os médicos entre day_from e day_to (inclusive)."""
+        calendars = self.calendars()
+        start = datetime.datetime.combine(day_from, datetime.time.min)
+        end = datetime.datetime.combine(day_to + datetime.timedelta(days=1), datetime.time.min)
+        intervals = {key: [] for key in calendars}
+
+        service = self._google_service_getter()
+        ids = {cid: key for key, cid in calendars.items() if cid}
+        if service and ids:
+            cal_ids = list(ids)
+            for i in range(0, len(cal_ids), FREEBUSY_BATCH):
+                chunk = cal_ids[i:i + FREEBUSY_BATCH]
+                busy = service.get_busy_intervals(
+                    chunk,
+                    start.replace(tzinfo=CLINIC_TZ).isoformat(),
+                    end.replace(tzinfo=CLINIC_TZ).isoformat()
+                )
+                for cal_id, periods in busy.items():
+                    intervals[ids[cal_id]].extend((to_local(s), to_local(e)) for s, e in periods)
+
+        step = datetime.timedelta(minutes=SLOT_MINUTES)
+        with sqlite3.connect(self._db_path_getter()) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT doctor, start_at FROM appointments
+                WHERE start_at >= ? AND start_at < ? AND status = 'confirmed'
+            ''', (start.strftime("%Y-%m-%d %H:%M"), end.strftime("%Y-%m-%d %H:%M")))
+            for doctor, start_at in cursor.fetchall():
+                begin = datetime.datetime.strptime(start_at, "%Y-%m-%d %H:%M")
+                intervals.setdefault(doctor_key(doctor), []).append((begin, begin + step))
+
+        with self._lock:
+            # Fora da janela recarregada, mantém o que já estava no cache
+            busy = {}
+            for key in set(self._busy) | set(intervals):
+                current = self._busy.get(key) or BusyIntervals()
+                kept = [(s, e) for s, e in zip(current._starts, current._ends) if s < start or s >= end]
+                busy[key] = BusyIntervals(kept + intervals.get(key, []))
+            self._busy = busy
+            windows = []
+            for w_from, w_to, loaded_at in self._windows:
+                if w_from < day_from:
+                    windows.append((w_from, min(w_to, day_from - datetime.timedelta(days=1)), loaded_at))
+                if w_to > day_to:
+                    windows.append((max(w_from, day_to + datetime.timedelta(days=1)), w_to, loaded_at))
+            windows.append((day_from, day_to, time.time()))
+            self._windows = sorted(windows)
+        logger.info(f"Disponibilidade recarregada: {len(busy)} médico(s), {day_from} a {day_to}")
+
+    def _refresh_async(self, day_from, day_to):
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh(day_from, day_to)
+            except Exception as e:
+                logger.error(f"Erro ao recarregar disponibilidade: {e}")
+            finally:
+                self._refreshing.release()
+
+        threading.Thread(target=run, name="availability-refresh", daemon=True).start()
+
+    def _ensure(self, day_from, day_to):
+        """Agenda a recarga do que falta ou venceu em [day_from, day_to]; nunca bloqueia."""
+        now = time.time()
+        with self._lock:
+            windows = list(self._windows)
+        missing, stale = [], []
+        day = day_from
+        for w_from, w_to, loaded_at in windows:
+            if w_to < day or w_from > day_to:
+                continue
+            if w_from > day:
+                missing.append((day, w_from - datetime.timedelta(days=1)))
+            if now - loaded_at > CACHE_TTL:
+                stale.append((max(w_from, day_from), min(w_to, day_to)))
+            day = w_to + datetime.timedelta(days=1)
+        if day <= day_to:
+            missing.append((day, day_to))
+        if missing:
+            first, last = missing[0][0], missing[-1][1]
+            # Pelo menos duas semanas, para as próximas consultas caírem no cache
+            self._refresh_async(first, max(last, first + datetime.timedelta(days=13)))
+        elif stale:
+            self._refresh_async(stale[0][0], stale[-1][1])
+
+    def prefetch(self, days=14):
+        """Carrega em segundo plano as próximas `days` dias (chamar ao subir o servidor)."""
+        today = datetime.datetime.now(CLINIC_TZ).date()
+        self._refresh_async(today, today + datetime.timedelta(days=days - 1))
+
+    def busy_for(self, doctor):
+        with self._lock:
+            return self._busy.get(doctor_key(doctor)) or BusyIntervals()
+
+    def slots(self, doctor, day_from, days, now=None):
+        day_to = day_from + datetime.timedelta(days=days - 1)
+        self._ensure(day_from, day_to)
+        return compute_slots(self.busy_for(doctor), day_from, days, self.hours(), now)
+
+    def is_free(self, doctor, start, minutes=SLOT_MINUTES, load=True):
+        """Horário livre segundo o cache. Com load=False nunca consulta o Google (resposta só da memória)."""
+        if load:
+            self._ensure(start.date(), start.date())
+        return not self.busy_for(doctor).overlaps(start, start + datetime.timedelta(minutes=minutes))
+
+    def add_busy(self, doctor, start, minutes=SLOT_MINUTES):
+        """Atualiza o cache na hora quando o próprio app agenda algo."""
+        key = doctor_key(doctor)
+        with self._lock:
+            # Copia antes de alterar: leitores seguem usando a versão anterior sem lock
+            current = self._busy.get(key) or BusyIntervals()
+            updated = BusyIntervals(zip(current._starts, current._ends))
+            updated.add(start, start + datetime.timedelta(minutes=minutes))
+            self._busy[key] = updated
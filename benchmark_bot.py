@@ -0,0 +1,114 @@
+import sys
+import time
+import datetime
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import conversation_service
+
+# Benchmark do fluxo do Vizô: reproduz milhares de conversas roteirizadas
+# (agendamento, exames, especialistas, atendente) intercaladas entre si, como
+# se estivessem acontecendo ao mesmo tempo, e mede transições por segundo e
+# memória por sessão. Roda nos dois motores:
+#   terminal  -> VizoBot(headless=True), uma instância por conversa
+#   whatsapp  -> conversation_service.step() sobre um SessionState por telefone
+#
+# Uso: python benchmark_bot.py [conversas] [threads]
+
+SCRIPTS = {
+    "agendamento": ["Ana Lima 96 99999-0000", "1", "Ana Lima", "96 99999-0000", "2"],
+    "exames": ["Bia Souza 96 98888-0000", "2", "1"],
+    "especialistas": ["Caio Reis 96 97777-0000", "3", "1", "Caio Reis", "96 97777-0000", "8"],
+    "atendente": ["Duda Melo 96 96666-0000", "4", "cancelar"],
+}
+
+# Meio-dia: o atendimento humano está aberto e o roteiro do atendente é sempre o mesmo
+_NOON = datetime.datetime(2026, 1, 5, 12, 0)
+
+
+def _terminal_factory():
+    from vizo_bot import VizoBot
+    bookings = []
+
+    def new_session(i):
+        bot = VizoBot(headless=True, on_booking=lambda data, doctor: bookings.append(doctor),
+                      on_handover=lambda data: {"ticket_id": i, "position": 1}, clock=lambda: _NOON)
+        bot.start(source="benchmark")
+        bot.take_events()
+        return bot
+
+    def feed(bot, text):
+        events, _ = bot.handle(text)
+        return len(events)
+
+    return new_session, feed, ["0"]
+
+
+def _whatsapp_factory():
+    engine = conversation_service.ConversationEngine(clock=lambda: _NOON.timestamp())
+
+    def new_session(i):
+        session = conversation_service.SessionState(f"55969{i:08d}")
+        conversation_service.step(session, "Oi", engine)
+        return session
+
+    def feed(session, text):
+        return len(conversation_service.step(session, text, engine))
+
+    return new_session, feed, ["0"]
+
+
+ENGINES = {"terminal": _terminal_factory, "whatsapp": _whatsapp_factory}
+
+
+def run_benchmark(engine="terminal", conversations=2000, threads=4):
+    """Reproduz `conversations` conversas e devolve as métricas num dict."""
+    new_session, feed, closing = ENGINES[engine]()
+    names = list(SCRIPTS)
+    scripts = [SCRIPTS[names[i % len(names)]] + closing for i in range(conversations)]
+
+    # Memória: sessões vivas logo depois da saudação (o que fica guardado por conversa)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = [new_session(i) for i in range(conversations)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    session_bytes = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    # Cada thread intercala as suas conversas: passo 1 de todas, depois passo 2...
+    counts = [0] * threads
+    replies = [0] * threads
+
+    def replay(shard):
+        mine = range(shard, conversations, threads)
+        for step_no in range(max(len(s) for s in scripts)):
+            for i in mine:
+                if step_no < len(scripts[i]):
+                    replies[shard] += feed(sessions[i], scripts[i][step_no])
+                    counts[shard] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(replay, range(threads)))
+    elapsed = time.perf_counter() - started
+    transitions = sum(counts)
+    return {
+        "engine": engine,
+        "conversations": conversations,
+        "threads": threads,
+        "transitions": transitions,
+        "replies": sum(replies),
+        "seconds": round(elapsed, 3),
+        "transitions_per_second": round(transitions / elapsed) if elapsed else None,
+        "bytes_per_session": round(session_bytes / conversations) if conversations else 0,
+    }
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    for name in ENGINES:
+        result = run_benchmark(name, total, workers)
+        print(f"[{name}] {result['conversations']} conversas, {result['transitions']} transições em "
+              f"{result['seconds']}s -> {result['transitions_per_second']} transições/s, "
+              f"~{result['bytes_per_session']} bytes por sessão")
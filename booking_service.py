@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Livro de reservas de horários. Cada (médico, horário) só pode ter uma linha
+# em slot_reservations: a reserva é decidida pelo UNIQUE do SQLite, no commit
+# local, e não mais depois da chamada ao Google. Uma reserva começa como
+# 'held' (segura o horário por HOLD_SECONDS enquanto o paciente preenche o
+# formulário) e vira 'confirmed' no agendamento.
+#
+# O que depende de APIs externas (evento no Calendar, lembrete no WhatsApp)
+# vai para booking_jobs, com uma chave de idempotência por tarefa, e é
+# executado pelo BookingJobWorker.
+
+HOLD_SECONDS = int(os.getenv("SLOT_HOLD_SECONDS", "300"))
+MAX_ATTEMPTS = int(os.getenv("BOOKING_JOB_MAX_ATTEMPTS", "8"))
+BASE_BACKOFF = float(os.getenv("BOOKING_JOB_BACKOFF", "5"))
+MAX_BACKOFF = 1800
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+def init_booking_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS slot_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doctor_key TEXT NOT NULL,
+            slot_start TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'held',
+            hold_token TEXT UNIQUE,
+            expires_at REAL,
+            appointment_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (doctor_key, slot_start)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS booking_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            payload_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            done_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_booking_jobs_due ON booking_jobs (status, next_attempt_at, id)")
+
+
+def _slot_s(start):
+    return start.strftime("%Y-%m-%d %H:%M")
+
+
+def _drop_expired(cursor, doctor_key, slot_s, now):
+    cursor.execute('''
+        DELETE FROM slot_reservations
+        WHERE doctor_key = ? AND slot_start = ? AND status = 'held' AND expires_at < ?
+    ''', (doctor_key, slot_s, now))
+
+
+def hold_slot(cursor, doctor_key, start, seconds=HOLD_SECONDS):
+    """Segura o horário por alguns minutos. Retorna o token; levanta SlotUnavailable se já estiver tomado."""
+    now = time.time()
+    slot_s = _slot_s(start)
+    _drop_expired(cursor, doctor_key, slot_s, now)
+    token = uuid.uuid4().hex
+    try:
+        cursor.execute('''
+            INSERT INTO slot_reservations (doctor_key, slot_start, status, hold_token, expires_at)
+            VALUES (?, ?, 'held', ?, ?)
+        ''', (doctor_key, slot_s, token, now + seconds))
+    except sqlite3.IntegrityError:
+        raise SlotUnavailable(slot_s)
+    return token
+
+
+def release_hold(cursor, token):
+    cursor.execute("DELETE FROM slot_reservations WHERE hold_token = ? AND status = 'held'", (token,))
+    return cursor.rowcount > 0
+
+
+def reserve_slot(cursor, doctor_key, start, hold_token=None):
+    """Confirma o horário (usando a reserva `hold_token`, se houver). Retorna o id da reserva.
+
+    Levanta SlotUnavailable se o horário for de outra pessoa ou se a reserva expirou e
+    alguém pegou o horário no meio tempo.
+    """
+    now = time.time()
+    slot_s = _slot_s(start)
+    if hold_token:
+        cursor.execute('''
+            UPDATE slot_reservations SET status = 'confirmed', expires_at = NULL
+            WHERE hold_token = ? AND doctor_key = ? AND slot_start = ? AND status = 'held'
+        ''', (hold_token, doctor_key, slot_s))
+        if cursor.rowcount:
+            cursor.execute("SELECT id FROM slot_reservations WHERE hold_token = ?", (hold_token,))
+            return cursor.fetchone()[0]
+    _drop_expired(cursor, doctor_key, slot_s, now)
+    try:
+        cursor.execute('''
+            INSERT INTO slot_reservations (doctor_key, slot_start, status)
+            VALUES (?, ?, 'confirmed')
+        ''', (doctor_key, slot_s))
+    except sqlite3.IntegrityError:
+        raise SlotUnavailable(slot_s)
+    return cursor.lastrowid
+
+
+def attach_appointment(cursor, reservation_id, appointment_id):
+    cursor.execute("UPDATE slot_reservations SET appointment_id = ? WHERE id = ?", (appointment_id, reservation_id))
+
+
+def taken_slots(cursor, doctor_key, slot_from, slot_to):
+    """Horários ('AAAA-MM-DD HH:MM') com reserva ativa no intervalo [slot_from, slot_to)."""
+    cursor.execute('''
+        SELECT slot_start FROM slot_reservations
+        WHERE doctor_key = ? AND slot_start >= ? AND slot_start < ?
+          AND (status = 'confirmed' OR expires_at >= ?)
+    ''', (doctor_key, slot_from, slot_to, time.time()))
+    return {r[0] for r in cursor.fetchall()}
+
+
+def enqueue_job(cursor, kind, payload, idempotency_key=None):
+    """Agenda uma tarefa externa. Uma chave repetida é ignorada (a tarefa já existe)."""
+    key = idempotency_key or uuid.uuid4().hex
+    cursor.execute('''
+        INSERT OR IGNORE INTO booking_jobs (kind, idempotency_key, payload_json)
+        VALUES (?, ?, ?)
+    ''', (kind, key, json.dumps(payload, ensure_ascii=False)))
+    return key
+
+
+def _backoff(attempts):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** max(0, attempts - 1)))
+    return delay * (0.5 + random.random() / 2)
+
+
+class BookingJobWorker:
+    """Executa booking_jobs em segundo plano.
+
+    `handlers` mapeia kind -> função(payload, idempotency_key). A função deve
+    levantar exceção para pedir nova tentativa e pode ser chamada mais de uma
+    vez com a mesma chave, então precisa ser idempotente.
+    """
+
+    def __init__(self, db_path_getter, handlers):
+        self._db_path_getter = db_path_getter
+        self.handlers = handlers
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="booking-jobs", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.run_once()
+            except Exception as e:
+                logger.error(f"Erro no worker de agendamentos: {e}")
+                delay = 30
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def run_once(self, limit=50):
+        """Executa as tarefas vencidas. Retorna quantos segundos esperar até a próxima rodada."""
+        now = time.time()
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, kind, idempotency_key, payload_json, attempts
+                FROM booking_jobs
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (now, limit))
+            due = cursor.fetchall()
+            for job_id, kind, key, payload_json, attempts in due:
+                handler = self.handlers.get(kind)
+                try:
+                    if handler is None:
+                        raise RuntimeError(f"Tipo de tarefa desconhecido: {kind}")
+                    handler(json.loads(payload_json), key)
+                except Exception as e:
+                    attempts += 1
+                    final = attempts >= MAX_ATTEMPTS
+                    logger.warning(f"Tarefa {kind} #{job_id} falhou ({e}); {'desistindo' if final else 'nova tentativa agendada'}")
+                    cursor.execute('''
+                        UPDATE booking_jobs
+                        SET attempts = ?, next_attempt_at = ?, last_error = ?, status = ?
+                        WHERE id = ?
+                    ''', (attempts, time.time() + _backoff(attempts), str(e)[:500],
+                          'failed' if final else 'pending', job_id))
+                else:
+                    cursor.execute(
+                        "UPDATE booking_jobs SET status = 'done', done_at = ?, last_error = NULL WHERE id = ?",
+                        (time.time(), job_id)
+                    )
+                conn.commit()
+            if len(due) == limit:
+                return 0
+            cursor.execute("SELECT MIN(next_attempt_at) FROM booking_jobs WHERE status = 'pending'")
+            next_at = cursor.fetchone()[0]
+        return max(1.0, next_at - time.time()) if next_at else 300
@@ -0,0 +1,92 @@
+import sqlite3
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Cache de respostas JSON invalidado pela versão de escrita do SQLite.
+
+    Uma conexão dedicada e de vida longa lê `PRAGMA data_version`, que muda
+    sempre que outra conexão (desta ou de outra instância do servidor) faz
+    commit no banco. Somado a um contador local (`invalidate()`), isso dá
+    uma versão barata de consultar: se não mudou, a resposta guardada
+    continua válida.
+    """
+
+    def __init__(self, db_path_getter, max_entries=256, max_age=60):
+        self._db_path_getter = db_path_getter
+        self._db_path = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._local_version = 0
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def _watcher(self):
+        path = self._db_path_getter()
+        if self._conn is None or path != self._db_path:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._db_path = path
+            self._entries.clear()
+        return self._conn
+
+    def version(self):
+        with self._lock:
+            try:
+                data_version = self._watcher().execute("PRAGMA data_version").fetchone()[0]
+            except Exception as e:
+                logger.error(f"Falha ao ler data_version: {e}")
+                self._conn = None
+                return None
+            return (data_version, self._local_version)
+
+    def invalidate(self):
+        """Invalida tudo (para mudanças de estado que não passam pelo SQLite)."""
+        with self._lock:
+            self._local_version += 1
+            self._entries.clear()
+
+    def get(self, key, version):
+        if version is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_version, stored_at, body, etag = entry
+            if entry_version != version or (time.monotonic() - stored_at) > self.max_age:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body, etag
+
+    def put(self, key, version, body):
+        etag = hashlib.sha1(body).hexdigest()
+        if version is None:
+            return etag
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+
+import whatsapp_service
+
+logger = logging.getLogger(__name__)
+
+# Disparo de campanhas pelo WhatsApp para leads que aceitaram receber
+# (patient_leads.consent = 1). Uma campanha é um retrato dos leads existentes
+# na criação (max_lead_id) filtrados por origem, interesse e data; o
+# CampaignRunner percorre esses leads por id, em lotes, e grava cada lote
+# (destinatários + mensagens na whatsapp_outbox + checkpoint) numa única
+# transação. Se o processo cair, a campanha continua do checkpoint.
+#
+# As mensagens entram na fila com prioridade baixa e o runner só coloca mais
+# um lote quando a fila em massa baixa de MAX_BULK_BACKLOG, então uma
+# campanha de 20 mil contatos nunca enche a fila na frente das conversas.
+
+BATCH_SIZE = int(os.getenv("CAMPAIGN_BATCH_SIZE", "50"))
+MAX_BULK_BACKLOG = int(os.getenv("CAMPAIGN_MAX_BACKLOG", "100"))
+CHECK_INTERVAL = float(os.getenv("CAMPAIGN_CHECK_INTERVAL", "10"))
+OPT_OUT_WORDS = {"sair", "parar", "pare", "stop", "cancelar campanha", "descadastrar"}
+
+CAMPAIGN_FILTERS = ("source", "interest", "from", "to")
+
+
+def init_campaign_tables(cursor):
+    cursor.execute("PRAGMA table_info(patient_leads)")
+    if "consent" not in [c[1] for c in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE patient_leads ADD COLUMN consent INTEGER NOT NULL DEFAULT 0")
+    # Índice parcial: só os leads com consentimento, na ordem em que a campanha os percorre
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_leads_consent ON patient_leads (id) WHERE consent = 1")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaign_optouts (
+            phone TEXT PRIMARY KEY,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            message TEXT NOT NULL,
+            filters_json TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'running',
+            max_lead_id INTEGER NOT NULL DEFAULT 0,
+            checkpoint_lead_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            campaign_id INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            lead_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            outbox_id INTEGER,
+            created_at REAL,
+            PRIMARY KEY (campaign_id, phone)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("PRAGMA table_info(campaign_recipients)")
+    if "created_at" not in [c[1] for c in cursor.fetchall()]:
+        # Data para a retenção LGPD; os destinatários antigos herdam a da campanha
+        cursor.execute("ALTER TABLE campaign_recipients ADD COLUMN created_at REAL")
+        cursor.execute('''
+            UPDATE campaign_recipients SET created_at = (
+                SELECT CAST(strftime('%s', c.created_at) AS REAL) FROM campaigns c WHERE c.id = campaign_id
+            )
+        ''')
+
+
+def _where(filters):
+    # Mesmas expressões de lead_service, para aproveitar os mesmos índices
+    clauses = ["consent = 1", "merged_into IS NULL"]
+    params = []
+    if "source" in filters:
+        clauses.append("LOWER(COALESCE(source, '')) = ?")
+        params.append(filters["source"].lower())
+    if "interest" in filters:
+        clauses.append("LOWER(COALESCE(interest, '')) LIKE ?")
+        params.append("%" + filters["interest"].lower() + "%")
+    if "from" in filters:
+        clauses.append("created_at >= ?")
+        params.append(filters["from"])
+    if "to" in filters:
+        clauses.append("created_at < date(?, '+1 day')")
+        params.append(filters["to"])
+    return " AND ".join(clauses), params
+
+
+def create_campaign(cursor, name, message, filters):
+    """Cria a campanha (sem commit) com o retrato atual dos leads. Retorna o id.
+
+    `filters` usa os valores já validados por lead_service.parse_filters
+    (datas como datetime.date).
+    """
+    stored = {k: (v.isoformat() if hasattr(v, "isoformat") else v) for k, v in filters.items() if k in CAMPAIGN_FILTERS}
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM patient_leads")
+    max_lead_id = cursor.fetchone()[0]
+    where, params = _where(stored)
+    cursor.execute(f"SELECT COUNT(*) FROM patient_leads WHERE {where} AND id <= ?", params + [max_lead_id])
+    total = cursor.fetchone()[0]
+    cursor.execute('''
+        INSERT INTO campaigns (name, message, filters_json, max_lead_id, total)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (name, message, json.dumps(stored, ensure_ascii=False), max_lead_id, total))
+    return cursor.lastrowid
+
+
+def render_message(template, name):
+    first_name = (name or "").strip().split(" ")[0]
+    return template.replace("{nome}", first_name)
+
+
+def is_opt_out(text):
+    return (text or "").strip().lower() in OPT_OUT_WORDS
+
+
+def record_opt_out(cursor, phone):
+    """Registra o opt-out e tira da fila os envios em massa ainda não mandados para o telefone."""
+    phone = whatsapp_service.normalize_phone(phone)
+    if not phone:
+        return
+    cursor.execute("INSERT OR IGNORE INTO campaign_optouts (phone) VALUES (?)", (phone,))
+    cursor.execute('''
+        UPDATE whatsapp_outbox SET status = 'cancelled', updated_at = ?
+        WHERE status = 'queued' AND priority >= ? AND phone = ?
+    ''', (time.time(), whatsapp_service.PRIORITY_BULK, phone))
+
+
+def advance(cursor, campaign_id, limit=None):
+    """Enfileira o próximo lote da campanha (sem commit). Retorna quantos leads foram lidos.
+
+    Retorna 0 e marca a campanha como 'done' quando não há mais leads.
+    """
+    cursor.execute(
+        "SELECT message, filters_json, max_lead_id, checkpoint_lead_id, status FROM campaigns WHERE id = ?",
+        (campaign_id,)
+    )
+    row = cursor.fetchone()
+    if not row or row[4] != 'running':
+        return 0
+    message, filters_json, max_lead_id, checkpoint, _ = row
+    limit = limit or BATCH_SIZE
+    where, params = _where(json.loads(filters_json))
+    cursor.execute(f'''
+        SELECT id, name, phone FROM patient_leads
+        WHERE {where} AND id > ? AND id <= ?
+        ORDER BY id ASC
+        LIMIT ?
+    ''', params + [checkpoint, max_lead_id, limit])
+    leads = cursor.fetchall()
+    if not leads:
+        cursor.execute(
+            "UPDATE campaigns SET status = 'done', finished_at = ? WHERE id = ?",
+            (time.time(), campaign_id)
+        )
+        return 0
+    for lead_id, name, raw_phone in leads:
+        phone = whatsapp_service.normalize_phone(raw_phone)
+        status, outbox_id = 'queued', None
+        if not phone:
+            status = 'invalid'
+        else:
+            cursor.execute("SELECT 1 FROM campaign_optouts WHERE phone = ?", (phone,))
+            if cursor.fetchone():
+                status = 'opted_out'
+        if status == 'queued':
+            cursor.execute("SELECT 1 FROM campaign_recipients WHERE campaign_id = ? AND phone = ?", (campaign_id, phone))
+            if cursor.fetchone():
+                # Mesmo telefone em outro lead: uma mensagem por pessoa
+                continue
+            outbox_id = whatsapp_service.enqueue_message(
+                cursor, phone, render_message(message, name), f"campaign-{campaign_id}-{phone}",
+                priority=whatsapp_service.PRIORITY_BULK
+            )
+        cursor.execute('''
+            INSERT OR IGNORE INTO campaign_recipients (campaign_id, phone, lead_id, status, outbox_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (campaign_id, phone or f"lead:{lead_id}", lead_id, status, outbox_id, time.time()))
+    cursor.execute("UPDATE campaigns SET checkpoint_lead_id = ? WHERE id = ?", (leads[-1][0], campaign_id))
+    return len(leads)
+
+
+def set_status(cursor, campaign_id, status):
+    """Pausa, retoma ou cancela. Cancelar tira da fila o que ainda não foi enviado."""
+    allowed_from = {"paused": ("running",), "running": ("paused",), "cancelled": ("running", "paused")}[status]
+    cursor.execute(
+        f"UPDATE campaigns SET status = ? WHERE id = ? AND status IN ({', '.join('?' for _ in allowed_from)})",
+        (status, campaign_id, *allowed_from)
+    )
+    if not cursor.rowcount:
+        return False
+    if status == "cancelled":
+        cursor.execute('''
+            UPDATE whatsapp_outbox SET status = 'cancelled', updated_at = ?
+            WHERE status = 'queued' AND id IN (
+                SELECT outbox_id FROM campaign_recipients WHERE campaign_id = ? AND outbox_id IS NOT NULL
+            )
+        ''', (time.time(), campaign_id))
+    return True
+
+
+def progress(cursor, campaign_id):
+    cursor.execute('''
+        SELECT id, name, status, total, checkpoint_lead_id, max_lead_id, created_at, finished_at
+        FROM campaigns WHERE id = ?
+    ''', (campaign_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute('''
+        SELECT COALESCE(o.status, r.status), COUNT(*)
+        FROM campaign_recipients r
+        LEFT JOIN whatsapp_outbox o ON o.id = r.outbox_id
+        WHERE r.campaign_id = ?
+        GROUP BY 1
+    ''', (campaign_id,))
+    counts = dict(cursor.fetchall())
+    processed = sum(counts.values())
+    pending = counts.get("queued", 0) + counts.get("sending", 0)
+    if row[2] == "done" and not pending:
+        percent = 100.0
+    else:
+        # Telefones repetidos não viram destinatário, então total é um teto
+        percent = round(min(100.0, 100.0 * (processed - pending) / row[3]), 1) if row[3] else 0.0
+    return {
+        "id": row[0],
+        "name": row[1],
+        "status": row[2],
+        "total": row[3],
+        "processed": processed,
+        "recipients": counts,
+        "progress": percent,
+        "created_at": row[6],
+        "finished_at": row[7],
+    }
+
+
+def list_campaigns(cursor, limit=50):
+    cursor.execute("SELECT id FROM campaigns ORDER BY id DESC LIMIT ?", (limit,))
+    return [progress(cursor, r[0]) for r in cursor.fetchall()]
+
+
+class CampaignRunner:
+    """Alimenta a fila do WhatsApp com as campanhas em andamento, no ritmo do envio.
+
+    `on_queued()` é chamado depois de cada lote gravado (para acordar o worker de envio).
+    """
+
+    def __init__(self, db_path_getter, on_queued=lambda: None):
+        self._db_path_getter = db_path_getter
+        self._on_queued = on_queued
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="campaign-runner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def run_once(self):
+        """Coloca lotes na fila enquanto houver espaço. Retorna quantos segundos esperar."""
+        queued = 0
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM campaigns WHERE status = 'running' ORDER BY id ASC")
+            for (campaign_id,) in cursor.fetchall():
+                while whatsapp_service.queued_bulk(cursor) < MAX_BULK_BACKLOG:
+                    read = advance(cursor, campaign_id)
+                    conn.commit()
+                    if not read:
+                        logger.info(f"Campanha #{campaign_id} terminou de ser enfileirada")
+                        break
+                    queued += read
+                    if self._stop.is_set():
+                        break
+        if queued:
+            self._on_queued()
+        return CHECK_INTERVAL
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.run_once()
+            except Exception as e:
+                logger.error(f"Erro no disparo de campanhas: {e}")
+                delay = 60
+            self._wake.wait(delay)
+            self._wake.clear()
@@ -0,0 +1,457 @@
+import os
+import time
+import datetime
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+from availability_service import CLINIC_TZ
+
+logger = logging.getLogger(__name__)
+
+# Fluxo do Vizô (o mesmo do vizo_bot.py) como tabela de transições, para
+# atender muitas conversas de WhatsApp ao mesmo tempo. Cada estado tem uma
+# função (sessão, texto, engine) -> lista de respostas, que também troca o
+# estado da sessão. Nada aqui imprime, fala ou chama API: efeitos colaterais
+# (registrar lead, chamar atendente, IA, métricas) são funções injetadas no
+# ConversationEngine.
+#
+# O estado de cada telefone é um SessionState (com __slots__, ~100 bytes)
+# guardado em whatsapp_sessions e num cache LRU em memória. Cada gravação
+# confere a versão da linha (controle otimista): se dois workers processarem
+# mensagens do mesmo telefone ao mesmo tempo, o segundo falha e o evento é
+# reprocessado com o estado novo.
+
+SESSION_CACHE_SIZE = int(os.getenv("WHATSAPP_SESSION_CACHE", "5000"))
+# Conversa parada há mais que isso recomeça do início
+SESSION_TTL = float(os.getenv("WHATSAPP_SESSION_TTL", str(24 * 3600)))
+
+ESPECIALISTAS = [
+    "Dr. Lucas Rezende", "Dra. Ana Catarina", "Dr. Tarcísio Guerra",
+    "Dr. Augusto Almeida", "Dra. Nabila Demachki", "Dra. Roseni Lopes",
+    "Dra. Michele Gonçalves"
+]
+ANY_DOCTOR_OPTION = 8
+# Respostas que contam como aceite explícito para receber campanhas
+CONSENT_WORDS = {"sim", "s", "aceito", "quero", "pode", "claro"}
+HUMAN_HOURS = (7, 18)
+
+DISCLAIMER = ("ℹ️ Este é um atendimento automatizado pela Pró-Visão Saúde Ocular Macapá. "
+              "As informações são educativas e não substituem avaliação médica presencial.")
+GREETING = "👁️ Olá! Eu sou o Vizô, seu assistente virtual da Pró-Visão Saúde Ocular Macapá. 🌿"
+GOODBYE = "👁️ Obrigado por falar com a Pró-Visão! Até logo. 🌿"
+EXAMES = ("Topografia de Córnea", "Mapeamento de Retina", "Campimetria Computadorizada",
+          "Biometria Óptica", "Tomografia de Coerência Óptica (OCT)")
+
+
+class SessionConflict(Exception):
+    """A sessão mudou no banco desde que foi lida (outro worker respondeu antes)."""
+
+
+class SessionState:
+    __slots__ = ("phone", "state", "info", "name", "contact", "doctor", "version", "updated_at", "consent")
+
+    def __init__(self, phone, state="NEW", info=None, name=None, contact=None, doctor=None,
+                 version=0, updated_at=0.0, consent=0):
+        self.phone = phone
+        self.state = state
+        self.info = info
+        self.name = name
+        self.contact = contact
+        self.doctor = doctor
+        self.version = version
+        self.updated_at = updated_at
+        self.consent = consent
+
+    def copy(self):
+        return SessionState(self.phone, self.state, self.info, self.name, self.contact, self.doctor,
+                            self.version, self.updated_at, self.consent)
+
+
+def init_conversation_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS whatsapp_sessions (
+            phone TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            info TEXT,
+            name TEXT,
+            contact TEXT,
+            doctor TEXT,
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("PRAGMA table_info(whatsapp_sessions)")
+    if "consent" not in [c[1] for c in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE whatsapp_sessions ADD COLUMN consent INTEGER NOT NULL DEFAULT 0")
+
+
+# --- Textos ---
+
+def menu_text(campaign_message=None):
+    lines = []
+    if campaign_message:
+        lines.append(f"📢 DESTAQUE: {campaign_message}\n")
+    lines += [
+        "1️⃣ Agendar consulta",
+        "2️⃣ Saber sobre exames",
+        "3️⃣ Conhecer nossos especialistas",
+        "4️⃣ Falar com atendente humano",
+        "5️⃣ Capacidades Técnicas (QD Synapse)",
+        "0️⃣ Sair",
+        "",
+        DISCLAIMER,
+    ]
+    return "\n".join(lines)
+
+
+def especialistas_list_text():
+    lines = ["Escolha o especialista:"]
+    lines += [f"{i + 1}️⃣ {m}" for i, m in enumerate(ESPECIALISTAS)]
+    lines.append(f"{ANY_DOCTOR_OPTION}️⃣ Qualquer especialista")
+    return "\n".join(lines)
+
+
+# --- Transições: cada função recebe (sessão, texto, engine) e devolve as respostas ---
+
+def _show_menu(s, engine):
+    engine.event(s, "VIEW_MENU")
+    s.state = "MENU"
+    return [menu_text(engine.campaign_message())]
+
+
+def _on_new(s, text, engine):
+    engine.event(s, "SESSION_START", {"source": "whatsapp"})
+    s.state = "START_DATA"
+    return [GREETING, "Para iniciarmos seu atendimento, por favor, me informe seu Nome Completo."]
+
+
+def _on_start_data(s, text, engine):
+    s.info = text
+    engine.event(s, "START_DATA_CAPTURED", {"input": text})
+    return ["Obrigado! Recebi suas informações. Como posso ajudar agora?"] + _show_menu(s, engine)
+
+
+def _show_exames(s, engine):
+    s.state = "EXAMES"
+    return [
+        "Aqui na Pró-Visão, nós cuidamos de tudo em um só lugar! 👁️✨\n"
+        "Dispomos de equipamentos novos de altíssima precisão. Realizamos:\n"
+        + "\n".join(f"- {e}" for e in EXAMES),
+        "Deseja agendar exames? (1=Sim / 2=Voltar)",
+    ]
+
+
+def _show_especialistas(s, engine):
+    s.state = "ESPECIALISTAS"
+    return [
+        "Conheça nossos especialistas:\n" + "\n".join(f"👨‍⚕️ {m}" for m in ESPECIALISTAS),
+        "Deseja agendar? (1=Sim / 2=Voltar)",
+    ]
+
+
+def _start_booking(s, engine):
+    s.state = "AGENDAMENTO_NOME"
+    return [
+        "É pra já! Vamos cuidar da saúde dos seus olhos. 👁️\n"
+        "Para prosseguirmos com o agendamento, por favor, me informe seu *Nome Completo*.",
+        "Importante (LGPD): Precisamos desses dados apenas para identificar você e confirmar sua consulta. "
+        "Eles serão armazenados com segurança. Você concorda?",
+    ]
+
+
+def _initiate_handover(s, engine):
+    hour = engine.now().hour
+    if hour < HUMAN_HOURS[0] or hour >= HUMAN_HOURS[1]:
+        return [
+            "Neste momento estamos fora do nosso horário de atendimento humano (7h00 às 18h00).\n"
+            "Posso continuar te ajudando aqui pelo Vizô agora mesmo, mas a equipe humana só retomará "
+            "o contato no próximo horário comercial.",
+        ] + _show_menu(s, engine)
+    s.state = "WAITING_HUMAN"
+    engine.request_human(s)
+    return ["🔄 Um de nossos atendentes humanos irá assumir esta conversa em breve. Por favor, aguarde... ⏳\n"
+            "(Digite 'cancelar' para voltar ao menu.)"]
+
+
+def _show_tech(s, engine):
+    s.state = "MENU"
+    return [
+        "🚀 *Capacidades Técnicas do Vizô (QD Synapse)* 🌿\n"
+        "A QD Synapse é uma startup orgulhosamente amazônida! 🇧🇷\n"
+        "O Vizô pode ser personalizado para atender diversas necessidades, como:\n"
+        "- Integração com sistemas de agendamento e prontuários (ERP/CRM)\n"
+        "- Dashboards de métricas em tempo real para gestão\n"
+        "- Personalização avançada de fluxos de conversa (NLP/IA)\n"
+        "- Suporte Omnichannel (WhatsApp, Web, Instagram, Telegram)\n"
+        "- Automação de follow-up e pesquisa de satisfação",
+        "Entre em contato conosco para transformar o atendimento da sua clínica!",
+    ]
+
+
+_MENU_OPTIONS = {
+    "1": ("CLICK_AGENDAMENTO", _start_booking),
+    "2": ("CLICK_EXAMES", _show_exames),
+    "3": ("CLICK_ESPECIALISTAS", _show_especialistas),
+    "4": ("CLICK_HUMANO", _initiate_handover),
+    "5": ("CLICK_TECH_CAPABILITIES", _show_tech),
+}
+
+
+def _on_menu(s, text, engine):
+    option = _MENU_OPTIONS.get(text)
+    if option:
+        event, action = option
+        engine.event(s, event)
+        return action(s, engine)
+    if not text.isdigit():
+        answer = engine.ask_ai(text)
+        if answer:
+            return [answer, "Como mais posso ajudar?"]
+    return ["Opção não reconhecida. Use os números do menu."] + _show_menu(s, engine)
+
+
+def _on_nome(s, text, engine):
+    s.name = text
+    engine.event(s, "INPUT_NAME_CAPTURED")
+    s.state = "AGENDAMENTO_ZAP"
+    return [f"Obrigado, {text}! É um prazer receber você aqui na Pró-Visão. 🌿\n"
+            "Por gentileza, me informe seu *número de WhatsApp com DDD*."]
+
+
+def _on_zap(s, text, engine):
+    s.contact = text
+    engine.event(s, "LEAD_CONVERTED", {"name": s.name, "phone": text})
+    s.state = "AGENDAMENTO_CAMPANHA"
+    return [f"Tudo anotado! 👁️\nRecebi seu contato *{text}*.\n"
+            "Você aceita receber novidades e campanhas da Pró-Visão por este WhatsApp? "
+            "Responda *sim* ou *não* (você pode sair a qualquer momento enviando SAIR)."]
+
+
+def _on_campanha(s, text, engine):
+    s.consent = 1 if text.lower() in CONSENT_WORDS else 0
+    s.state = "AGENDAMENTO_MEDICO"
+    return ["Combinado! Agora, escolha o especialista:", especialistas_list_text()]
+
+
+def _on_medico(s, text, engine):
+    try:
+        choice = int(text)
+    except ValueError:
+        return ["Entendido. Registramos seu interesse."] + _show_menu(s, engine)
+    if not (1 <= choice <= len(ESPECIALISTAS) or choice == ANY_DOCTOR_OPTION):
+        return ["Opção inválida. Registramos seu interesse geral."] + _show_menu(s, engine)
+    s.doctor = ESPECIALISTAS[choice - 1] if choice != ANY_DOCTOR_OPTION else "Qualquer especialista"
+    engine.event(s, "APPOINTMENT_SCHEDULED", {"doctor": s.doctor})
+    engine.booking_requested(s)
+    return [f"Ótima escolha! Agendamento pré-confirmado com {s.doctor}. 👩‍⚕️✨\n"
+            "Nossa equipe entrará em contato em breve!"] + _show_menu(s, engine)
+
+
+def _on_exames(s, text, engine):
+    if text == "1":
+        return ["Por favor, inicie o processo de agendamento (Opção 1 no menu principal)."] + _show_menu(s, engine)
+    return _show_menu(s, engine)
+
+
+def _on_especialistas(s, text, engine):
+    if text == "1":
+        s.state = "AGENDAMENTO_NOME"
+        return ["Iniciando agendamento...\nPor favor, me informe seu *Nome Completo*."]
+    return _show_menu(s, engine)
+
+
+def _on_waiting_human(s, text, engine):
+    # O atendente conversa direto; o bot só volta se o paciente pedir
+    if text.lower() in ("cancelar", "menu"):
+        engine.cancel_human(s)
+        return ["Solicitação de atendente cancelada. Voltando ao menu."] + _show_menu(s, engine)
+    return []
+
+
+TRANSITIONS = {
+    "NEW": _on_new,
+    "START_DATA": _on_start_data,
+    "MENU": _on_menu,
+    "AGENDAMENTO_NOME": _on_nome,
+    "AGENDAMENTO_ZAP": _on_zap,
+    "AGENDAMENTO_CAMPANHA": _on_campanha,
+    "AGENDAMENTO_MEDICO": _on_medico,
+    "EXAMES": _on_exames,
+    "ESPECIALISTAS": _on_especialistas,
+    "WAITING_HUMAN": _on_waiting_human,
+}
+
+
+def step(session, text, engine):
+    """Aplica uma mensagem à sessão (alterando-a) e devolve as respostas."""
+    text = (text or "").strip()
+    if text == "0" and session.state not in ("NEW", "WAITING_HUMAN"):
+        engine.event(session, "SESSION_END")
+        session.state = "NEW"
+        return [GOODBYE]
+    handler = TRANSITIONS.get(session.state, _on_new)
+    return handler(session, text, engine)
+
+
+# --- Persistência ---
+
+def load_session(cursor, phone):
+    cursor.execute('''
+        SELECT state, info, name, contact, doctor, version, updated_at, consent
+        FROM whatsapp_sessions WHERE phone = ?
+    ''', (phone,))
+    row = cursor.fetchone()
+    return SessionState(phone, *row) if row else None
+
+
+def save_session(cursor, session, now):
+    """Grava a sessão se a versão no banco ainda for session.version. Levanta SessionConflict se não for."""
+    values = (session.state, session.info, session.name, session.contact, session.doctor, session.consent, now)
+    if session.version == 0:
+        try:
+            cursor.execute('''
+                INSERT INTO whatsapp_sessions (state, info, name, contact, doctor, consent, updated_at, phone, version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ''', values + (session.phone,))
+        except sqlite3.IntegrityError:
+            raise SessionConflict(session.phone)
+    else:
+        cursor.execute('''
+            UPDATE whatsapp_sessions
+            SET state = ?, info = ?, name = ?, contact = ?, doctor = ?, consent = ?, updated_at = ?,
+                version = version + 1
+            WHERE phone = ? AND version = ?
+        ''', values + (session.phone, session.version))
+        if not cursor.rowcount:
+            raise SessionConflict(session.phone)
+    session.version += 1
+    session.updated_at = now
+
+
+def end_handover(cursor, phone, now):
+    """Atendente encerrou o ticket (sem commit): a sessão sai de WAITING_HUMAN e volta ao MENU.
+
+    Sobe a versão, então uma mensagem em processamento com a sessão antiga
+    dá SessionConflict. Quem chama deve tirar o telefone do cache depois do commit.
+    """
+    cursor.execute('''
+        UPDATE whatsapp_sessions SET state = 'MENU', updated_at = ?, version = version + 1
+        WHERE phone = ? AND state = 'WAITING_HUMAN'
+    ''', (now, phone))
+    return cursor.rowcount
+
+
+class ConversationEngine:
+    """Conduz as conversas de WhatsApp: cache LRU de sessões + tabela de transições.
+
+    Efeitos colaterais injetados (todos opcionais):
+      on_event(cursor, session, nome, detalhes) métricas do fluxo (na transação da mensagem)
+      on_booking(cursor, session)               pedido de agendamento (na transação da mensagem)
+      on_handover(cursor, session)              paciente pediu atendente humano
+      on_handover_cancel(cursor, session)       paciente desistiu do atendente
+      ask_ai(texto) -> str | None               resposta livre fora do menu
+      campaign_getter() -> str | None           destaque exibido no menu
+    """
+
+    def __init__(self, capacity=SESSION_CACHE_SIZE, on_event=None, on_booking=None, on_handover=None,
+                 ask_ai=None, campaign_getter=None, clock=None, on_handover_cancel=None):
+        self.capacity = capacity
+        self._on_event = on_event
+        self._on_booking = on_booking
+        self._on_handover = on_handover
+        self._on_handover_cancel = on_handover_cancel
+        self._ask_ai = ask_ai
+        self._campaign_getter = campaign_getter
+        self._clock = clock or time.time
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Cursor da mensagem em andamento, por thread (cada worker tem a sua transação)
+        self._local = threading.local()
+
+    # Chamados pelas transições
+    def event(self, session, name, details=None):
+        if self._on_event:
+            self._on_event(getattr(self._local, "cursor", None), session, name, details or {})
+
+    def booking_requested(self, session):
+        if self._on_booking:
+            self._on_booking(self._local.cursor, session)
+
+    def request_human(self, session):
+        if self._on_handover:
+            self._on_handover(self._local.cursor, session)
+
+    def cancel_human(self, session):
+        if self._on_handover_cancel:
+            self._on_handover_cancel(self._local.cursor, session)
+
+    def ask_ai(self, text):
+        if not self._ask_ai:
+            return None
+        try:
+            return self._ask_ai(text)
+        except Exception as e:
+            logger.warning(f"IA indisponível no WhatsApp: {e}")
+            return None
+
+    def campaign_message(self):
+        return self._campaign_getter() if self._campaign_getter else None
+
+    def now(self):
+        """Agora no horário da clínica, independente do fuso do servidor."""
+        return datetime.datetime.fromtimestamp(self._clock(), CLINIC_TZ)
+
+    # Cache
+    def _cached(self, phone):
+        with self._lock:
+            session = self._cache.get(phone)
+            if session is not None:
+                self._cache.move_to_end(phone)
+                return session.copy()
+        return None
+
+    def remember(self, session):
+        """Atualiza o cache com a sessão já gravada (chamar depois do commit)."""
+        with self._lock:
+            current = self._cache.get(session.phone)
+            if current is not None and current.version > session.version:
+                return
+            self._cache[session.phone] = session
+            self._cache.move_to_end(session.phone)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def forget(self, phone):
+        with self._lock:
+            self._cache.pop(phone, None)
+
+    def cached_sessions(self):
+        with self._lock:
+            return len(self._cache)
+
+    def handle(self, cursor, phone, text):
+        """Processa uma mensagem recebida usando o cursor (e a transação) de quem chama.
+
+        Retorna (sessão, respostas). A sessão só deve ir para o cache com
+        remember() depois do commit. Levanta SessionConflict se outro worker
+        gravou a sessão no meio tempo.
+        """
+        now = self._clock()
+        session = self._cached(phone) or load_session(cursor, phone)
+        if session is None:
+            session = SessionState(phone)
+        elif now - session.updated_at > SESSION_TTL and session.state != "NEW":
+            session.state = "NEW"
+        self._local.cursor = cursor
+        try:
+            replies = step(session, text, self)
+        finally:
+            self._local.cursor = None
+        try:
+            save_session(cursor, session, now)
+        except SessionConflict:
+            self.forget(phone)
+            raise
+        return session, replies
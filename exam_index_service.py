@@ -0,0 +1,229 @@
+import os
+import re
+import sqlite3
+import datetime
+import threading
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Índice local dos arquivos de exame da pasta do Drive. Do nome de cada
+# arquivo saem o nome do paciente (normalizado: sem acento, minúsculo, sem
+# palavras como "exame"/"resultado") e a data do exame; o nome do paciente é
+# quebrado em trigramas em exam_trigrams. A busca conta os trigramas em
+# comum com a consulta (coeficiente de Dice), então "Joao da Silva" acha
+# "João D'Silva - 13-02-2026.pdf" sem nenhuma chamada ao Drive.
+#
+# Exame é dado de saúde (LGPD): a busca nunca é pública. O envio ao paciente
+# usa exams_for_patient() com o nome do cadastro verificado pelo telefone, e
+# só aceita arquivos com score de pelo menos MATCH_SCORE.
+
+REFRESH_INTERVAL = float(os.getenv("EXAM_INDEX_INTERVAL", "300"))
+# Quanto a data informada pesa no score (a mais se bate, a menos se não bate)
+DATE_WEIGHT = 0.25
+# Score mínimo para considerar que o arquivo é do paciente: tolera acento,
+# apóstrofo e uma letra trocada, mas não um sobrenome diferente
+MATCH_SCORE = float(os.getenv("EXAM_MATCH_SCORE", "0.75"))
+
+_NOISE_WORDS = {
+    "pdf", "exame", "exames", "resultado", "resultados", "laudo", "laudos", "de", "da", "do",
+    "das", "dos", "e", "paciente", "retinografia", "campo", "visual", "oct", "topografia",
+    "mapeamento", "retina", "biometria", "paquimetria", "tonometria", "microscopia", "especular",
+}
+_DATE_PATTERNS = (
+    (re.compile(r"(\d{4})[-_./](\d{1,2})[-_./](\d{1,2})"), ("y", "m", "d")),
+    (re.compile(r"(\d{1,2})[-_./](\d{1,2})[-_./](\d{4})"), ("d", "m", "y")),
+    (re.compile(r"(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)"), ("y", "m", "d")),
+)
+
+
+def init_exam_index_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exam_files (
+            file_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            patient_norm TEXT NOT NULL,
+            exam_date TEXT,
+            web_link TEXT,
+            modified_time TEXT,
+            trigrams INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exam_trigrams (
+            trigram TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (trigram, file_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_exam_trigrams_file ON exam_trigrams (file_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_exam_files_patient ON exam_files (patient_norm, exam_date)")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+
+def parse_date(text):
+    """Primeira data reconhecível em `text`, como 'AAAA-MM-DD', ou None."""
+    for pattern, order in _DATE_PATTERNS:
+        for match in pattern.finditer(str(text or "")):
+            parts = dict(zip(order, (int(g) for g in match.groups())))
+            try:
+                return datetime.date(parts["y"], parts["m"], parts["d"]).isoformat()
+            except ValueError:
+                continue
+    return None
+
+
+def parse_file_name(name):
+    """('joao silva', '2026-02-13') a partir de 'João D'Silva - 13-02-2026 - Retinografia.pdf'."""
+    base = os.path.splitext(name or "")[0]
+    exam_date = parse_date(base)
+    words = [w for w in normalize(base).split() if not w.isdigit() and w not in _NOISE_WORDS and len(w) > 1]
+    return " ".join(words), exam_date
+
+
+def patient_query(text):
+    """Normaliza o nome digitado do mesmo jeito que os nomes de arquivo."""
+    words = [w for w in normalize(text).split() if w not in _NOISE_WORDS and len(w) > 1]
+    return " ".join(words)
+
+
+def trigrams(text):
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _index_file(cursor, f):
+    patient, exam_date = parse_file_name(f.get("name"))
+    grams = trigrams(patient)
+    cursor.execute("DELETE FROM exam_trigrams WHERE file_id = ?", (f["id"],))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO exam_trigrams (trigram, file_id) VALUES (?, ?)",
+        [(g, f["id"]) for g in grams]
+    )
+    cursor.execute('''
+        INSERT INTO exam_files (file_id, name, patient_norm, exam_date, web_link, modified_time, trigrams)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (file_id) DO UPDATE SET
+            name = excluded.name, patient_norm = excluded.patient_norm, exam_date = excluded.exam_date,
+            web_link = excluded.web_link, modified_time = excluded.modified_time, trigrams = excluded.trigrams
+    ''', (f["id"], f.get("name") or "", patient, exam_date, f.get("webViewLink"), f.get("modifiedTime"), len(grams)))
+
+
+def refresh_index(conn, files):
+    """Atualiza o índice com a listagem atual da pasta. Só reindexa arquivos novos ou alterados."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT file_id, name, modified_time FROM exam_files")
+    known = {r[0]: (r[1], r[2]) for r in cursor.fetchall()}
+    current = {f["id"] for f in files}
+    removed = set(known) - current
+    for file_id in removed:
+        cursor.execute("DELETE FROM exam_trigrams WHERE file_id = ?", (file_id,))
+        cursor.execute("DELETE FROM exam_files WHERE file_id = ?", (file_id,))
+    changed = 0
+    for f in files:
+        if known.get(f["id"]) != (f.get("name") or "", f.get("modifiedTime")):
+            _index_file(cursor, f)
+            changed += 1
+    conn.commit()
+    return {"indexed": changed, "removed": len(removed), "total": len(files)}
+
+
+def search(cursor, name, exam_date=None, limit=5):
+    """Arquivos mais parecidos com o nome do paciente, do mais provável para o menos.
+
+    Com `exam_date` ('AAAA-MM-DD'), arquivos dessa data sobem na lista.
+    """
+    grams = trigrams(patient_query(name))
+    if not grams:
+        return []
+    placeholders = ", ".join("?" for _ in grams)
+    cursor.execute(f'''
+        SELECT f.file_id, f.name, f.patient_norm, f.exam_date, f.web_link,
+               2.0 * COUNT(*) / (f.trigrams + ?) AS score
+        FROM exam_trigrams t
+        JOIN exam_files f ON f.file_id = t.file_id
+        WHERE t.trigram IN ({placeholders})
+        GROUP BY f.file_id
+    ''', [len(grams)] + list(grams))
+    results = []
+    for file_id, file_name, patient, file_date, link, score in cursor.fetchall():
+        if exam_date and file_date:
+            score += DATE_WEIGHT if file_date == exam_date else -DATE_WEIGHT
+        results.append({
+            "file_id": file_id,
+            "name": file_name,
+            "patient": patient,
+            "exam_date": file_date,
+            "link": link,
+            "score": round(min(score, 1.0), 3),
+        })
+    # Empate no score: exame mais recente primeiro
+    results.sort(key=lambda r: r["exam_date"] or "", reverse=True)
+    results.sort(key=lambda r: r["score"], reverse=True)
+    return results[:limit]
+
+
+def similarity(a, b):
+    """Coeficiente de Dice entre os trigramas de dois nomes de paciente (0 a 1)."""
+    grams_a, grams_b = trigrams(patient_query(a)), trigrams(patient_query(b))
+    if not grams_a or not grams_b:
+        return 0.0
+    return 2.0 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+def exams_for_patient(cursor, name, exam_date=None, limit=5):
+    """Exames do paciente `name` com score de pelo menos MATCH_SCORE, do mais provável ao menos.
+
+    Com `exam_date` ('AAAA-MM-DD'), os exames dessa data sobem na lista.
+    """
+    return [r for r in search(cursor, name, exam_date, limit) if r["score"] >= MATCH_SCORE]
+
+
+class ExamIndexWorker:
+    """Relê a pasta de exames do Drive a cada REFRESH_INTERVAL segundos."""
+
+    def __init__(self, db_path_getter, google_service_getter, folder_id_getter):
+        self._db_path_getter = db_path_getter
+        self._google_service_getter = google_service_getter
+        self._folder_id_getter = folder_id_getter
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="exam-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh_once(self):
+        service = self._google_service_getter()
+        folder_id = self._folder_id_getter()
+        if not service or not folder_id:
+            return None
+        files = service.list_folder_pdfs(folder_id)
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            stats = refresh_index(conn, files)
+        if stats["indexed"] or stats["removed"]:
+            logger.info(f"Índice de exames atualizado: {stats}")
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.error(f"Erro ao atualizar índice de exames: {e}")
+            self._stop.wait(REFRESH_INTERVAL)
@@ -1,186 +1,303 @@
-import os
-import datetime
-import logging
-import json
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Scopes: Calendar, Sheets (Database), Drive (Knowledge Base)
-SCOPES = [
-    'https://www.googleapis.com/auth/calendar',
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive.readonly'
-]
-
-from google.oauth2 import service_account
-
-class GoogleService:
-    def __init__(self):
-        self.creds = None
-        self.token_file = 'token.json'
-        # Prioriza Service Account se existir, pois é mais estável para backend
-        self.service_account_file = 'service_account.json' 
-        self.client_secret_file = 'client_secret.json'
-        self.authenticate()
-
-    def authenticate(self):
-        """Autentica via Service Account (preferencial) ou OAuth User."""
-        # 1. Tenta Service Account (Melhor para servidor/bot)
-        if os.path.exists(self.service_account_file):
-            try:
-                self.creds = service_account.Credentials.from_service_account_file(
-                    self.service_account_file, scopes=SCOPES)
-                logger.info("Autenticado via Service Account ✅")
-                return
-            except Exception as e:
-                logger.error(f"Erro Service Account: {e}")
-
-        # 2. Fallback para OAuth User (Tokens salvos)
-        if os.path.exists(self.token_file):
-            self.creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
-        
-        # 3. Fluxo de Login Manual (apenas se não houver SA)
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                if os.path.exists(self.client_secret_file):
-                    flow = InstalledAppFlow.from_client_secrets_file(self.client_secret_file, SCOPES)
-                    self.creds = flow.run_local_server(port=0)
-                    with open(self.token_file, 'w') as token:
-                        token.write(self.creds.to_json())
-                else:
-                    logger.warning("Nenhuma credencial Google encontrada (SA ou OAuth).")
-
-    # --- GOOGLE CALENDAR (Agendamento) ---
-    def create_appointment(self, summary, description, start_time, doctor_email=None):
-        """Cria um agendamento no Google Calendar."""
-        if not self.creds: return False
-        try:
-            service = build('calendar', 'v3', credentials=self.creds)
-            
-            # Formato esperado: 2026-02-13T10:00:00Z
-            event = {
-                'summary': summary,
-                'description': description,
-                'start': {'dateTime': start_time, 'timeZone': 'America/Fortaleza'},
-                'end': {'dateTime': (datetime.datetime.fromisoformat(start_time.replace('Z', '')) + 
-                                   datetime.timedelta(minutes=30)).isoformat() + 'Z', 
-                        'timeZone': 'America/Fortaleza'},
-            }
-            if doctor_email:
-                event['attendees'] = [{'email': doctor_email}]
-
-            event = service.events().insert(calendarId='primary', body=event).execute()
-            logger.info(f"Evento criado: {event.get('htmlLink')}")
-            return event.get('htmlLink')
-        except HttpError as error:
-            logger.error(f'Um erro ocorreu ao criar evento: {error}')
-            return None
-
-    # --- GOOGLE SHEETS (Banco de Dados e Relatórios) ---
+import os
+import datetime
+import logging
+import json
+import threading
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Scopes: Calendar, Sheets (Database), Drive (Knowledge Base)
+SCOPES = [
+    'https://www.googleapis.com/auth/calendar',
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive.readonly'
+]
+
+from google.oauth2 import service_account
+
+# Renova o token alguns minutos antes de expirar, para nenhuma chamada
+# pagar a renovação (ou um 401) no meio de uma requisição.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+HTTP_TIMEOUT = int(os.getenv("GOOGLE_HTTP_TIMEOUT", "30"))
+
+class GoogleService:
+    def __init__(self):
+        self.creds = None
+        self.token_file = 'token.json'
+        # Prioriza Service Account se existir, pois é mais estável para backend
+        self.service_account_file = 'service_account.json' 
+        self.client_secret_file = 'client_secret.json'
+        # Clientes da API por thread: httplib2 não é thread-safe, então cada
+        # thread tem seu próprio transporte (com keep-alive) e seus recursos.
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self.authenticate()
+
+    def _ensure_fresh_token(self):
+        """Renova as credenciais antes do vencimento (uma thread por vez)."""
+        creds = self.creds
+        expiry = getattr(creds, 'expiry', None)
+        if getattr(creds, 'token', None) and (expiry is None or expiry - datetime.datetime.utcnow() > TOKEN_REFRESH_MARGIN):
+            return
+        with self._refresh_lock:
+            expiry = getattr(creds, 'expiry', None)
+            if getattr(creds, 'token', None) and (expiry is None or expiry - datetime.datetime.utcnow() > TOKEN_REFRESH_MARGIN):
+                return
+            try:
+                creds.refresh(Request())
+                if isinstance(creds, Credentials):
+                    with open(self.token_file, 'w') as token:
+                        token.write(creds.to_json())
+            except Exception as e:
+                logger.error(f"Falha ao renovar credenciais Google: {e}")
+
+    def _service(self, name, version):
+        """Recurso da API (calendar/sheets/drive) já construído para esta thread."""
+        self._ensure_fresh_token()
+        services = getattr(self._local, 'services', None)
+        if services is None:
+            services = self._local.services = {}
+            self._local.http = google_auth_httplib2.AuthorizedHttp(
+                self.creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        service = services.get((name, version))
+        if service is None:
+            service = build(name, version, http=self._local.http,
+                            static_discovery=True, cache_discovery=False)
+            services[(name, version)] = service
+        return service
+
+    def authenticate(self):
+        """Autentica via Service Account (preferencial) ou OAuth User."""
+        # 1. Tenta Service Account (Melhor para servidor/bot)
+        if os.path.exists(self.service_account_file):
+            try:
+                self.creds = service_account.Credentials.from_service_account_file(
+                    self.service_account_file, scopes=SCOPES)
+                logger.info("Autenticado via Service Account ✅")
+                return
+            except Exception as e:
+                logger.error(f"Erro Service Account: {e}")
+
+        # 2. Fallback para OAuth User (Tokens salvos)
+        if os.path.exists(self.token_file):
+            self.creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
+        
+        # 3. Fluxo de Login Manual (apenas se não houver SA)
+        if not self.creds or not self.creds.valid:
+            if self.creds and self.creds.expired and self.creds.refresh_token:
+                self.creds.refresh(Request())
+            else:
+                if os.path.exists(self.client_secret_file):
+                    flow = InstalledAppFlow.from_client_secrets_file(self.client_secret_file, SCOPES)
+                    self.creds = flow.run_local_server(port=0)
+                    with open(self.token_file, 'w') as token:
+                        token.write(self.creds.to_json())
+                else:
+                    logger.warning("Nenhuma credencial Google encontrada (SA ou OAuth).")
+
+    # --- GOOGLE CALENDAR (Agendamento) ---
+    def create_appointment(self, summary, description, start_time, doctor_email=None, event_id=None):
+        """Cria um agendamento no Google Calendar.
+
+        Com `event_id` (base32hex, ex.: uuid4().hex) a criação é idempotente: se o
+        evento já existir, devolve o link dele.
+        """
+        if not self.creds: return False
+        try:
+            service = self._service('calendar', 'v3')
+            
+            # Formato esperado: 2026-02-13T10:00:00-03:00 (ou com Z, em UTC)
+            start = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+            event = {
+                'summary': summary,
+                'description': description,
+                'start': {'dateTime': start.isoformat(), 'timeZone': 'America/Fortaleza'},
+                'end': {'dateTime': (start + datetime.timedelta(minutes=30)).isoformat(),
+                        'timeZone': 'America/Fortaleza'},
+            }
+            if doctor_email:
+                event['attendees'] = [{'email': doctor_email}]
+            if event_id:
+                event['id'] = event_id
+
+            event = service.events().insert(calendarId='primary', body=event).execute()
+            logger.info(f"Evento criado: {event.get('htmlLink')}")
+            return event.get('htmlLink')
+        except HttpError as error:
+            if event_id and getattr(error.resp, 'status', None) == 409:
+                try:
+                    existing = service.events().get(calendarId='primary', eventId=event_id).execute()
+                    return existing.get('htmlLink')
+                except HttpError as lookup_error:
+                    # O id já existe, mas não nesta agenda (ou sem acesso): não há link a devolver.
+                    logger.warning(f"Evento {event_id} duplicado, mas não foi possível lê-lo: {lookup_error}")
+                    return None
+            logger.error(f'Um erro ocorreu ao criar evento: {error}')
+            return None
+
+    def get_busy_intervals(self, calendar_ids, time_min, time_max):
+        """Free/busy de várias agendas em uma chamada: {calendar_id: [(inicio, fim), ...]} em RFC 3339."""
+        if not self.creds:
+            raise RuntimeError("Google não autenticado")
+        service = self._service('calendar', 'v3')
+        result = service.freebusy().query(body={
+            'timeMin': time_min,
+            'timeMax': time_max,
+            'timeZone': 'America/Fortaleza',
+            'items': [{'id': cid} for cid in calendar_ids],
+        }).execute()
+        busy = {}
+        for cid, info in (result.get('calendars') or {}).items():
+            if info.get('errors'):
+                logger.warning(f"Free/busy indisponível para {cid}: {info['errors']}")
+            busy[cid] = [(p['start'], p['end']) for p in info.get('busy', [])]
+        return busy
+
+    # --- GOOGLE SHEETS (Banco de Dados e Relatórios) ---
     def add_lead_to_sheets(self, spreadsheet_id, data, sheet_range="A1"):
-        if not self.creds: return False
-        try:
-            service = build('sheets', 'v4', credentials=self.creds)
-            body = {'values': [data]}
-            result = service.spreadsheets().values().append(
-                spreadsheetId=spreadsheet_id, range=sheet_range,
-                valueInputOption="RAW", body=body).execute()
-            return True
-        except HttpError as error:
-            logger.error(f'Erro no Sheets: {error}')
-            return False
-
-    def get_morning_report(self, spreadsheet_id):
-        """Lê os atendimentos do dia para gerar o relatório do WhatsApp."""
-        if not self.creds: return "Erro na autenticação"
-        try:
-            service = build('sheets', 'v4', credentials=self.creds)
-            range_name = 'Sheet1!A2:E' # Ignora o cabeçalho
-            result = service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id, range=range_name).execute()
-            rows = result.get('values', [])
-            
-            if not rows:
-                return "Nenhum agendamento encontrado para hoje."
-            
-            # Filtro simples por data (exemplo)
-            today = datetime.date.today().strftime("%Y-%m-%d")
-            today_tasks = [row for row in rows if row[0].startswith(today)]
-            
-            report = f"*Relatório Vizô - {today}*\n\n"
-            for task in today_tasks:
-                report += f"📍 {task[1]} - {task[3]} ({task[2]})\n"
-            
-            return report
-        except HttpError as error:
-            return f"Erro ao gerar relatório: {error}"
-
-    def check_user_exists(self, spreadsheet_id, identifier):
-        """Verifica se um usuário já existe na planilha (por Nome ou Email/Telefone)."""
-        if not self.creds: return False
-        try:
-            service = build('sheets', 'v4', credentials=self.creds)
-            range_name = 'Sheet1!A:E' # Busca em toda a planilha
-            result = service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id, range=range_name).execute()
-            rows = result.get('values', [])
-            
-            if not rows: return False
-            
-            # Procura o identificador em qualquer coluna da linha
-            for row in rows:
-                if any(identifier.lower() in str(cell).lower() for cell in row):
-                    return True
-            return False
-        except HttpError as error:
-            logger.error(f"Erro ao verificar usuário: {error}")
-            return False
-
-    # --- GOOGLE DRIVE (Knowledge Base) ---
-    def list_knowledge_files(self, folder_id):
-        """Lista PDFs de uma pasta específica do Drive para consulta do bot."""
-        if not self.creds: return []
-        try:
-            service = build('drive', 'v3', credentials=self.creds)
-            # Ensure folder_id is safe or handle specific placeholder
-            if "digite_o_id" in folder_id:
-                return []
-                
-            query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
-            results = service.files().list(
-                q=query, spaces='drive', fields='files(id, name, webViewLink, webContentLink)').execute()
-            return results.get('files', [])
-        except HttpError as error:
-            logger.error(f'Erro ao acessar Drive: {error}')
-            return []
-
-    def search_file_by_name(self, folder_id, name_query):
-        """Busca um arquivo específico por nome (parcial)."""
-        if not self.creds: return None
-        try:
-            service = build('drive', 'v3', credentials=self.creds)
-            query = f"'{folder_id}' in parents and name contains '{name_query}' and mimeType='application/pdf' and trashed=false"
-            results = service.files().list(
-                q=query, spaces='drive', fields='files(id, name, webViewLink, webContentLink)').execute()
-            files = results.get('files', [])
-            return files[0] if files else None
-        except HttpError as error:
-            logger.error(f'Erro ao buscar arquivo no Drive: {error}')
-            return None
-
-if __name__ == "__main__":
-    # Teste de inicialização
-    gs = GoogleService()
-    print("Serviço Google Inicializado.")
+        if not self.creds: return False
+        try:
+            self.append_rows(spreadsheet_id, [data], sheet_range)
+            return True
+        except HttpError as error:
+            logger.error(f'Erro no Sheets: {error}')
+            return False
+
+    def append_rows(self, spreadsheet_id, rows, sheet_range="A1"):
+        """Anexa várias linhas em uma única chamada values.append. Levanta HttpError em caso de falha."""
+        if not self.creds:
+            raise RuntimeError("Google não autenticado")
+        service = self._service('sheets', 'v4')
+        return service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id, range=sheet_range,
+            valueInputOption="RAW", insertDataOption="INSERT_ROWS",
+            body={'values': rows}).execute()
+
+    def get_rows(self, spreadsheet_id, range_name):
+        """Lê as linhas de um intervalo (lista de listas). Levanta HttpError em caso de falha."""
+        if not self.creds:
+            raise RuntimeError("Google não autenticado")
+        service = self._service('sheets', 'v4')
+        result = service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=range_name).execute()
+        return result.get('values', [])
+
+    def get_morning_report(self, spreadsheet_id):
+        """Lê os atendimentos do dia para gerar o relatório do WhatsApp."""
+        if not self.creds: return "Erro na autenticação"
+        try:
+            service = self._service('sheets', 'v4')
+            range_name = 'Sheet1!A2:E' # Ignora o cabeçalho
+            result = service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id, range=range_name).execute()
+            rows = result.get('values', [])
+            
+            if not rows:
+                return "Nenhum agendamento encontrado para hoje."
+            
+            # Filtro simples por data (exemplo)
+            today = datetime.date.today().strftime("%Y-%m-%d")
+            today_tasks = [row for row in rows if row[0].startswith(today)]
+            
+            report = f"*Relatório Vizô - {today}*\n\n"
+            for task in today_tasks:
+                report += f"📍 {task[1]} - {task[3]} ({task[2]})\n"
+            
+            return report
+        except HttpError as error:
+            return f"Erro ao gerar relatório: {error}"
+
+    def check_user_exists(self, spreadsheet_id, identifier):
+        """Verifica se um usuário já existe na planilha (por Nome ou Email/Telefone)."""
+        if not self.creds: return False
+        try:
+            service = self._service('sheets', 'v4')
+            range_name = 'Sheet1!A:E' # Busca em toda a planilha
+            result = service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id, range=range_name).execute()
+            rows = result.get('values', [])
+            
+            if not rows: return False
+            
+            # Procura o identificador em qualquer coluna da linha
+            for row in rows:
+                if any(identifier.lower() in str(cell).lower() for cell in row):
+                    return True
+            return False
+        except HttpError as error:
+            logger.error(f"Erro ao verificar usuário: {error}")
+            return False
+
+    # --- GOOGLE DRIVE (Knowledge Base) ---
+    def list_knowledge_files(self, folder_id):
+        """Lista PDFs de uma pasta específica do Drive para consulta do bot."""
+        if not self.creds: return []
+        try:
+            service = self._service('drive', 'v3')
+            # Ensure folder_id is safe or handle specific placeholder
+            if "digite_o_id" in folder_id:
+                return []
+                
+            query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
+            results = service.files().list(
+                q=query, spaces='drive', fields='files(id, name, webViewLink, webContentLink)').execute()
+            return results.get('files', [])
+        except HttpError as error:
+            logger.error(f'Erro ao acessar Drive: {error}')
+            return []
+
+    def list_folder_pdfs(self, folder_id):
+        """Todos os PDFs da pasta, com md5Checksum e modifiedTime. Levanta HttpError em caso de falha."""
+        if not self.creds:
+            raise RuntimeError("Google não autenticado")
+        service = self._service('drive', 'v3')
+        query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
+        files, page_token = [], None
+        while True:
+            results = service.files().list(
+                q=query, spaces='drive', pageToken=page_token, pageSize=1000,
+                fields='nextPageToken, files(id, name, webViewLink, md5Checksum, modifiedTime)').execute()
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+
+    def download_file(self, file_id):
+        """Conteúdo binário de um arquivo do Drive."""
+        if not self.creds:
+            raise RuntimeError("Google não autenticado")
+        service = self._service('drive', 'v3')
+        return service.files().get_media(fileId=file_id).execute()
+
+    def search_file_by_name(self, folder_id, name_query):
+        """Busca um arquivo específico por nome (parcial)."""
+        if not self.creds: return None
+        try:
+            service = self._service('drive', 'v3')
+            # Aspas simples e barras precisam de escape na sintaxe de busca do Drive
+            safe_name = name_query.replace("\\", "\\\\").replace("'", "\\'")
+            query = f"'{folder_id}' in parents and name contains '{safe_name}' and mimeType='application/pdf' and trashed=false"
+            results = service.files().list(
+                q=query, spaces='drive', fields='files(id, name, webViewLink, webContentLink)').execute()
+            files = results.get('files', [])
+            return files[0] if files else None
+        except HttpError as error:
+            logger.error(f'Erro ao buscar arquivo no Drive: {error}')
+            return None
+
+if __name__ == "__main__":
+    # Teste de inicialização
+    gs = GoogleService()
+    print("Serviço Google Inicializado.")
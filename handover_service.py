@@ -0,0 +1,271 @@
+import os
+import time
+import datetime
+
+import whatsapp_service
+
+# Fila de atendimento humano. Cada pedido de atendente (chat web, WhatsApp ou
+# terminal) vira um ticket em handover_tickets; o índice único parcial garante
+# um só ticket aberto por sessão, então repetir o pedido não duplica a fila.
+# O atendente "pega" um ticket com claim() (um UPDATE condicional, então dois
+# consoles nunca pegam o mesmo), devolve com release() ou encerra com close().
+#
+# Cada mudança também entra em handover_events, que é o que o SSE dos
+# consoles entrega (id do evento = id da linha, para retomar com
+# Last-Event-ID). Os tempos ficam no ticket: espera = first_claimed_at -
+# created_at e atendimento = closed_at - first_claimed_at.
+
+HANDOVER_TOPIC = "handover"
+# Atendentes avisados pelo WhatsApp a cada ticket novo (separados por vírgula)
+NOTIFY_PHONES = [p.strip() for p in os.getenv("HANDOVER_NOTIFY_PHONES", "96 99160-3396").split(",") if p.strip()]
+
+TICKET_COLUMNS = (
+    "id", "session_id", "channel", "name", "phone", "status", "attendant",
+    "created_at", "first_claimed_at", "claimed_at", "closed_at",
+)
+
+
+class TicketConflict(Exception):
+    """O ticket não está no estado esperado (outro atendente pegou, já foi encerrado...)."""
+
+
+def init_handover_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS handover_tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            name TEXT,
+            phone TEXT,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            attendant TEXT,
+            created_at REAL NOT NULL,
+            first_claimed_at REAL,
+            claimed_at REAL,
+            closed_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_handover_open_session
+        ON handover_tickets (session_id) WHERE status IN ('waiting', 'claimed')
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_handover_status ON handover_tickets (status, created_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS handover_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            attendant TEXT,
+            at REAL NOT NULL
+        )
+    ''')
+
+
+def _ticket(row):
+    return dict(zip(TICKET_COLUMNS, row)) if row else None
+
+
+def get_ticket(cursor, ticket_id):
+    cursor.execute(f"SELECT {', '.join(TICKET_COLUMNS)} FROM handover_tickets WHERE id = ?", (ticket_id,))
+    return _ticket(cursor.fetchone())
+
+
+def _log(cursor, ticket_id, kind, attendant, now):
+    cursor.execute(
+        "INSERT INTO handover_events (ticket_id, kind, attendant, at) VALUES (?, ?, ?, ?)",
+        (ticket_id, kind, attendant, now)
+    )
+
+
+def notify_text(name, phone, channel):
+    return (
+        f"🔔 Paciente aguardando atendimento humano ({channel}): {name or 'Visitante'}"
+        f"{' - ' + phone if phone else ''}. Abra o console de atendimento para assumir."
+    )
+
+
+def open_ticket(cursor, session_id, channel, name=None, phone=None, now=None, notify_whatsapp=False):
+    """Coloca a sessão na fila (sem commit). Retorna (ticket_id, criado).
+
+    Se a sessão já tem um ticket aberto, devolve esse ticket e criado=False.
+    Com notify_whatsapp, cada telefone de NOTIFY_PHONES recebe um aviso pela
+    fila do WhatsApp, na mesma transação.
+    """
+    now = now or time.time()
+    cursor.execute('''
+        INSERT INTO handover_tickets (session_id, channel, name, phone, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (session_id) WHERE status IN ('waiting', 'claimed') DO NOTHING
+    ''', (session_id, channel, name, phone, now))
+    created = cursor.rowcount == 1
+    cursor.execute(
+        "SELECT id FROM handover_tickets WHERE session_id = ? AND status IN ('waiting', 'claimed')",
+        (session_id,)
+    )
+    ticket_id = cursor.fetchone()[0]
+    if created:
+        _log(cursor, ticket_id, "opened", None, now)
+        if notify_whatsapp:
+            for attendant_phone in NOTIFY_PHONES:
+                whatsapp_service.enqueue_message(
+                    cursor, attendant_phone, notify_text(name, phone, channel),
+                    f"handover-{ticket_id}-{whatsapp_service.normalize_phone(attendant_phone)}"
+                )
+    return ticket_id, created
+
+
+def position(cursor, ticket_id):
+    """Posição (1 = próximo) de um ticket ainda esperando; None se não estiver na fila."""
+    cursor.execute('''
+        SELECT COUNT(*) FROM handover_tickets w, handover_tickets t
+        WHERE t.id = ? AND t.status = 'waiting' AND w.status = 'waiting'
+          AND (w.created_at < t.created_at OR (w.created_at = t.created_at AND w.id <= t.id))
+    ''', (ticket_id,))
+    count = cursor.fetchone()[0]
+    return count or None
+
+
+def claim(cursor, ticket_id, attendant, now=None):
+    """Atendente assume o ticket (sem commit). Levanta TicketConflict se ele não estava esperando."""
+    now = now or time.time()
+    cursor.execute(f'''
+        UPDATE handover_tickets
+        SET status = 'claimed', attendant = ?, claimed_at = ?, first_claimed_at = COALESCE(first_claimed_at, ?)
+        WHERE id = ? AND status = 'waiting'
+        RETURNING {', '.join(TICKET_COLUMNS)}
+    ''', (attendant, now, now, ticket_id))
+    ticket = _ticket(cursor.fetchone())
+    if not ticket:
+        raise TicketConflict("Ticket não está aguardando atendimento")
+    _log(cursor, ticket_id, "claimed", attendant, now)
+    return ticket
+
+
+def claim_next(cursor, attendant, now=None):
+    """Assume o ticket mais antigo da fila. Retorna None se a fila estiver vazia."""
+    cursor.execute("SELECT id FROM handover_tickets WHERE status = 'waiting' ORDER BY created_at, id LIMIT 1")
+    row = cursor.fetchone()
+    return claim(cursor, row[0], attendant, now) if row else None
+
+
+def release(cursor, ticket_id, attendant, now=None):
+    """Devolve o ticket para a fila (mantém a posição original e o first_claimed_at)."""
+    now = now or time.time()
+    cursor.execute('''
+        UPDATE handover_tickets SET status = 'waiting', attendant = NULL, claimed_at = NULL
+        WHERE id = ? AND status = 'claimed' AND attendant = ?
+    ''', (ticket_id, attendant))
+    if not cursor.rowcount:
+        raise TicketConflict("Ticket não está com este atendente")
+    _log(cursor, ticket_id, "released", attendant, now)
+    return get_ticket(cursor, ticket_id)
+
+
+def close(cursor, ticket_id, attendant, now=None):
+    now = now or time.time()
+    cursor.execute('''
+        UPDATE handover_tickets SET status = 'closed', closed_at = ?
+        WHERE id = ? AND status = 'claimed' AND attendant = ?
+    ''', (now, ticket_id, attendant))
+    if not cursor.rowcount:
+        raise TicketConflict("Ticket não está com este atendente")
+    _log(cursor, ticket_id, "closed", attendant, now)
+    return get_ticket(cursor, ticket_id)
+
+
+def cancel(cursor, session_id, now=None):
+    """Paciente desistiu: o ticket que esperava vira 'abandoned'; o que estava em atendimento é encerrado."""
+    now = now or time.time()
+    cursor.execute('''
+        UPDATE handover_tickets
+        SET status = CASE status WHEN 'waiting' THEN 'abandoned' ELSE 'closed' END, closed_at = ?
+        WHERE session_id = ? AND status IN ('waiting', 'claimed')
+        RETURNING id, status
+    ''', (now, session_id))
+    rows = cursor.fetchall()
+    for ticket_id, status in rows:
+        _log(cursor, ticket_id, status, None, now)
+    return len(rows)
+
+
+def open_tickets(cursor, now=None):
+    """Fila atual (esperando e em atendimento), do mais antigo para o mais novo."""
+    now = now or time.time()
+    cursor.execute(f'''
+        SELECT {', '.join(TICKET_COLUMNS)} FROM handover_tickets
+        WHERE status IN ('waiting', 'claimed')
+        ORDER BY created_at, id
+    ''')
+    tickets = [_ticket(r) for r in cursor.fetchall()]
+    for t in tickets:
+        t["waiting_seconds"] = round(now - t["created_at"]) if t["status"] == "waiting" else None
+    return tickets
+
+
+def events_after(cursor, last_id, limit=100):
+    """Eventos depois de last_id com o estado atual do ticket, para o SSE dos consoles."""
+    cursor.execute(f'''
+        SELECT e.id, e.kind, e.attendant, e.at, {', '.join('t.' + c for c in TICKET_COLUMNS)}
+        FROM handover_events e
+        JOIN handover_tickets t ON t.id = e.ticket_id
+        WHERE e.id > ?
+        ORDER BY e.id ASC
+        LIMIT ?
+    ''', (last_id, limit))
+    return [
+        {"id": r[0], "kind": r[1], "attendant": r[2], "at": r[3], "ticket": _ticket(r[4:])}
+        for r in cursor.fetchall()
+    ]
+
+
+def last_event_id(cursor):
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM handover_events")
+    return cursor.fetchone()[0]
+
+
+def wait_stats(cursor, date_from=None, date_to=None):
+    """Médias (segundos) dos tickets criados no período e o tamanho atual da fila.
+
+    avg_wait: criação -> primeiro claim; avg_handle: primeiro claim -> encerramento.
+    """
+    clauses, params = [], []
+    # Datas como date ou 'YYYY-MM-DD' (rollup_service.parse_range), no horário local
+    if date_from:
+        clauses.append("created_at >= ?")
+        params.append(datetime.datetime.fromisoformat(str(date_from)).timestamp())
+    if date_to:
+        clauses.append("created_at < ?")
+        params.append((datetime.datetime.fromisoformat(str(date_to)) + datetime.timedelta(days=1)).timestamp())
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    cursor.execute(f'''
+        SELECT AVG(first_claimed_at - created_at),
+               AVG(CASE WHEN status = 'closed' THEN closed_at - first_claimed_at END),
+               SUM(status = 'abandoned'),
+               COUNT(*)
+        FROM handover_tickets {where}
+    ''', params)
+    avg_wait, avg_handle, abandoned, total = cursor.fetchone()
+    cursor.execute("SELECT status, COUNT(*) FROM handover_tickets WHERE status IN ('waiting', 'claimed') GROUP BY status")
+    current = dict(cursor.fetchall())
+    return {
+        "avg_wait": avg_wait,
+        "avg_handle": avg_handle,
+        "tickets": total,
+        "abandoned": abandoned or 0,
+        "waiting": current.get("waiting", 0),
+        "in_progress": current.get("claimed", 0),
+    }
+
+
+def format_duration(seconds):
+    """45 -> '45s', 192 -> '3m 12s'; '-' sem dados."""
+    if seconds is None:
+        return "-"
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m"
@@ -0,0 +1,304 @@
+import io
+import os
+import re
+import time
+import sqlite3
+import threading
+import logging
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Conteúdo dos PDFs da pasta de conhecimento do Drive. O sync compara
+# md5Checksum/modifiedTime com o que já está em knowledge_files e só baixa
+# arquivos novos ou alterados; a extração de texto roda em um pool de
+# processos (é CPU pura) e o resultado vai para knowledge_chunks em trechos
+# de ~CHUNK_CHARS caracteres, com página e offsets no texto original. O chat
+# consulta só o índice FTS5 local, nunca o Drive.
+#
+# O pool usa 'spawn': o sync roda numa thread do servidor Flask e um fork de
+# processo com várias threads pode herdar locks travados. Os PDFs são baixados
+# e extraídos em janelas de SYNC_WINDOW arquivos, para não segurar a pasta
+# inteira na memória. Um arquivo que falha só é tentado de novo depois de um
+# backoff exponencial (RETRY_BASE, RETRY_BASE * 2, ... até RETRY_MAX).
+#
+# A extração precisa do pacote pypdf (pip install pypdf); sem ele o worker
+# avisa no log e não sincroniza.
+
+CHUNK_CHARS = int(os.getenv("KNOWLEDGE_CHUNK_CHARS", "1200"))
+CHUNK_OVERLAP = int(os.getenv("KNOWLEDGE_CHUNK_OVERLAP", "200"))
+SYNC_INTERVAL = float(os.getenv("KNOWLEDGE_SYNC_INTERVAL", "900"))
+MAX_WORKERS = int(os.getenv("KNOWLEDGE_WORKERS", "0")) or None
+SYNC_WINDOW = int(os.getenv("KNOWLEDGE_SYNC_WINDOW", "4"))
+RETRY_BASE = float(os.getenv("KNOWLEDGE_RETRY_BASE", "900"))
+RETRY_MAX = float(os.getenv("KNOWLEDGE_RETRY_MAX", "86400"))
+MAX_CONTEXT_CHUNKS = 4
+
+_TERM_RE = re.compile(r"\w{3,}", re.UNICODE)
+
+
+def init_knowledge_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS knowledge_files (
+            file_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            web_link TEXT,
+            md5 TEXT,
+            modified_time TEXT,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            synced_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(knowledge_files)")
+    columns = [c[1] for c in cursor.fetchall()]
+    if "attempts" not in columns:
+        cursor.execute("ALTER TABLE knowledge_files ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    if "last_attempt_at" not in columns:
+        cursor.execute("ALTER TABLE knowledge_files ADD COLUMN last_attempt_at REAL")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS knowledge_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            start_offset INTEGER NOT NULL,
+            end_offset INTEGER NOT NULL,
+            text TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_chunks_file ON knowledge_chunks (file_id, start_offset)")
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_chunks_fts USING fts5(
+            text,
+            content='knowledge_chunks',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS knowledge_chunks_fts_ai AFTER INSERT ON knowledge_chunks BEGIN
+            INSERT INTO knowledge_chunks_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS knowledge_chunks_fts_ad AFTER DELETE ON knowledge_chunks BEGIN
+            INSERT INTO knowledge_chunks_fts (knowledge_chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+
+
+def pdf_support():
+    """True se o pypdf está instalado."""
+    return importlib.util.find_spec("pypdf") is not None
+
+
+def extract_pdf_pages(data):
+    """Texto de cada página do PDF (roda no pool de processos). Requer pypdf."""
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    return [(page.extract_text() or "") for page in reader.pages]
+
+
+def chunk_pages(pages, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """Divide o texto em trechos [(página, início, fim, texto)].
+
+    Os offsets são posições no texto do documento inteiro (páginas unidas
+    por '\\n'), e os cortes caem em espaço sempre que possível.
+    """
+    chunks = []
+    base = 0
+    for page_no, text in enumerate(pages, start=1):
+        pos = 0
+        while pos < len(text):
+            end = min(len(text), pos + size)
+            if end < len(text):
+                cut = text.rfind(" ", pos + size // 2, end)
+                if cut > pos:
+                    end = cut
+            piece = text[pos:end].strip()
+            if piece:
+                chunks.append((page_no, base + pos, base + end, piece))
+            if end >= len(text):
+                break
+            pos = max(end - overlap, pos + 1)
+        base += len(text) + 1
+    return chunks
+
+
+def retry_delay(attempts):
+    return min(RETRY_MAX, RETRY_BASE * (2 ** max(0, attempts - 1)))
+
+
+def _changed(known, f, now):
+    if not known:
+        return True
+    md5, modified, error, attempts, last_attempt_at = known
+    if error:
+        return now >= (last_attempt_at or 0) + retry_delay(attempts)
+    if f.get("md5Checksum") and md5:
+        return f["md5Checksum"] != md5
+    return f.get("modifiedTime") != modified
+
+
+def _record_failure(conn, f, error, now):
+    # Mantém os trechos da versão anterior; o arquivo volta a ser tentado depois do backoff
+    logger.warning(f"Falha ao extrair texto de {f.get('name')}: {error}")
+    conn.execute('''
+        INSERT INTO knowledge_files (file_id, name, web_link, error, attempts, last_attempt_at)
+        VALUES (?, ?, ?, ?, 1, ?)
+        ON CONFLICT (file_id) DO UPDATE SET
+            error = excluded.error, attempts = attempts + 1, last_attempt_at = excluded.last_attempt_at
+    ''', (f["id"], f.get("name") or "", f.get("webViewLink"), str(error)[:500], now))
+    conn.commit()
+
+
+def _store_chunks(conn, f, chunks):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM knowledge_chunks WHERE file_id = ?", (f["id"],))
+    cursor.executemany('''
+        INSERT INTO knowledge_chunks (file_id, page, start_offset, end_offset, text)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(f["id"], *c) for c in chunks])
+    cursor.execute('''
+        INSERT INTO knowledge_files (file_id, name, web_link, md5, modified_time, chunks, error, synced_at)
+        VALUES (?, ?, ?, ?, ?, ?, NULL, CURRENT_TIMESTAMP)
+        ON CONFLICT (file_id) DO UPDATE SET
+            name = excluded.name, web_link = excluded.web_link, md5 = excluded.md5,
+            modified_time = excluded.modified_time, chunks = excluded.chunks,
+            error = NULL, attempts = 0, last_attempt_at = NULL, synced_at = CURRENT_TIMESTAMP
+    ''', (f["id"], f.get("name") or "", f.get("webViewLink"), f.get("md5Checksum"),
+          f.get("modifiedTime"), len(chunks)))
+    conn.commit()
+
+
+def sync_folder(conn, google_service, folder_id, executor=None, now=None):
+    """Sincroniza a pasta do Drive com knowledge_files/knowledge_chunks.
+
+    Retorna {"updated": n, "removed": n, "unchanged": n, "failed": n}; os
+    arquivos em backoff contam como unchanged.
+    """
+    now = now or time.time()
+    files = google_service.list_folder_pdfs(folder_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT file_id, md5, modified_time, error, attempts, last_attempt_at FROM knowledge_files")
+    known = {r[0]: r[1:] for r in cursor.fetchall()}
+    stats = {"updated": 0, "removed": 0, "unchanged": 0, "failed": 0}
+
+    current = {f["id"] for f in files}
+    for file_id in set(known) - current:
+        cursor.execute("DELETE FROM knowledge_chunks WHERE file_id = ?", (file_id,))
+        cursor.execute("DELETE FROM knowledge_files WHERE file_id = ?", (file_id,))
+        stats["removed"] += 1
+    conn.commit()
+
+    pending = [f for f in files if _changed(known.get(f["id"]), f, now)]
+    stats["unchanged"] = len(files) - len(pending)
+    if not pending:
+        return stats
+
+    own_executor = executor is None
+    executor = executor or ProcessPoolExecutor(
+        max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for i in range(0, len(pending), SYNC_WINDOW):
+            # Download em sequência (I/O e um cliente por thread); a extração vai
+            # para o pool. Só uma janela de PDFs fica na memória por vez.
+            futures = []
+            for f in pending[i:i + SYNC_WINDOW]:
+                try:
+                    futures.append((f, executor.submit(extract_pdf_pages, google_service.download_file(f["id"]))))
+                except Exception as e:
+                    futures.append((f, e))
+            for f, future in futures:
+                try:
+                    if isinstance(future, Exception):
+                        raise future
+                    chunks = chunk_pages(future.result())
+                except Exception as e:
+                    _record_failure(conn, f, e, now)
+                    stats["failed"] += 1
+                    continue
+                _store_chunks(conn, f, chunks)
+                stats["updated"] += 1
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return stats
+
+
+def list_documents(cursor):
+    cursor.execute("SELECT name, web_link FROM knowledge_files ORDER BY name")
+    return [{"name": r[0], "webViewLink": r[1]} for r in cursor.fetchall()]
+
+
+def search_chunks(cursor, text, limit=MAX_CONTEXT_CHUNKS):
+    """Trechos mais relevantes para a pergunta (qualquer termo com 3+ letras casa)."""
+    terms = _TERM_RE.findall(text or "")
+    if not terms:
+        return []
+    match = " OR ".join(f'"{t}"' for t in dict.fromkeys(t.lower() for t in terms))
+    cursor.execute('''
+        SELECT f.name, f.web_link, c.page, c.start_offset, c.end_offset, c.text
+        FROM knowledge_chunks_fts s
+        JOIN knowledge_chunks c ON c.id = s.rowid
+        JOIN knowledge_files f ON f.file_id = c.file_id
+        WHERE knowledge_chunks_fts MATCH ?
+        ORDER BY s.rank
+        LIMIT ?
+    ''', (match, limit))
+    return [
+        {"name": r[0], "link": r[1], "page": r[2], "start": r[3], "end": r[4], "text": r[5]}
+        for r in cursor.fetchall()
+    ]
+
+
+def format_chunks_for_prompt(chunks):
+    return "\n\n".join(f"({c['name']}, p. {c['page']})\n{c['text']}" for c in chunks)
+
+
+class KnowledgeSyncWorker:
+    """Roda sync_folder() em segundo plano a cada SYNC_INTERVAL segundos."""
+
+    def __init__(self, db_path_getter, google_service_getter, folder_id_getter):
+        self._db_path_getter = db_path_getter
+        self._google_service_getter = google_service_getter
+        self._folder_id_getter = folder_id_getter
+        self._stop = threading.Event()
+        self._thread = None
+        self._warned = False
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="knowledge-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sync_once(self):
+        service = self._google_service_getter()
+        folder_id = self._folder_id_getter()
+        if not service or not folder_id:
+            return None
+        if not pdf_support():
+            if not self._warned:
+                logger.warning("pypdf não está instalado (pip install pypdf); os PDFs do Drive não serão indexados")
+                self._warned = True
+            return None
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            stats = sync_folder(conn, service, folder_id)
+        if stats["updated"] or stats["removed"] or stats["failed"]:
+            logger.info(f"Sync dos PDFs do Drive: {stats}")
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                logger.error(f"Erro no sync dos PDFs do Drive: {e}")
+            self._stop.wait(SYNC_INTERVAL)
@@ -0,0 +1,134 @@
+import base64
+import csv
+import datetime
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Consultas de patient_leads com paginação por cursor (keyset) em
+# (created_at, id). Os índices idx_patient_leads_created e
+# idx_patient_leads_source_created (rollup_service) cobrem a ordenação e o
+# filtro por origem, então cada página custa o mesmo, seja a primeira ou a
+# milésima.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+LEAD_COLUMNS = ("id", "created_at", "name", "phone", "status", "source", "medium", "campaign", "interest")
+
+FILTER_PARAMS = ("source", "status", "campaign", "interest", "from", "to")
+
+
+def encode_cursor(created_at, lead_id):
+    raw = f"{created_at}|{lead_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """Decodifica o cursor opaco devolvido em next_cursor. Levanta ValueError se inválido."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created_at, lead_id = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").rsplit("|", 1)
+        return created_at, int(lead_id)
+    except Exception:
+        raise ValueError("cursor inválido")
+
+
+def parse_filters(args):
+    """Extrai e valida os filtros da query string (source, status, campaign, interest, from, to)."""
+    filters = {}
+    for name in ("source", "status", "campaign", "interest"):
+        value = (args.get(name) or "").strip()
+        if value:
+            filters[name] = value
+    for name in ("from", "to"):
+        value = (args.get(name) or "").strip()
+        if value:
+            try:
+                filters[name] = datetime.date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Parâmetro '{name}' inválido, use YYYY-MM-DD")
+    return filters
+
+
+def parse_limit(value):
+    if value in (None, ""):
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("limit deve ser um número inteiro")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _where(filters, cursor_key=None):
+    # Leads mesclados (mesmo telefone) aparecem só pelo lead canônico
+    clauses = ["merged_into IS NULL"]
+    params = []
+    if "source" in filters:
+        clauses.append("LOWER(COALESCE(source, '')) = ?")
+        params.append(filters["source"].lower())
+    if "status" in filters:
+        clauses.append("LOWER(COALESCE(status, '')) LIKE ?")
+        params.append(filters["status"].lower() + "%")
+    if "campaign" in filters:
+        clauses.append("LOWER(COALESCE(campaign, '')) = ?")
+        params.append(filters["campaign"].lower())
+    if "interest" in filters:
+        clauses.append("LOWER(COALESCE(interest, '')) LIKE ?")
+        params.append("%" + filters["interest"].lower() + "%")
+    if "from" in filters:
+        clauses.append("created_at >= ?")
+        params.append(filters["from"].isoformat())
+    if "to" in filters:
+        clauses.append("created_at < ?")
+        params.append((filters["to"] + datetime.timedelta(days=1)).isoformat())
+    if cursor_key is not None:
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(cursor_key)
+    sql = " WHERE " + " AND ".join(clauses)
+    return sql, params
+
+
+def iter_leads(cursor, filters, cursor_key=None, limit=None):
+    """Itera os leads do mais novo para o mais antigo sem materializar a lista."""
+    where, params = _where(filters, cursor_key)
+    sql = f"SELECT {', '.join(LEAD_COLUMNS)} FROM patient_leads{where} ORDER BY created_at DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    cursor.execute(sql, params)
+    for row in cursor:
+        yield dict(zip(LEAD_COLUMNS, row))
+
+
+def fetch_page(cursor, filters, cursor_token=None, limit=DEFAULT_PAGE_SIZE):
+    """Devolve (leads, next_cursor) para uma página. next_cursor é None na última página."""
+    cursor_key = decode_cursor(cursor_token) if cursor_token else None
+    # Busca um a mais para saber se existe próxima página
+    leads = list(iter_leads(cursor, filters, cursor_key, limit + 1))
+    next_cursor = None
+    if len(leads) > limit:
+        leads = leads[:limit]
+        last = leads[-1]
+        next_cursor = encode_cursor(last["created_at"], last["id"])
+    return leads, next_cursor
+
+
+def stream_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(LEAD_COLUMNS)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([row[c] if row[c] is not None else "" for c in LEAD_COLUMNS])
+        yield buffer.getvalue()
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
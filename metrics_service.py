@@ -0,0 +1,94 @@
+import os
+import json
+
+# Eventos do funil (SESSION_START, LEAD_CONVERTED, APPOINTMENT_SCHEDULED...)
+# enviados em lotes pelo bot do terminal (vizo_bot.MetricsLogger) e pelo chat
+# web (VizoMetrics em chat.html) para POST /api/metrics. Cada lote entra com
+# um único executemany numa transação curta; a tabela só tem o índice usado
+# pela retenção, para a escrita continuar barata com volume alto.
+
+MAX_BATCH = int(os.getenv("METRICS_MAX_BATCH", "500"))
+MAX_DETAILS_BYTES = int(os.getenv("METRICS_MAX_DETAILS_BYTES", "4096"))
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+def init_metrics_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS funnel_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            event TEXT NOT NULL,
+            source TEXT,
+            occurred_at TEXT,
+            details TEXT,
+            received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_funnel_events_received ON funnel_events (received_at)")
+
+
+def _row(item, client):
+    if not isinstance(item, dict):
+        return None
+    event = item.get("event")
+    if not isinstance(event, str) or not event.strip() or len(event) > 64:
+        return None
+    details = item.get("details") or {}
+    if not isinstance(details, dict):
+        return None
+    details_json = json.dumps(details, ensure_ascii=False)
+    if len(details_json.encode("utf-8")) > MAX_DETAILS_BYTES:
+        return None
+    session_id = item.get("session_id") or item.get("sessionId")
+    source = details.get("source") or client
+    return (
+        str(session_id)[:100] if session_id else None,
+        event.strip().upper(),
+        str(source)[:100] if source else None,
+        str(item.get("timestamp") or "")[:40] or None,
+        details_json,
+    )
+
+
+def parse_batch(data, client=None):
+    """Valida um lote: {"events": [...]}, uma lista ou um evento solto (formato antigo).
+
+    Retorna (linhas, rejeitados). Eventos inválidos são descartados um a um;
+    levanta InvalidBatch se o corpo não for um lote ou passar de MAX_BATCH.
+    """
+    if isinstance(data, dict) and "events" in data:
+        items = data["events"]
+        client = client or data.get("client")
+    elif isinstance(data, dict):
+        items = [data]
+    else:
+        items = data
+    if not isinstance(items, list) or not items:
+        raise InvalidBatch("Envie {\"events\": [...]} com pelo menos um evento")
+    if len(items) > MAX_BATCH:
+        raise InvalidBatch(f"Lote com {len(items)} eventos; o máximo é {MAX_BATCH}")
+    rows = [r for r in (_row(item, client) for item in items) if r]
+    return rows, len(items) - len(rows)
+
+
+def insert_events(cursor, rows):
+    """Grava as linhas de parse_batch() (sem commit). Retorna quantas entraram."""
+    cursor.executemany('''
+        INSERT INTO funnel_events (session_id, event, source, occurred_at, details)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+
+def event_counts(cursor, since=None):
+    """{evento: total} desde `since` (YYYY-MM-DD), ou de todo o período."""
+    if since:
+        cursor.execute(
+            "SELECT event, COUNT(*) FROM funnel_events WHERE received_at >= ? GROUP BY event", (since,)
+        )
+    else:
+        cursor.execute("SELECT event, COUNT(*) FROM funnel_events GROUP BY event")
+    return dict(cursor.fetchall())
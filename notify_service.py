@@ -0,0 +1,51 @@
+import threading
+import time
+import zlib
+
+
+class Notifier:
+    """Avisa, dentro do processo, que um tópico (ex.: uma sessão de chat) mudou.
+
+    Quem espera pega um token com `token(topic)`, consulta o banco e, se não
+    houver nada novo, chama `wait(topic, token, timeout)`. Como o token é lido
+    antes da consulta, uma escrita que aconteça no meio do caminho não se
+    perde. Os tópicos são distribuídos em um número fixo de slots, então a
+    memória não cresce com o número de sessões; colisões só causam um
+    despertar extra, e quem acorda sempre consulta o banco de novo.
+    """
+
+    def __init__(self, slots=256):
+        self._slots = slots
+        self._versions = [0] * slots
+        self._conds = [threading.Condition() for _ in range(slots)]
+
+    def _slot(self, topic):
+        return zlib.crc32(str(topic).encode("utf-8")) % self._slots
+
+    def token(self, topic):
+        i = self._slot(topic)
+        with self._conds[i]:
+            return self._versions[i]
+
+    def notify(self, topic):
+        i = self._slot(topic)
+        cond = self._conds[i]
+        with cond:
+            self._versions[i] += 1
+            cond.notify_all()
+
+    def wait(self, topic, token, timeout):
+        """Bloqueia até o tópico mudar depois de `token` ou até `timeout` segundos.
+
+        Retorna True se houve notificação.
+        """
+        i = self._slot(topic)
+        cond = self._conds[i]
+        deadline = time.monotonic() + timeout
+        with cond:
+            while self._versions[i] == token:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                cond.wait(remaining)
+            return True
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+import logging
+
+import sheets_mirror_service
+
+logger = logging.getLogger(__name__)
+
+# Outbox de escritas no Google Sheets. Os endpoints gravam a linha em
+# sheets_outbox (de preferência na mesma transação da escrita local) e
+# respondem na hora; o SheetsOutboxWorker junta as linhas pendentes por
+# planilha/intervalo e manda cada grupo em um único values.append.
+
+MAX_BATCH_ROWS = int(os.getenv("SHEETS_OUTBOX_BATCH", "500"))
+MAX_ATTEMPTS = int(os.getenv("SHEETS_OUTBOX_MAX_ATTEMPTS", "10"))
+BASE_BACKOFF = float(os.getenv("SHEETS_OUTBOX_BACKOFF", "2"))
+MAX_BACKOFF = float(os.getenv("SHEETS_OUTBOX_MAX_BACKOFF", "900"))
+# Cota padrão do Sheets: 60 escritas/min por usuário -> 1 chamada por segundo
+MIN_CALL_INTERVAL = float(os.getenv("SHEETS_MIN_INTERVAL", "1.0"))
+SENT_RETENTION_SECONDS = 7 * 24 * 3600
+# Linha em 'sending' há mais que isso: o processo caiu no meio do envio
+STALE_CLAIM_SECONDS = float(os.getenv("SHEETS_OUTBOX_STALE_SECONDS", "300"))
+
+
+def init_outbox_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sheets_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spreadsheet_id TEXT NOT NULL,
+            sheet_range TEXT NOT NULL,
+            row_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at REAL
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(sheets_outbox)")
+    if "claimed_at" not in [c[1] for c in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE sheets_outbox ADD COLUMN claimed_at REAL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheets_outbox_due ON sheets_outbox (status, next_attempt_at, id)")
+
+
+def enqueue_row(cursor, spreadsheet_id, row, sheet_range="A1"):
+    """Registra uma linha para o Sheets usando o cursor (e a transação) de quem chama.
+
+    As células também entram no espelho local, para check de usuário não
+    depender do envio.
+    """
+    sheets_mirror_service.record_row(cursor, spreadsheet_id, row)
+    cursor.execute(
+        "INSERT INTO sheets_outbox (spreadsheet_id, sheet_range, row_json) VALUES (?, ?, ?)",
+        (spreadsheet_id, sheet_range, json.dumps(["" if v is None else v for v in row], ensure_ascii=False))
+    )
+    return cursor.lastrowid
+
+
+def backlog(cursor):
+    """Resumo da fila para monitoramento."""
+    cursor.execute('''
+        SELECT status, COUNT(*), MIN(created_at)
+        FROM sheets_outbox
+        GROUP BY status
+    ''')
+    stats = {"pending": 0, "failed": 0, "sent": 0, "oldest_pending": None}
+    for status, count, oldest in cursor.fetchall():
+        stats[status] = count
+        if status == 'pending':
+            stats["oldest_pending"] = oldest
+    cursor.execute("SELECT COUNT(*) FROM sheets_outbox WHERE status = 'pending' AND attempts > 0")
+    stats["retrying"] = cursor.fetchone()[0]
+    return stats
+
+
+def _backoff(attempts):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** max(0, attempts - 1)))
+    return delay * (0.5 + random.random() / 2)
+
+
+def _http_status(error):
+    resp = getattr(error, "resp", None)
+    try:
+        return int(getattr(resp, "status", None))
+    except (TypeError, ValueError):
+        return None
+
+
+class SheetsOutboxWorker:
+    """Esvazia sheets_outbox em segundo plano, em lotes por planilha/intervalo."""
+
+    def __init__(self, db_path_getter, google_service_getter):
+        self._db_path_getter = db_path_getter
+        self._google_service_getter = google_service_getter
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_call = 0.0
+        self._quota_until = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sheets-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Avisa que há linhas novas (chamar depois do commit)."""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.drain_once()
+            except Exception as e:
+                logger.error(f"Erro no worker do outbox do Sheets: {e}")
+                delay = 30
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def _throttle(self):
+        wait = max(self._last_call + MIN_CALL_INTERVAL, self._quota_until) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_call = time.time()
+
+    def drain_once(self):
+        """Envia um lote de linhas vencidas. Retorna quantos segundos esperar até a próxima rodada."""
+        service = self._google_service_getter()
+        if not service:
+            return 60
+        now = time.time()
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            cursor = conn.cursor()
+            # Pega o lote num UPDATE só: outro processo (ou o reloader) nunca
+            # manda as mesmas linhas
+            cursor.execute('''
+                UPDATE sheets_outbox SET status = 'sending', claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM sheets_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= ?)
+                       OR (status = 'sending' AND claimed_at < ?)
+                    ORDER BY id ASC
+                    LIMIT ?
+                )
+                RETURNING id, spreadsheet_id, sheet_range, row_json, attempts
+            ''', (now, now, now - STALE_CLAIM_SECONDS, MAX_BATCH_ROWS))
+            due = sorted(cursor.fetchall())
+            conn.commit()
+            if not due:
+                cursor.execute("DELETE FROM sheets_outbox WHERE status = 'sent' AND sent_at < ?", (now - SENT_RETENTION_SECONDS,))
+                cursor.execute("SELECT MIN(next_attempt_at) FROM sheets_outbox WHERE status = 'pending'")
+                next_at = cursor.fetchone()[0]
+                conn.commit()
+                return max(1.0, next_at - now) if next_at else 300
+
+            groups = {}
+            for row_id, spreadsheet_id, sheet_range, row_json, attempts in due:
+                groups.setdefault((spreadsheet_id, sheet_range), []).append((row_id, json.loads(row_json), attempts))
+
+            for (spreadsheet_id, sheet_range), items in groups.items():
+                self._throttle()
+                ids = [i[0] for i in items]
+                try:
+                    service.append_rows(spreadsheet_id, [i[1] for i in items], sheet_range)
+                except Exception as e:
+                    status = _http_status(e)
+                    if status == 429:
+                        self._quota_until = time.time() + 60
+                    logger.warning(f"Falha ao enviar {len(ids)} linha(s) ao Sheets ({status or e}); nova tentativa agendada")
+                    for row_id, _, attempts in items:
+                        attempts += 1
+                        final = attempts >= MAX_ATTEMPTS or status in (400, 403, 404)
+                        cursor.execute('''
+                            UPDATE sheets_outbox
+                            SET attempts = ?, next_attempt_at = ?, last_error = ?, status = ?
+                            WHERE id = ?
+                        ''', (attempts, time.time() + _backoff(attempts), str(e)[:500],
+                              'failed' if final else 'pending', row_id))
+                else:
+                    cursor.executemany(
+                        "UPDATE sheets_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                        [(time.time(), row_id) for row_id in ids]
+                    )
+                conn.commit()
+        return 0 if len(due) == MAX_BATCH_ROWS else 1
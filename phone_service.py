@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+import rollup_service
+import whatsapp_service
+
+logger = logging.getLogger(__name__)
+
+# Telefone canônico dos leads. patient_leads.phone guarda o que o paciente
+# digitou ("96 99160-3396", "5596991603396", ...); phone_e164 guarda a forma
+# E.164 ("+5596991603396"), gravada na inserção e preenchida em lotes para as
+# linhas antigas ('' quando o número não é válido). O índice parcial sobre
+# phone_e164 dos leads não mesclados faz da busca por telefone uma consulta
+# pontual, sem varrer a tabela.
+#
+# O merge junta leads com o mesmo telefone: o mais antigo fica como lead
+# canônico e os outros recebem merged_into = id dele. As linhas mescladas
+# não são apagadas, então origem/mídia/campanha de cada contato continuam
+# disponíveis (attribution_history) e o rollup diário não muda. Quando a
+# retenção arquiva o canônico, promote_survivors passa o posto ao contato
+# mais novo do grupo.
+
+BACKFILL_BATCH = int(os.getenv("PHONE_BACKFILL_BATCH", "500"))
+BATCH_PAUSE = float(os.getenv("PHONE_BACKFILL_PAUSE", "0.05"))
+MAINTENANCE_INTERVAL = float(os.getenv("PHONE_MAINTENANCE_INTERVAL", "3600"))
+
+
+def init_phone_tables(cursor):
+    cursor.execute("PRAGMA table_info(patient_leads)")
+    cols = [c[1] for c in cursor.fetchall()]
+    if "phone_e164" not in cols:
+        cursor.execute("ALTER TABLE patient_leads ADD COLUMN phone_e164 TEXT")
+    if "merged_into" not in cols:
+        cursor.execute("ALTER TABLE patient_leads ADD COLUMN merged_into INTEGER")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_patient_leads_phone
+        ON patient_leads (phone_e164, id) WHERE merged_into IS NULL
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_leads_merged ON patient_leads (merged_into) WHERE merged_into IS NOT NULL")
+
+
+def to_e164(phone):
+    """'+5596991603396' a partir de qualquer formato; '' se não parecer um celular/fixo brasileiro."""
+    digits = whatsapp_service.normalize_phone(phone)
+    # 55 + DDD + 8 ou 9 dígitos
+    if len(digits) not in (12, 13):
+        return ""
+    return "+" + digits
+
+
+def backfill_batch(conn, limit=BACKFILL_BATCH):
+    """Preenche phone_e164 de um lote de leads antigos. Retorna quantas linhas foram atualizadas."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, phone FROM patient_leads
+        WHERE phone_e164 IS NULL AND merged_into IS NULL
+        ORDER BY id ASC
+        LIMIT ?
+    ''', (limit,))
+    rows = cursor.fetchall()
+    cursor.executemany(
+        "UPDATE patient_leads SET phone_e164 = ? WHERE id = ?",
+        [(to_e164(phone), lead_id) for lead_id, phone in rows]
+    )
+    conn.commit()
+    return len(rows)
+
+
+def backfill(conn, pause=BATCH_PAUSE, stop_event=None):
+    """Roda backfill_batch() até acabar, com pausas curtas entre as transações."""
+    total = 0
+    while not (stop_event and stop_event.is_set()):
+        done = backfill_batch(conn)
+        total += done
+        if done < BACKFILL_BATCH:
+            break
+        time.sleep(pause)
+    return total
+
+
+def merge_phone(cursor, phone_e164):
+    """Junta os leads não mesclados com este telefone no mais antigo (sem commit).
+
+    O lead canônico herda o status e o nome mais recentes e o consentimento
+    de qualquer um deles. Retorna o id canônico, ou None se não havia duplicados.
+    """
+    cursor.execute('''
+        SELECT id, name, status, consent FROM patient_leads
+        WHERE phone_e164 = ? AND merged_into IS NULL
+        ORDER BY id ASC
+    ''', (phone_e164,))
+    leads = cursor.fetchall()
+    if len(leads) < 2:
+        return None
+    canonical = leads[0][0]
+    latest_name = next((l[1] for l in reversed(leads) if l[1]), None)
+    latest_status = next((l[2] for l in reversed(leads) if l[2]), None)
+    consent = max(l[3] or 0 for l in leads)
+    cursor.executemany(
+        "UPDATE patient_leads SET merged_into = ? WHERE id = ?",
+        [(canonical, l[0]) for l in leads[1:]]
+    )
+    cursor.execute(
+        "UPDATE patient_leads SET name = COALESCE(?, name), consent = ? WHERE id = ?",
+        (latest_name, consent, canonical)
+    )
+    if latest_status and latest_status != leads[0][2]:
+        rollup_service.update_lead_status(cursor, canonical, latest_status)
+    return canonical
+
+
+def promote_survivors(cursor, rows):
+    """Antes da retenção apagar `rows` (dicts de patient_leads): o contato mais novo de cada grupo vira o canônico.
+
+    Sem isso, os leads mesclados num canônico arquivado ficariam apontando
+    para um id que não existe mais e sumiriam das buscas e campanhas. O
+    herdeiro recebe o nome, o status e o consentimento do canônico.
+    """
+    leaving = [r["id"] for r in rows]
+    placeholders = ", ".join("?" for _ in leaving)
+    promoted = 0
+    for r in rows:
+        if r.get("merged_into") is not None:
+            continue
+        cursor.execute(f'''
+            SELECT id, status FROM patient_leads
+            WHERE merged_into = ? AND id NOT IN ({placeholders})
+            ORDER BY id DESC LIMIT 1
+        ''', [r["id"]] + leaving)
+        heir = cursor.fetchone()
+        if not heir:
+            continue
+        cursor.execute(
+            "UPDATE patient_leads SET merged_into = NULL, name = COALESCE(?, name), consent = MAX(consent, ?) WHERE id = ?",
+            (r.get("name"), r.get("consent") or 0, heir[0])
+        )
+        cursor.execute(
+            f"UPDATE patient_leads SET merged_into = ? WHERE merged_into = ? AND id NOT IN ({placeholders})",
+            [heir[0], r["id"]] + leaving
+        )
+        if r.get("status") and r["status"] != heir[1]:
+            rollup_service.update_lead_status(cursor, heir[0], r["status"])
+        promoted += 1
+    return promoted
+
+
+def merge_duplicates(conn, stop_event=None):
+    """Mescla todos os grupos de leads com o mesmo telefone. Uma transação por telefone."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT phone_e164 FROM patient_leads
+        WHERE merged_into IS NULL AND phone_e164 > ''
+        GROUP BY phone_e164
+        HAVING COUNT(*) > 1
+    ''')
+    phones = [r[0] for r in cursor.fetchall()]
+    merged = 0
+    for phone in phones:
+        if stop_event and stop_event.is_set():
+            break
+        if merge_phone(cursor, phone):
+            merged += 1
+        conn.commit()
+    return merged
+
+
+def find_lead(cursor, phone):
+    """Lead canônico do telefone (qualquer formato), ou None. Usa só o índice de phone_e164."""
+    phone_e164 = to_e164(phone)
+    if not phone_e164:
+        return None
+    cursor.execute('''
+        SELECT id, created_at, name, phone, status, source, medium, campaign, interest, consent
+        FROM patient_leads
+        WHERE phone_e164 = ? AND merged_into IS NULL
+        ORDER BY id ASC
+        LIMIT 1
+    ''', (phone_e164,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    keys = ("id", "created_at", "name", "phone", "status", "source", "medium", "campaign", "interest", "consent")
+    return dict(zip(keys, row))
+
+
+def attribution_history(cursor, lead_id):
+    """Todos os contatos (o lead e os mesclados nele), do mais antigo para o mais novo."""
+    cursor.execute('''
+        SELECT id, created_at, source, medium, campaign, interest, status
+        FROM patient_leads
+        WHERE id = ? OR merged_into = ?
+        ORDER BY created_at ASC, id ASC
+    ''', (lead_id, lead_id))
+    keys = ("id", "created_at", "source", "medium", "campaign", "interest", "status")
+    return [dict(zip(keys, r)) for r in cursor.fetchall()]
+
+
+def run_maintenance(db_path, stop_event=None):
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        filled = backfill(conn, stop_event=stop_event)
+        merged = merge_duplicates(conn, stop_event=stop_event)
+    if filled or merged:
+        logger.info(f"Telefones de leads: {filled} normalizados, {merged} grupos mesclados")
+    return {"backfilled": filled, "merged": merged}
+
+
+class PhoneMaintenanceWorker:
+    """Roda o backfill de phone_e164 e o merge de duplicados a cada MAINTENANCE_INTERVAL segundos."""
+
+    def __init__(self, db_path_getter):
+        self._db_path_getter = db_path_getter
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="phone-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_maintenance(self._db_path_getter(), stop_event=self._stop)
+            except Exception as e:
+                logger.error(f"Erro na manutenção de telefones dos leads: {e}")
+            self._stop.wait(MAINTENANCE_INTERVAL)
@@ -0,0 +1,224 @@
+import os
+import time
+import heapq
+import sqlite3
+import datetime
+import threading
+import logging
+
+import whatsapp_service
+from availability_service import CLINIC_TZ
+
+logger = logging.getLogger(__name__)
+
+# Lembretes de consulta (24 h e 2 h antes). Cada lembrete é uma linha em
+# appointment_reminders, indexada por due_at; o ReminderScheduler mantém em
+# memória um heap só com os lembretes que vencem nas próximas LOAD_HORIZON
+# horas e dorme até o primeiro deles, então dezenas de milhares de lembretes
+# agendados não pesam nem na memória nem em consultas periódicas.
+#
+# Ao subir, o scheduler carrega também os lembretes vencidos que ficaram
+# pendentes enquanto o servidor estava fora e os envia na hora, a menos que
+# a consulta já tenha passado. O envio é só um enqueue na whatsapp_outbox,
+# na mesma transação que marca o lembrete como enviado.
+
+REMINDER_OFFSETS = (("24h", 24 * 3600), ("2h", 2 * 3600))
+LOAD_HORIZON = float(os.getenv("REMINDER_LOAD_HORIZON", str(6 * 3600)))
+
+
+def init_reminder_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointment_reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            appointment_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            outbox_id INTEGER,
+            sent_at REAL,
+            UNIQUE (appointment_id, kind)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due ON appointment_reminders (status, due_at)")
+
+
+def _clinic_timestamp(start_at):
+    """Epoch de um horário de consulta; datetimes sem fuso são horário da clínica."""
+    if start_at.tzinfo is None:
+        start_at = start_at.replace(tzinfo=CLINIC_TZ)
+    return start_at.timestamp()
+
+
+def schedule_reminders(cursor, appointment_id, start_at, now=None):
+    """Agenda os lembretes da consulta (sem commit). Retorna [(id, due_at)].
+
+    `start_at` é o datetime da consulta no horário da clínica (independe do
+    fuso do servidor); lembretes cujo horário já passou (consulta marcada em
+    cima da hora) não são criados.
+    """
+    now = now or time.time()
+    start_ts = _clinic_timestamp(start_at)
+    scheduled = []
+    for kind, offset in REMINDER_OFFSETS:
+        due_at = start_ts - offset
+        if due_at <= now:
+            continue
+        cursor.execute('''
+            INSERT INTO appointment_reminders (appointment_id, kind, due_at) VALUES (?, ?, ?)
+            ON CONFLICT (appointment_id, kind) DO UPDATE SET due_at = excluded.due_at, status = 'pending'
+        ''', (appointment_id, kind, due_at))
+        cursor.execute(
+            "SELECT id FROM appointment_reminders WHERE appointment_id = ? AND kind = ?",
+            (appointment_id, kind)
+        )
+        scheduled.append((cursor.fetchone()[0], due_at))
+    return scheduled
+
+
+def reminder_text(kind, name, doctor, start_at):
+    start = datetime.datetime.strptime(start_at, "%Y-%m-%d %H:%M")
+    when = "amanhã" if kind == "24h" else "hoje"
+    return (
+        f"Olá{', ' + name if name else ''}! Lembrete da Pró-Visão Saúde Ocular Macapá: "
+        f"sua consulta com {doctor} é {when}, {start.strftime('%d/%m/%Y')} às {start.strftime('%H:%M')}. "
+        "Se não puder comparecer, responda esta mensagem para remarcar."
+    )
+
+
+class ReminderScheduler:
+    """Dispara os lembretes vencidos colocando-os na fila do WhatsApp.
+
+    `on_queued()` é chamado depois do commit quando algo entrou na fila
+    (para acordar o worker de envio).
+    """
+
+    def __init__(self, db_path_getter, on_queued=lambda: None, enabled_getter=lambda: True):
+        self._db_path_getter = db_path_getter
+        self._on_queued = on_queued
+        self._enabled_getter = enabled_getter
+        self._heap = []
+        self._in_heap = set()
+        self._loaded_until = 0.0
+        self._heap_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="appointment-reminders", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def add(self, scheduled):
+        """Avisa o scheduler de lembretes recém-agendados ([(id, due_at)], após o commit)."""
+        woke = False
+        with self._heap_lock:
+            for reminder_id, due_at in scheduled:
+                # Além do horizonte carregado: entra no próximo load(). Uma entrada
+                # antiga do mesmo id no heap é inofensiva (_fire confere status e due_at)
+                if due_at < self._loaded_until:
+                    heapq.heappush(self._heap, (due_at, reminder_id))
+                    self._in_heap.add(reminder_id)
+                    woke = woke or self._heap[0][1] == reminder_id
+        if woke:
+            self._wake.set()
+
+    def load(self, conn, now):
+        """Carrega no heap os pendentes que vencem até now + LOAD_HORIZON (inclusive os atrasados)."""
+        until = now + LOAD_HORIZON
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, due_at FROM appointment_reminders
+            WHERE status = 'pending' AND due_at < ?
+        ''', (until,))
+        rows = cursor.fetchall()
+        with self._heap_lock:
+            for reminder_id, due_at in rows:
+                if reminder_id not in self._in_heap:
+                    heapq.heappush(self._heap, (due_at, reminder_id))
+                    self._in_heap.add(reminder_id)
+            self._loaded_until = until
+        return len(rows)
+
+    def _pop_due(self, now):
+        due = []
+        with self._heap_lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, reminder_id = heapq.heappop(self._heap)
+                self._in_heap.discard(reminder_id)
+                due.append(reminder_id)
+        return due
+
+    def _fire(self, cursor, reminder_id, now):
+        """Enfileira um lembrete. Retorna o novo status ('sent'/'skipped') ou None se não estava pendente."""
+        cursor.execute('''
+            SELECT r.appointment_id, r.kind, r.due_at, a.name, a.phone, a.doctor, a.start_at, a.status
+            FROM appointment_reminders r
+            JOIN appointments a ON a.id = r.appointment_id
+            WHERE r.id = ? AND r.status = 'pending'
+        ''', (reminder_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        appointment_id, kind, due_at, name, phone, doctor, start_at, appt_status = row
+        if due_at > now:
+            # Reagendado depois de entrar no heap
+            return None
+        start_ts = _clinic_timestamp(datetime.datetime.strptime(start_at, "%Y-%m-%d %H:%M")) if start_at else 0
+        # Depois de uma parada longa, só o lembrete mais próximo da consulta é enviado
+        cursor.execute('''
+            SELECT 1 FROM appointment_reminders
+            WHERE appointment_id = ? AND status = 'pending' AND due_at > ? AND due_at <= ?
+        ''', (appointment_id, due_at, now))
+        superseded = cursor.fetchone() is not None
+        if appt_status != 'confirmed' or not phone or start_ts <= now or superseded:
+            cursor.execute("UPDATE appointment_reminders SET status = 'skipped' WHERE id = ?", (reminder_id,))
+            return 'skipped'
+        outbox_id = whatsapp_service.enqueue_message(
+            cursor, phone, reminder_text(kind, name, doctor, start_at), f"reminder-{appointment_id}-{kind}"
+        )
+        cursor.execute(
+            "UPDATE appointment_reminders SET status = 'sent', outbox_id = ?, sent_at = ? WHERE id = ?",
+            (outbox_id, now, reminder_id)
+        )
+        return 'sent'
+
+    def run_once(self, now=None):
+        """Dispara os vencidos. Retorna quantos segundos esperar até a próxima rodada."""
+        now = now or time.time()
+        if not self._enabled_getter():
+            return 300
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            if now >= self._loaded_until:
+                self.load(conn, now)
+            due = self._pop_due(now)
+            sent = 0
+            if due:
+                cursor = conn.cursor()
+                # Ordem pelo due_at: o 'superseded' vê o 2h ainda pendente ao tratar o 24h
+                sent = sum(1 for reminder_id in due if self._fire(cursor, reminder_id, now) == 'sent')
+                conn.commit()
+        if sent:
+            logger.info(f"{sent} lembrete(s) de consulta enfileirado(s)")
+            self._on_queued()
+        with self._heap_lock:
+            next_at = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+        return max(0.0, next_at - time.time())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.run_once()
+            except Exception as e:
+                logger.error(f"Erro no agendador de lembretes: {e}")
+                delay = 60
+            self._wake.wait(delay)
+            self._wake.clear()
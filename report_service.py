@@ -0,0 +1,206 @@
+import os
+import time
+import sqlite3
+import datetime
+import threading
+import logging
+
+import availability_service
+
+logger = logging.getLogger(__name__)
+
+# Relatório matinal. Os agendamentos feitos pelo app ficam na tabela local
+# appointments (indexada pela data da consulta) e os leads vêm de
+# patient_leads, então montar o relatório não depende do Sheets. Os dias são
+# do fuso da clínica (CLINIC_TZ). O texto enviado fica em daily_reports, um
+# por dia, gravado só pelo agendador; a leitura pela API não escreve no banco
+# (uma escrita mudaria o data_version e invalidaria o cache do dashboard).
+
+REPORT_TIME = os.getenv("MORNING_REPORT_TIME", "07:00")
+
+
+def init_report_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            start_at TEXT,
+            name TEXT,
+            phone TEXT,
+            doctor TEXT,
+            status TEXT NOT NULL DEFAULT 'confirmed',
+            calendar_link TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_appointments_start ON appointments (start_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_reports (
+            day TEXT PRIMARY KEY,
+            text TEXT,
+            built_at REAL,
+            sent_at REAL,
+            sent_to TEXT
+        )
+    ''')
+
+
+def record_appointment(cursor, name, phone, doctor, start_at=None, calendar_link=None):
+    """Grava um agendamento (start_at = datetime local ou None) e invalida o relatório do dia."""
+    start_s = start_at.strftime("%Y-%m-%d %H:%M") if start_at else None
+    cursor.execute('''
+        INSERT INTO appointments (start_at, name, phone, doctor, calendar_link)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (start_s, name, phone, doctor, calendar_link))
+    if start_s:
+        cursor.execute("UPDATE daily_reports SET text = NULL WHERE day = ?", (start_s[:10],))
+    return cursor.lastrowid
+
+
+def today():
+    """Data de hoje no fuso da clínica."""
+    return datetime.datetime.now(availability_service.CLINIC_TZ).date()
+
+
+def _utc_bound(day):
+    """Meia-noite local de `day` como texto UTC, no formato do CURRENT_TIMESTAMP."""
+    start = datetime.datetime.combine(day, datetime.time()).replace(tzinfo=availability_service.CLINIC_TZ)
+    return start.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _leads_on(cursor, day):
+    """Leads criados no dia local `day` e quantos já estão agendados/confirmados.
+
+    lead_daily_rollup agrupa por dia UTC, que corta o dia da clínica às
+    21h; aqui a contagem vem de patient_leads pelo índice de created_at.
+    """
+    cursor.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(LOWER(TRIM(COALESCE(status, ''))) LIKE 'agendado%'
+                         OR LOWER(TRIM(COALESCE(status, ''))) LIKE 'confirmado%'), 0)
+        FROM patient_leads
+        WHERE created_at >= ? AND created_at < ?
+    ''', (_utc_bound(day), _utc_bound(day + datetime.timedelta(days=1))))
+    return cursor.fetchone()
+
+
+def build_report(cursor, day):
+    """Monta o texto do relatório de `day` (date) a partir do banco local."""
+    day_s = day.isoformat()
+    cursor.execute('''
+        SELECT start_at, name, phone, doctor
+        FROM appointments
+        WHERE start_at >= ? AND start_at < ? AND status = 'confirmed'
+        ORDER BY start_at ASC, id ASC
+    ''', (day_s, (day + datetime.timedelta(days=1)).isoformat()))
+    appointments = cursor.fetchall()
+    leads, conversions = _leads_on(cursor, day - datetime.timedelta(days=1))
+
+    report = f"*Relatório Vizô - {day_s}*\n\n"
+    if appointments:
+        for start_at, name, phone, doctor in appointments:
+            report += f"📍 {start_at[11:16]} {name} - {doctor} ({phone})\n"
+    else:
+        report += "Nenhum agendamento encontrado para hoje.\n"
+    report += f"\nLeads de ontem: {leads} ({conversions} convertidos)"
+    return report
+
+
+def get_report(conn, day):
+    """Texto do relatório do dia, do cache quando possível. Não escreve no banco."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT text FROM daily_reports WHERE day = ?", (day.isoformat(),))
+    row = cursor.fetchone()
+    if row and row[0] is not None:
+        return row[0]
+    return build_report(cursor, day)
+
+
+def store_report(conn, day):
+    """Monta (ou reaproveita) o relatório do dia e grava em daily_reports."""
+    text = get_report(conn, day)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO daily_reports (day, text, built_at) VALUES (?, ?, ?)
+        ON CONFLICT (day) DO UPDATE SET text = excluded.text, built_at = excluded.built_at
+    ''', (day.isoformat(), text, time.time()))
+    conn.commit()
+    return text
+
+
+def _parse_time(value):
+    try:
+        hour, minute = value.split(":")
+        return datetime.time(int(hour), int(minute))
+    except (ValueError, AttributeError):
+        logger.warning(f"MORNING_REPORT_TIME inválido ({value!r}); usando 07:00")
+        return datetime.time(7, 0)
+
+
+class MorningReportScheduler:
+    """Monta e envia o relatório todo dia no horário configurado.
+
+    Se o servidor subir depois do horário e o relatório do dia ainda não
+    tiver sido enviado, envia na hora.
+    """
+
+    def __init__(self, db_path_getter, send_text, recipients_getter, at=None):
+        self._db_path_getter = db_path_getter
+        self._send_text = send_text
+        self._recipients_getter = recipients_getter
+        self.at = _parse_time(at or REPORT_TIME)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="morning-report", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self, now=None):
+        """Envia o relatório de hoje se já passou do horário e ele ainda não foi enviado."""
+        now = now or datetime.datetime.now(availability_service.CLINIC_TZ).replace(tzinfo=None)
+        if now.time() < self.at:
+            return False
+        day = now.date()
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            cursor = conn.cursor()
+            # Já enviado: não remonta o relatório a cada despertar
+            cursor.execute("SELECT sent_at FROM daily_reports WHERE day = ?", (day.isoformat(),))
+            row = cursor.fetchone()
+            if row and row[0]:
+                return False
+            text = store_report(conn, day)
+            sent_to = [p for p in self._recipients_getter() if self._send_text(p, text)]
+            if not sent_to:
+                logger.warning("Relatório matinal não foi entregue a nenhum destinatário")
+                return False
+            cursor.execute(
+                "UPDATE daily_reports SET sent_at = ?, sent_to = ? WHERE day = ?",
+                (time.time(), ",".join(sent_to), day.isoformat())
+            )
+            conn.commit()
+        logger.info(f"Relatório matinal de {day} enviado para {len(sent_to)} destinatário(s)")
+        return True
+
+    def _seconds_until_next(self, now=None):
+        now = now or datetime.datetime.now(availability_service.CLINIC_TZ).replace(tzinfo=None)
+        target = datetime.datetime.combine(now.date(), self.at)
+        if target <= now:
+            target += datetime.timedelta(days=1)
+        return (target - now).total_seconds()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                delay = self._seconds_until_next()
+            except Exception as e:
+                logger.error(f"Erro no relatório matinal: {e}")
+                delay = 300
+            # Acorda pelo menos a cada hora para tolerar ajustes de relógio
+            self._stop.wait(min(delay, 3600))
@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import gzip
+import hashlib
+import sqlite3
+import datetime
+import threading
+import time
+import logging
+from collections import namedtuple
+
+import phone_service
+
+logger = logging.getLogger(__name__)
+
+# Retenção LGPD: linhas mais antigas que o corte (padrão 6 meses, como no
+# README) saem do banco "quente" para arquivos mensais JSONL comprimidos em
+# ARCHIVE_DIR/<tabela>/<AAAA-MM>.jsonl.gz. Cada lote vira um membro gzip
+# separado e ganha uma linha no manifesto <AAAA-MM>.manifest.jsonl com o
+# SHA-256 dos bytes gravados, para auditoria e para o restore conferir a
+# integridade. Só depois do arquivo estar no disco o lote é apagado do
+# banco, em transações curtas.
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))
+ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "archives")
+BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "200"))
+
+# Como arquivar cada tabela: coluna de data do corte, o tipo dela ('text' =
+# DATETIME em UTC como o CURRENT_TIMESTAMP, 'epoch' = REAL em segundos), a
+# chave primária usada na ordem dos lotes e no DELETE e, opcionalmente, uma
+# função before_delete(cursor, rows) que roda na transação do DELETE.
+Retained = namedtuple("Retained", "date_col kind key before_delete", defaults=("text", ("id",), None))
+
+# Toda tabela nova com dados pessoais (telefone, nome, texto de mensagem)
+# precisa entrar aqui com a sua coluna de data.
+RETAINED_TABLES = {
+    "chat_logs": Retained("timestamp"),
+    "patient_leads": Retained("created_at", before_delete=phone_service.promote_survivors),
+    "funnel_events": Retained("received_at"),
+    "sheets_outbox": Retained("created_at"),
+    "appointments": Retained("created_at"),
+    "daily_reports": Retained("day", key=("day",)),
+    "booking_jobs": Retained("created_at"),
+    "whatsapp_outbox": Retained("created_at"),
+    "zapi_inbox": Retained("received_at", "epoch"),
+    "appointment_reminders": Retained("due_at", "epoch"),
+    "campaign_recipients": Retained("created_at", "epoch", ("campaign_id", "phone")),
+    "whatsapp_sessions": Retained("updated_at", "epoch", ("phone",)),
+    "handover_tickets": Retained("created_at", "epoch"),
+    "handover_events": Retained("at", "epoch"),
+    "chat_sessions": Retained("started_at", "epoch"),
+}
+
+
+def init_retention_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS retention_state (
+            table_name TEXT PRIMARY KEY,
+            archived_before TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def archived_before(cursor, table):
+    """Data (YYYY-MM-DD) antes da qual as linhas da tabela já foram arquivadas, ou None."""
+    cursor.execute("SELECT archived_before FROM retention_state WHERE table_name = ?", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def cutoff_date(days=None, today=None):
+    today = today or datetime.datetime.utcnow().date()
+    return today - datetime.timedelta(days=RETENTION_DAYS if days is None else days)
+
+
+def _archive_paths(archive_dir, table, month):
+    folder = os.path.join(archive_dir, table)
+    return (
+        os.path.join(folder, f"{month}.jsonl.gz"),
+        os.path.join(folder, f"{month}.manifest.jsonl"),
+    )
+
+
+def _key_value(row, key):
+    return row[key[0]] if len(key) == 1 else [row[k] for k in key]
+
+
+def _month(value, kind):
+    if value is None:
+        return "0000-00"
+    if kind == "epoch":
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime("%Y-%m")
+    return str(value)[:7]
+
+
+def _write_batch(archive_dir, table, month, rows, key=("id",)):
+    """Grava um lote como novo membro gzip e registra o checksum no manifesto."""
+    archive_path, manifest_path = _archive_paths(archive_dir, table, month)
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+    member = gzip.compress(payload)
+    with open(archive_path, "ab") as f:
+        offset = f.tell()
+        f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+    entry = {
+        "offset": offset,
+        "length": len(member),
+        "sha256": hashlib.sha256(member).hexdigest(),
+        "rows": len(rows),
+        "min_id": _key_value(rows[0], key),
+        "max_id": _key_value(rows[-1], key),
+        "archived_at": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+    }
+    with open(manifest_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def archive_table(db_path, table, cutoff, archive_dir=ARCHIVE_DIR, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, stop_event=None):
+    """Arquiva e apaga, em lotes, as linhas de `table` anteriores a `cutoff` (date).
+
+    Cada lote usa uma transação curta, então o servidor continua escrevendo
+    normalmente enquanto o job roda. Retorna quantas linhas foram movidas.
+    """
+    spec = RETAINED_TABLES[table]
+    cutoff_s = cutoff.isoformat()
+    if spec.kind == "epoch":
+        limit = datetime.datetime(cutoff.year, cutoff.month, cutoff.day, tzinfo=datetime.timezone.utc).timestamp()
+    else:
+        limit = cutoff_s
+    order = ", ".join(spec.key)
+    match = " AND ".join(f"{k} = ?" for k in spec.key)
+    moved = 0
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        init_retention_tables(cursor)
+        conn.commit()
+        while not (stop_event and stop_event.is_set()):
+            cursor.execute(
+                f"SELECT * FROM {table} WHERE {spec.date_col} < ? ORDER BY {order} LIMIT ?",
+                (limit, batch_size)
+            )
+            rows = [dict(r) for r in cursor.fetchall()]
+            if not rows:
+                break
+            by_month = {}
+            for r in rows:
+                by_month.setdefault(_month(r.get(spec.date_col), spec.kind), []).append(r)
+            for month, month_rows in by_month.items():
+                _write_batch(archive_dir, table, month, month_rows, spec.key)
+            if spec.before_delete:
+                spec.before_delete(cursor, rows)
+            cursor.executemany(
+                f"DELETE FROM {table} WHERE {match}", [tuple(r[k] for k in spec.key) for r in rows]
+            )
+            conn.commit()
+            moved += len(rows)
+            if pause:
+                time.sleep(pause)
+        cursor.execute('''
+            INSERT INTO retention_state (table_name, archived_before, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (table_name) DO UPDATE SET
+                archived_before = MAX(archived_before, excluded.archived_before),
+                updated_at = CURRENT_TIMESTAMP
+        ''', (table, cutoff_s))
+        conn.commit()
+    if moved:
+        logger.info(f"Retenção: {moved} linhas de {table} arquivadas (antes de {cutoff_s})")
+    return moved
+
+
+def incremental_vacuum(db_path, pages=VACUUM_PAGES, pause=BATCH_PAUSE, stop_event=None):
+    """Devolve páginas livres ao sistema em passos pequenos (requer auto_vacuum=INCREMENTAL)."""
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode != 2:
+            logger.warning("auto_vacuum não é INCREMENTAL; rode 'python retention_service.py enable-vacuum' uma vez.")
+            return 0
+        released = 0
+        while not (stop_event and stop_event.is_set()):
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({min(free, pages)})").fetchall()
+            released += min(free, pages)
+            if pause:
+                time.sleep(pause)
+        return released
+
+
+def enable_incremental_vacuum(db_path):
+    """Converte um banco existente para auto_vacuum=INCREMENTAL (faz um VACUUM completo, uma vez)."""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def run_retention(db_path, days=None, archive_dir=ARCHIVE_DIR, stop_event=None):
+    cutoff = cutoff_date(days)
+    moved = {}
+    for table in RETAINED_TABLES:
+        moved[table] = archive_table(db_path, table, cutoff, archive_dir, stop_event=stop_event)
+    if any(moved.values()):
+        incremental_vacuum(db_path, stop_event=stop_event)
+    return moved
+
+
+def restore_month(db_path, table, month, archive_dir=ARCHIVE_DIR):
+    """Devolve ao banco as linhas de um mês arquivado, conferindo cada checksum.
+
+    Linhas cuja chave já existe são ignoradas, então o restore pode ser repetido.
+    Levanta ValueError se algum lote não bater com o manifesto.
+    """
+    if table not in RETAINED_TABLES:
+        raise ValueError(f"Tabela não arquivada: {table}")
+    archive_path, manifest_path = _archive_paths(archive_dir, table, month)
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"Arquivo de {table} para {month} não encontrado")
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    restored = 0
+    with open(archive_path, "rb") as archive, sqlite3.connect(db_path, timeout=30) as conn:
+        cursor = conn.cursor()
+        for entry in entries:
+            archive.seek(entry["offset"])
+            member = archive.read(entry["length"])
+            if hashlib.sha256(member).hexdigest() != entry["sha256"]:
+                raise ValueError(f"Checksum inválido em {archive_path} (offset {entry['offset']})")
+            for line in gzip.decompress(member).decode("utf-8").splitlines():
+                row = json.loads(line)
+                cols = list(row.keys())
+                cursor.execute(
+                    f"INSERT OR IGNORE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                    [row[c] for c in cols]
+                )
+                restored += cursor.rowcount
+        conn.commit()
+    return restored
+
+
+class RetentionWorker:
+    """Roda run_retention() em segundo plano a cada `interval_hours`."""
+
+    def __init__(self, db_path_getter, interval_hours=None):
+        self._db_path_getter = db_path_getter
+        self.interval = float(interval_hours or os.getenv("RETENTION_INTERVAL_HOURS", "24")) * 3600
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_retention(self._db_path_getter(), stop_event=self._stop)
+            except Exception as e:
+                logger.error(f"Erro no job de retenção: {e}")
+            self._stop.wait(self.interval)
+
+
+if __name__ == "__main__":
+    # Uso:
+    #   python retention_service.py run [dias]
+    #   python retention_service.py restore <tabela> <AAAA-MM>
+    #   python retention_service.py enable-vacuum
+    logging.basicConfig(level=logging.INFO)
+    db = os.getenv("VIZO_DB", "vizo_chat.db")
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "run":
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(run_retention(db, days))
+    elif cmd == "restore" and len(sys.argv) == 4:
+        print(f"{restore_month(db, sys.argv[2], sys.argv[3])} linhas restauradas")
+    elif cmd == "enable-vacuum":
+        enable_incremental_vacuum(db)
+        print("auto_vacuum=INCREMENTAL ativado")
+    else:
+        print("Uso: python retention_service.py run [dias] | restore <tabela> <AAAA-MM> | enable-vacuum")
+        sys.exit(1)
@@ -0,0 +1,340 @@
+import sys
+import sqlite3
+import datetime
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Rollup diário de patient_leads. Cada linha guarda quantos leads existem para
+# a combinação (dia, origem, status, interesse). O caminho de escrita de leads
+# atualiza esta tabela na mesma transação; rebuild_rollups() reconstrói tudo a
+# partir de patient_leads quando for preciso reparar.
+
+GRANULARITIES = ("day", "week", "month")
+
+SOURCE_COLORS = {
+    'Instagram': '#E1306C',
+    'WhatsApp': '#25D366',
+    'Facebook': '#1877F2',
+    'Site Direto': '#2e70ce',
+    'Google Ads': '#FBBC05',
+    'Outros': '#6b7280'
+}
+
+INTEREST_BUCKETS = ("Consulta", "Exames", "Cirurgia", "Outros")
+
+
+def source_key(source):
+    """Chave de origem usada no rollup (origem em minúsculas, como no filtro por canal)."""
+    return (source or '').strip().lower()
+
+
+def status_key(status):
+    """Classifica o status do lead em 'converted' (agendado/confirmado) ou 'open'."""
+    s = (status or '').strip().lower()
+    if s.startswith('agendado') or s.startswith('confirmado'):
+        return 'converted'
+    return 'open'
+
+
+def interest_bucket(interest):
+    """Agrupa o interesse livre em Consulta/Exames/Cirurgia/Outros ('' quando vazio)."""
+    if not interest:
+        return ''
+    l = interest.lower()
+    if "consulta" in l:
+        return "Consulta"
+    if "exame" in l:
+        return "Exames"
+    if "cirurg" in l:
+        return "Cirurgia"
+    return "Outros"
+
+
+def source_label(key):
+    """Rótulo amigável da origem para os gráficos do dashboard."""
+    s = key or 'direct'
+    if 'insta' in s:
+        return 'Instagram'
+    if 'whats' in s or 'zap' in s:
+        return 'WhatsApp'
+    if 'face' in s:
+        return 'Facebook'
+    if 'google' in s:
+        return 'Google Ads'
+    if 'site' in s or 'direct' in s:
+        return 'Site Direto'
+    return 'Outros'
+
+
+def init_rollup_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lead_daily_rollup (
+            day TEXT NOT NULL,
+            source_key TEXT NOT NULL,
+            status_key TEXT NOT NULL,
+            interest_bucket TEXT NOT NULL,
+            leads INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, source_key, status_key, interest_bucket)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lead_rollup_source_day ON lead_daily_rollup (source_key, day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_leads_created ON patient_leads (created_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_leads_source_created ON patient_leads (LOWER(COALESCE(source, '')), created_at)")
+
+
+def _register_functions(conn):
+    conn.create_function("lead_source_key", 1, source_key, deterministic=True)
+    conn.create_function("lead_status_key", 1, status_key, deterministic=True)
+    conn.create_function("lead_interest_bucket", 1, interest_bucket, deterministic=True)
+
+
+def _apply_delta(cursor, day, src, status, interest, delta):
+    cursor.execute('''
+        INSERT INTO lead_daily_rollup (day, source_key, status_key, interest_bucket, leads)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day, source_key, status_key, interest_bucket)
+        DO UPDATE SET leads = leads + excluded.leads
+    ''', (day, source_key(src), status_key(status), interest_bucket(interest), delta))
+
+
+def record_lead_insert(cursor, lead_id):
+    """Soma o lead recém inserido no rollup. Deve rodar antes do commit do INSERT."""
+    cursor.execute(
+        "SELECT DATE(created_at), source, status, interest FROM patient_leads WHERE id = ?",
+        (lead_id,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return
+    day, src, status, interest = row
+    _apply_delta(cursor, day, src, status, interest, 1)
+
+
+def update_lead_status(cursor, lead_id, new_status):
+    """Atualiza o status do lead e move a contagem no rollup na mesma transação.
+
+    Retorna False se o lead não existir.
+    """
+    cursor.execute(
+        "SELECT DATE(created_at), source, status, interest FROM patient_leads WHERE id = ?",
+        (lead_id,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return False
+    day, src, old_status, interest = row
+    cursor.execute("UPDATE patient_leads SET status = ? WHERE id = ?", (new_status, lead_id))
+    if status_key(old_status) != status_key(new_status):
+        _apply_delta(cursor, day, src, old_status, interest, -1)
+        _apply_delta(cursor, day, src, new_status, interest, 1)
+    return True
+
+
+def rebuild_rollups(conn):
+    """Reconstrói lead_daily_rollup do zero a partir de patient_leads."""
+    _register_functions(conn)
+    cursor = conn.cursor()
+    init_rollup_tables(cursor)
+    # Dias já arquivados pela retenção não existem mais em patient_leads;
+    # as contagens deles ficam como estão.
+    keep_before = ''
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'retention_state'")
+    if cursor.fetchone():
+        cursor.execute("SELECT archived_before FROM retention_state WHERE table_name = 'patient_leads'")
+        row = cursor.fetchone()
+        keep_before = row[0] if row else ''
+    cursor.execute("DELETE FROM lead_daily_rollup WHERE day >= ?", (keep_before,))
+    cursor.execute('''
+        INSERT INTO lead_daily_rollup (day, source_key, status_key, interest_bucket, leads)
+        SELECT DATE(created_at),
+               lead_source_key(source),
+               lead_status_key(status),
+               lead_interest_bucket(interest),
+               COUNT(*)
+        FROM patient_leads
+        WHERE created_at IS NOT NULL AND created_at >= ?
+        GROUP BY 1, 2, 3, 4
+    ''', (keep_before,))
+    conn.commit()
+    cursor.execute("SELECT COALESCE(SUM(leads), 0) FROM lead_daily_rollup")
+    return cursor.fetchone()[0]
+
+
+def ensure_rollups(conn):
+    """Preenche o rollup na primeira execução quando já existem leads antigos."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM lead_daily_rollup LIMIT 1")
+    if cursor.fetchone():
+        return
+    cursor.execute("SELECT 1 FROM patient_leads LIMIT 1")
+    if cursor.fetchone():
+        total = rebuild_rollups(conn)
+        logger.info(f"Rollup de leads reconstruído ({total} leads)")
+
+
+def parse_range(date_from=None, date_to=None, granularity=None):
+    """Valida os parâmetros from/to (YYYY-MM-DD) e granularity vindos da URL.
+
+    Levanta ValueError com uma mensagem legível se algum valor for inválido.
+    """
+    granularity = (granularity or 'day').strip().lower()
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity deve ser um de: {', '.join(GRANULARITIES)}")
+    parsed = []
+    for name, value in (("from", date_from), ("to", date_to)):
+        if value:
+            try:
+                parsed.append(datetime.date.fromisoformat(value.strip()).isoformat())
+            except ValueError:
+                raise ValueError(f"Parâmetro '{name}' inválido, use YYYY-MM-DD")
+        else:
+            parsed.append(None)
+    if parsed[0] and parsed[1] and parsed[0] > parsed[1]:
+        raise ValueError("'from' não pode ser maior que 'to'")
+    return parsed[0], parsed[1], granularity
+
+
+def _where(date_from, date_to, source=None):
+    clauses = []
+    params = []
+    if date_from:
+        clauses.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("day <= ?")
+        params.append(date_to)
+    if source is not None:
+        clauses.append("source_key = ?")
+        params.append(source_key(source))
+    sql = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return sql, params
+
+
+def _period_expr(granularity):
+    if granularity == 'week':
+        # Segunda-feira da semana ISO
+        return "DATE(day, '-6 days', 'weekday 1')"
+    if granularity == 'month':
+        return "strftime('%Y-%m', day)"
+    return "day"
+
+
+def query_totals(cursor, date_from=None, date_to=None, source=None):
+    where, params = _where(date_from, date_to, source)
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(leads), 0),
+               COALESCE(SUM(CASE WHEN status_key = 'converted' THEN leads ELSE 0 END), 0)
+        FROM lead_daily_rollup{where}
+    ''', params)
+    total, conversions = cursor.fetchone()
+    return total, conversions
+
+
+def query_series(cursor, date_from=None, date_to=None, granularity='day', source=None):
+    where, params = _where(date_from, date_to, source)
+    period = _period_expr(granularity)
+    cursor.execute(f'''
+        SELECT {period} AS period,
+               SUM(leads),
+               SUM(CASE WHEN status_key = 'converted' THEN leads ELSE 0 END)
+        FROM lead_daily_rollup{where}
+        GROUP BY period
+        HAVING SUM(leads) > 0
+        ORDER BY period ASC
+    ''', params)
+    return cursor.fetchall()
+
+
+def query_sources(cursor, date_from=None, date_to=None):
+    where, params = _where(date_from, date_to)
+    cursor.execute(f'''
+        SELECT source_key, SUM(leads)
+        FROM lead_daily_rollup{where}
+        GROUP BY source_key
+    ''', params)
+    agg = {}
+    for key, count in cursor.fetchall():
+        if not count:
+            continue
+        label = source_label(key)
+        agg[label] = agg.get(label, 0) + count
+    return agg
+
+
+def query_interests(cursor, date_from=None, date_to=None, source=None):
+    where, params = _where(date_from, date_to, source)
+    cursor.execute(f'''
+        SELECT interest_bucket, SUM(leads)
+        FROM lead_daily_rollup{where}
+        GROUP BY interest_bucket
+    ''', params)
+    return {bucket: count for bucket, count in cursor.fetchall()}
+
+
+def query_channel_summary(cursor, channel, date_from=None, date_to=None, granularity='day', today=None):
+    """Resumo completo de um canal em uma única passada pelo rollup.
+
+    Devolve totais e conversões do período, leads de hoje e de ontem,
+    contagem por balde de interesse e a série agrupada por granularity.
+    """
+    today = today or datetime.datetime.utcnow().date()
+    today_s = today.isoformat()
+    yesterday_s = (today - datetime.timedelta(days=1)).isoformat()
+    in_range = []
+    params = []
+    if date_from:
+        in_range.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        in_range.append("day <= ?")
+        params.append(date_to)
+    in_range_sql = " AND ".join(in_range) if in_range else "1"
+    period = _period_expr(granularity)
+    cursor.execute(f'''
+        SELECT {period} AS period,
+               interest_bucket,
+               ({in_range_sql}) AS in_range,
+               SUM(leads),
+               SUM(CASE WHEN status_key = 'converted' THEN leads ELSE 0 END),
+               SUM(CASE WHEN day = ? THEN leads ELSE 0 END),
+               SUM(CASE WHEN day = ? THEN leads ELSE 0 END)
+        FROM lead_daily_rollup
+        WHERE source_key = ? AND (({in_range_sql}) OR day IN (?, ?))
+        GROUP BY period, interest_bucket, in_range
+        ORDER BY period ASC
+    ''', params + [today_s, yesterday_s, source_key(channel)] + params + [today_s, yesterday_s])
+
+    summary = {
+        "total": 0,
+        "conversions": 0,
+        "today": 0,
+        "yesterday": 0,
+        "interests": {},
+        "series": OrderedDict(),
+    }
+    for period, bucket, flag, leads, conv, on_today, on_yesterday in cursor.fetchall():
+        summary["today"] += on_today or 0
+        summary["yesterday"] += on_yesterday or 0
+        if not flag or not leads:
+            continue
+        summary["total"] += leads
+        summary["conversions"] += conv or 0
+        summary["interests"][bucket] = summary["interests"].get(bucket, 0) + leads
+        point = summary["series"].setdefault(period, [0, 0])
+        point[0] += leads
+        point[1] += conv or 0
+    return summary
+
+
+if __name__ == "__main__":
+    # Uso: python rollup_service.py rebuild [caminho_do_banco]
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Uso: python rollup_service.py rebuild [vizo_chat.db]")
+        sys.exit(1)
+    db_path = sys.argv[2] if len(sys.argv) > 2 else "vizo_chat.db"
+    with sqlite3.connect(db_path) as conn:
+        total = rebuild_rollups(conn)
+    print(f"Rollup reconstruído: {total} leads em {db_path}")
@@ -0,0 +1,179 @@
+import re
+import html
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Busca full-text nas mensagens do chat com SQLite FTS5. O índice
+# chat_logs_fts é de "conteúdo externo": guarda só os tokens e lê o texto de
+# chat_logs, e os gatilhos abaixo o mantêm em dia com inserts, updates e os
+# deletes da retenção. O tokenizador unicode61 com remove_diacritics 2 faz
+# "lentes", "LENTES" e "lêntes" caírem no mesmo termo.
+
+MAX_CANDIDATES = 5000
+SNIPPETS_PER_SESSION = 3
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def init_search_index(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_logs_fts USING fts5(
+            message,
+            content='chat_logs',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_logs_fts_ai AFTER INSERT ON chat_logs BEGIN
+            INSERT INTO chat_logs_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_logs_fts_ad AFTER DELETE ON chat_logs BEGIN
+            INSERT INTO chat_logs_fts (chat_logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_logs_fts_au AFTER UPDATE OF message ON chat_logs BEGIN
+            INSERT INTO chat_logs_fts (chat_logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO chat_logs_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_timestamp ON chat_logs (timestamp)")
+
+
+def ensure_search_index(conn):
+    """Reconstrói o índice se ele estiver atrás de chat_logs (ex.: banco anterior ao FTS)."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(id) FROM chat_logs")
+    last_message = cursor.fetchone()[0]
+    cursor.execute("SELECT MAX(id) FROM chat_logs_fts_docsize")
+    last_indexed = cursor.fetchone()[0]
+    if last_message != last_indexed:
+        rebuild_search_index(conn)
+
+
+def rebuild_search_index(conn):
+    conn.execute("INSERT INTO chat_logs_fts (chat_logs_fts) VALUES ('rebuild')")
+    conn.commit()
+    logger.info("Índice de busca de mensagens reconstruído")
+
+
+def build_match_query(text):
+    """Converte o texto digitado em uma expressão MATCH segura.
+
+    Cada palavra vira um termo entre aspas (todas obrigatórias) e a última
+    aceita prefixo, para a busca funcionar enquanto o atendente digita.
+    Retorna None se não houver nenhuma palavra.
+    """
+    terms = _TERM_RE.findall(text or "")
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _id_range(cursor, date_from=None, date_to=None):
+    """Faixa de ids de chat_logs para o período (ids crescem junto com timestamp)."""
+    low, high = None, None
+    if date_from:
+        cursor.execute("SELECT MIN(id) FROM chat_logs WHERE timestamp >= ?", (date_from.isoformat(),))
+        low = cursor.fetchone()[0]
+        if low is None:
+            return 1, 0
+    if date_to:
+        cursor.execute(
+            "SELECT MAX(id) FROM chat_logs WHERE timestamp < ?",
+            ((date_to + datetime.timedelta(days=1)).isoformat(),)
+        )
+        high = cursor.fetchone()[0]
+        if high is None:
+            return 1, 0
+    return low or 0, high if high is not None else 2 ** 62
+
+
+def _render_snippet(raw):
+    return html.escape(raw or "").replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+def search_messages(cursor, text, date_from=None, date_to=None, limit=DEFAULT_PAGE_SIZE, offset=0):
+    """Busca mensagens e agrupa os resultados por sessão, das mais relevantes para as menos.
+
+    Considera no máximo MAX_CANDIDATES mensagens mais bem ranqueadas, o que
+    mantém o custo limitado mesmo para termos muito comuns.
+    """
+    match = build_match_query(text)
+    result = {"sessions": [], "total_sessions": 0, "truncated": False}
+    if not match:
+        return result
+    low, high = _id_range(cursor, date_from, date_to)
+    if low > high:
+        return result
+
+    cursor.execute('''
+        SELECT f.rowid, f.rank, c.session_id, c.timestamp
+        FROM chat_logs_fts f
+        JOIN chat_logs c ON c.id = f.rowid
+        WHERE chat_logs_fts MATCH ? AND f.rowid BETWEEN ? AND ?
+        ORDER BY f.rank
+        LIMIT ?
+    ''', (match, low, high, MAX_CANDIDATES + 1))
+    candidates = cursor.fetchall()
+    if len(candidates) > MAX_CANDIDATES:
+        candidates = candidates[:MAX_CANDIDATES]
+        result["truncated"] = True
+
+    sessions = {}
+    for msg_id, score, session_id, ts in candidates:
+        s = sessions.get(session_id)
+        if s is None:
+            s = sessions[session_id] = {
+                "session_id": session_id,
+                "score": score,
+                "hits": 0,
+                "last_at": ts,
+                "_ids": [],
+            }
+        s["hits"] += 1
+        if ts and (s["last_at"] is None or ts > s["last_at"]):
+            s["last_at"] = ts
+        if len(s["_ids"]) < SNIPPETS_PER_SESSION:
+            s["_ids"].append(msg_id)
+
+    ordered = list(sessions.values())
+    result["total_sessions"] = len(ordered)
+    page = ordered[offset:offset + limit]
+    ids = [i for s in page for i in s["_ids"]]
+    if not ids:
+        return result
+
+    cursor.execute(f'''
+        SELECT f.rowid, c.sender, c.timestamp,
+               snippet(chat_logs_fts, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 16)
+        FROM chat_logs_fts f
+        JOIN chat_logs c ON c.id = f.rowid
+        WHERE chat_logs_fts MATCH ? AND f.rowid IN ({', '.join('?' for _ in ids)})
+    ''', [match] + ids)
+    snippets = {row[0]: row for row in cursor.fetchall()}
+
+    for s in page:
+        s["matches"] = [
+            {
+                "id": msg_id,
+                "sender": snippets[msg_id][1],
+                "timestamp": snippets[msg_id][2],
+                "snippet": _render_snippet(snippets[msg_id][3]),
+            }
+            for msg_id in s.pop("_ids") if msg_id in snippets
+        ]
+        result["sessions"].append(s)
+    return result
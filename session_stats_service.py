@@ -0,0 +1,278 @@
+import os
+import sys
+import sqlite3
+import threading
+import time
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sessionização incremental de chat_logs. O job lê só as linhas depois da
+# marca d'água (id) guardada em session_stats_state e atualiza um resumo por
+# sessão em chat_sessions: início, fim, mensagens por remetente, tempo até a
+# primeira resposta e se a conversa virou lead. O dashboard lê os KPIs desses
+# resumos, sem varrer chat_logs a cada requisição.
+#
+# No WhatsApp o session_id é fixo por telefone, então uma pausa maior que
+# SESSION_GAP_MINUTES abre uma sessão nova. O lead vem dos eventos
+# LEAD_CONVERTED de funnel_events (chat web e WhatsApp), lidos com uma marca
+# d'água própria depois das mensagens do mesmo lote.
+
+SESSION_GAP = int(os.getenv("SESSION_GAP_MINUTES", "30")) * 60
+ACTIVE_WINDOW = int(os.getenv("ACTIVE_CHAT_MINUTES", "5")) * 60
+ROLLING_DAYS = int(os.getenv("SESSION_KPI_ROLLING_DAYS", "7"))
+BATCH_SIZE = int(os.getenv("SESSION_STATS_BATCH", "2000"))
+INTERVAL = float(os.getenv("SESSION_STATS_INTERVAL_SECONDS", "15"))
+
+SUMMARY_COLUMNS = (
+    "id", "session_id", "channel", "started_at", "ended_at",
+    "user_messages", "bot_messages", "attendant_messages",
+    "first_user_at", "first_response_seconds", "lead_captured",
+)
+SENDER_COLUMNS = {"user": "user_messages", "bot": "bot_messages", "attendant": "attendant_messages"}
+
+
+def init_session_stats_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            ended_at REAL NOT NULL,
+            user_messages INTEGER NOT NULL DEFAULT 0,
+            bot_messages INTEGER NOT NULL DEFAULT 0,
+            attendant_messages INTEGER NOT NULL DEFAULT 0,
+            first_user_at REAL,
+            first_response_seconds REAL,
+            lead_captured INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_session ON chat_sessions (session_id, started_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_started ON chat_sessions (started_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_ended ON chat_sessions (ended_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_stats_state (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+def channel_of(session_id):
+    return "whatsapp" if (session_id or "").startswith("whatsapp:") else "web"
+
+
+def _mark(cursor, source):
+    cursor.execute("SELECT last_id FROM session_stats_state WHERE source = ?", (source,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _set_mark(cursor, source, last_id):
+    cursor.execute('''
+        INSERT INTO session_stats_state (source, last_id) VALUES (?, ?)
+        ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id
+    ''', (source, last_id))
+
+
+def _latest(cursor, session_id):
+    cursor.execute(f'''
+        SELECT {', '.join(SUMMARY_COLUMNS)} FROM chat_sessions
+        WHERE session_id = ? ORDER BY started_at DESC LIMIT 1
+    ''', (session_id,))
+    row = cursor.fetchone()
+    return dict(zip(SUMMARY_COLUMNS, row)) if row else None
+
+
+def _new_summary(session_id, at):
+    return {
+        "id": None, "session_id": session_id, "channel": channel_of(session_id),
+        "started_at": at, "ended_at": at,
+        "user_messages": 0, "bot_messages": 0, "attendant_messages": 0,
+        "first_user_at": None, "first_response_seconds": None, "lead_captured": 0,
+    }
+
+
+def _save(cursor, summary):
+    columns = SUMMARY_COLUMNS[1:]
+    values = [summary[c] for c in columns]
+    if summary["id"] is None:
+        cursor.execute(f'''
+            INSERT INTO chat_sessions ({', '.join(columns)})
+            VALUES ({', '.join('?' for _ in columns)}) RETURNING id
+        ''', values)
+        summary["id"] = cursor.fetchone()[0]
+    else:
+        cursor.execute(
+            f"UPDATE chat_sessions SET {', '.join(c + ' = ?' for c in columns)} WHERE id = ?",
+            values + [summary["id"]]
+        )
+
+
+def _apply_messages(cursor, rows, now):
+    """Aplica as linhas (id, session_id, sender, epoch) aos resumos e grava os alterados."""
+    current = {}
+    dirty = {}
+    for _, session_id, sender, at in rows:
+        session_id = session_id or "desconhecida"
+        at = at if at is not None else now
+        summary = current.get(session_id)
+        if summary is None:
+            summary = _latest(cursor, session_id)
+        if summary is None or at - summary["ended_at"] > SESSION_GAP:
+            summary = _new_summary(session_id, at)
+        dirty[id(summary)] = summary
+        current[session_id] = summary
+
+        summary["started_at"] = min(summary["started_at"], at)
+        summary["ended_at"] = max(summary["ended_at"], at)
+        column = SENDER_COLUMNS.get(sender)
+        if column:
+            summary[column] += 1
+        if sender == "user":
+            if summary["first_user_at"] is None:
+                summary["first_user_at"] = at
+        elif column and summary["first_user_at"] is not None and summary["first_response_seconds"] is None:
+            summary["first_response_seconds"] = max(0.0, at - summary["first_user_at"])
+    for summary in dirty.values():
+        _save(cursor, summary)
+    return len(dirty)
+
+
+def process_batch(conn, limit=None, now=None):
+    """Processa até `limit` mensagens e eventos novos numa transação.
+
+    Retorna {"messages": n, "events": n, "sessions": n}; zeros quando não há
+    nada depois das marcas d'água.
+    """
+    limit = limit or BATCH_SIZE
+    now = now or time.time()
+    cursor = conn.cursor()
+
+    last_log = _mark(cursor, "chat_logs")
+    # chat_logs.timestamp é CURRENT_TIMESTAMP (UTC); julianday também aceita frações de segundo
+    cursor.execute('''
+        SELECT id, session_id, sender, (julianday(timestamp) - 2440587.5) * 86400.0
+        FROM chat_logs WHERE id > ? ORDER BY id LIMIT ?
+    ''', (last_log, limit))
+    rows = cursor.fetchall()
+    sessions = _apply_messages(cursor, rows, now) if rows else 0
+    if rows:
+        _set_mark(cursor, "chat_logs", rows[-1][0])
+
+    # Eventos de um lead só chegam depois de alguma mensagem da sessão; uma
+    # conversão sem resumo (sessão sem chat_logs) é ignorada.
+    last_event = _mark(cursor, "funnel_events")
+    cursor.execute('''
+        SELECT id, session_id, event FROM funnel_events WHERE id > ? ORDER BY id LIMIT ?
+    ''', (last_event, limit))
+    events = cursor.fetchall()
+    for _, session_id, event in events:
+        if event == "LEAD_CONVERTED" and session_id:
+            cursor.execute('''
+                UPDATE chat_sessions SET lead_captured = 1
+                WHERE id = (SELECT id FROM chat_sessions WHERE session_id = ? ORDER BY started_at DESC LIMIT 1)
+            ''', (session_id,))
+    if events:
+        _set_mark(cursor, "funnel_events", events[-1][0])
+
+    conn.commit()
+    return {"messages": len(rows), "events": len(events), "sessions": sessions}
+
+
+def run_sessionization(db_path, stop_event=None, limit=None):
+    """Processa lotes até alcançar o fim de chat_logs e funnel_events."""
+    limit = limit or BATCH_SIZE
+    totals = {"messages": 0, "events": 0}
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        while not (stop_event and stop_event.is_set()):
+            result = process_batch(conn, limit)
+            totals["messages"] += result["messages"]
+            totals["events"] += result["events"]
+            if result["messages"] < limit and result["events"] < limit:
+                break
+    return totals
+
+
+def _epoch(day, end=False):
+    moment = datetime.datetime.fromisoformat(str(day))
+    if end:
+        moment += datetime.timedelta(days=1)
+    return moment.timestamp()
+
+
+def kpis(cursor, date_from=None, date_to=None, now=None):
+    """KPIs das sessões iniciadas no período (datas locais, como no restante do dashboard).
+
+    Sem período, usa a janela móvel dos últimos ROLLING_DAYS dias. active_chats
+    conta as sessões com mensagem nos últimos ACTIVE_CHAT_MINUTES minutos.
+    """
+    now = now or time.time()
+    start = _epoch(date_from) if date_from else (now - ROLLING_DAYS * 86400 if not date_to else 0)
+    end = _epoch(date_to, end=True) if date_to else now + 1
+    cursor.execute('''
+        SELECT COUNT(*),
+               AVG(first_response_seconds),
+               AVG(ended_at - started_at),
+               COALESCE(SUM(lead_captured), 0),
+               AVG(user_messages + bot_messages + attendant_messages)
+        FROM chat_sessions
+        WHERE started_at >= ? AND started_at < ?
+    ''', (start, end))
+    sessions, avg_first_response, avg_duration, leads, avg_messages = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*) FROM chat_sessions WHERE ended_at >= ?", (now - ACTIVE_WINDOW,))
+    active = cursor.fetchone()[0]
+    return {
+        "sessions": sessions,
+        "avg_first_response": avg_first_response,
+        "avg_duration": avg_duration,
+        "avg_messages": round(avg_messages, 1) if avg_messages is not None else None,
+        "leads": leads,
+        "lead_rate": round(leads / sessions * 100.0, 1) if sessions else 0.0,
+        "active_chats": active,
+    }
+
+
+class SessionStatsWorker:
+    """Roda a sessionização a cada SESSION_STATS_INTERVAL_SECONDS segundos (ou antes, com wake())."""
+
+    def __init__(self, db_path_getter, interval=None):
+        self._db_path_getter = db_path_getter
+        self.interval = float(interval or INTERVAL)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-stats", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_sessionization(self._db_path_getter(), stop_event=self._stop)
+            except Exception as e:
+                logger.error(f"Erro na sessionização dos chats: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+if __name__ == "__main__":
+    # Uso: python session_stats_service.py [caminho_do_banco]
+    logging.basicConfig(level=logging.INFO)
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "vizo_chat.db"
+    with sqlite3.connect(db_path) as conn:
+        init_session_stats_tables(conn.cursor())
+    print(run_sessionization(db_path))
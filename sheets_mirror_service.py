@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Espelho local das células da planilha de usuários (Sheet1!A:E), para o
+# login não baixar a planilha inteira a cada verificação. Cada célula vira
+# uma chave normalizada (sem acento, minúscula, espaços colapsados) em
+# sheet_mirror_keys; a consulta é uma busca pela chave primária.
+#
+# O espelho é alimentado por três caminhos:
+#   - enqueue_row do outbox registra as células na mesma transação;
+#   - o SheetsMirrorWorker puxa periodicamente só as linhas novas (delta);
+#   - uma vez por dia a planilha é relida por inteiro para pegar edições.
+
+MIRROR_TAB = os.getenv("SHEETS_MIRROR_TAB", "Sheet1")
+MIRROR_COLUMNS = "A:E"
+DELTA_INTERVAL = float(os.getenv("SHEETS_MIRROR_INTERVAL", "300"))
+FULL_INTERVAL = float(os.getenv("SHEETS_MIRROR_FULL_INTERVAL", str(24 * 3600)))
+
+
+def init_mirror_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_mirror_keys (
+            spreadsheet_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (spreadsheet_id, key)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_mirror_state (
+            spreadsheet_id TEXT PRIMARY KEY,
+            synced_rows INTEGER NOT NULL DEFAULT 0,
+            last_delta_at REAL,
+            last_full_at REAL
+        )
+    ''')
+
+
+def normalize_key(value):
+    text = unicodedata.normalize("NFKD", str(value or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def record_row(cursor, spreadsheet_id, row):
+    """Adiciona as células de uma linha ao espelho (sem commit)."""
+    keys = {normalize_key(cell) for cell in row}
+    keys.discard("")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO sheet_mirror_keys (spreadsheet_id, key) VALUES (?, ?)",
+        [(spreadsheet_id, k) for k in keys]
+    )
+
+
+def is_synced(cursor, spreadsheet_id):
+    cursor.execute("SELECT last_full_at FROM sheet_mirror_state WHERE spreadsheet_id = ?", (spreadsheet_id,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def user_exists(cursor, spreadsheet_id, identifier):
+    """True se alguma célula da planilha for igual ao identificador (normalizado)."""
+    key = normalize_key(identifier)
+    if not key:
+        return False
+    cursor.execute(
+        "SELECT 1 FROM sheet_mirror_keys WHERE spreadsheet_id = ? AND key = ?",
+        (spreadsheet_id, key)
+    )
+    return cursor.fetchone() is not None
+
+
+def _pending_outbox_rows(cursor, spreadsheet_id):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sheets_outbox'")
+    if not cursor.fetchone():
+        return []
+    cursor.execute(
+        "SELECT row_json FROM sheets_outbox WHERE spreadsheet_id = ? AND status = 'pending'",
+        (spreadsheet_id,)
+    )
+    return [json.loads(r[0]) for r in cursor.fetchall()]
+
+
+def full_sync(conn, google_service, spreadsheet_id):
+    """Relê a planilha inteira e substitui o espelho. Linhas ainda no outbox são mantidas."""
+    rows = google_service.get_rows(spreadsheet_id, f"{MIRROR_TAB}!{MIRROR_COLUMNS}")
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM sheet_mirror_keys WHERE spreadsheet_id = ?", (spreadsheet_id,))
+    for row in rows:
+        record_row(cursor, spreadsheet_id, row)
+    for row in _pending_outbox_rows(cursor, spreadsheet_id):
+        record_row(cursor, spreadsheet_id, row)
+    now = time.time()
+    cursor.execute('''
+        INSERT INTO sheet_mirror_state (spreadsheet_id, synced_rows, last_delta_at, last_full_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (spreadsheet_id) DO UPDATE SET
+            synced_rows = excluded.synced_rows,
+            last_delta_at = excluded.last_delta_at,
+            last_full_at = excluded.last_full_at
+    ''', (spreadsheet_id, len(rows), now, now))
+    conn.commit()
+    return len(rows)
+
+
+def delta_sync(conn, google_service, spreadsheet_id):
+    """Busca só as linhas depois da última já espelhada."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT synced_rows FROM sheet_mirror_state WHERE spreadsheet_id = ?", (spreadsheet_id,))
+    state = cursor.fetchone()
+    if not state:
+        return full_sync(conn, google_service, spreadsheet_id)
+    synced = state[0]
+    first, last = MIRROR_COLUMNS.split(":")
+    rows = google_service.get_rows(spreadsheet_id, f"{MIRROR_TAB}!{first}{synced + 1}:{last}")
+    for row in rows:
+        record_row(cursor, spreadsheet_id, row)
+    cursor.execute(
+        "UPDATE sheet_mirror_state SET synced_rows = ?, last_delta_at = ? WHERE spreadsheet_id = ?",
+        (synced + len(rows), time.time(), spreadsheet_id)
+    )
+    conn.commit()
+    return len(rows)
+
+
+class SheetsMirrorWorker:
+    """Mantém o espelho atualizado em segundo plano (delta periódico + releitura diária)."""
+
+    def __init__(self, db_path_getter, google_service_getter, spreadsheet_ids_getter):
+        self._db_path_getter = db_path_getter
+        self._google_service_getter = google_service_getter
+        self._spreadsheet_ids_getter = spreadsheet_ids_getter
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sheets-mirror", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def sync_once(self):
+        service = self._google_service_getter()
+        if not service:
+            return
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            for spreadsheet_id in self._spreadsheet_ids_getter():
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT last_full_at FROM sheet_mirror_state WHERE spreadsheet_id = ?", (spreadsheet_id,))
+                    row = cursor.fetchone()
+                    if not row or not row[0] or time.time() - row[0] > FULL_INTERVAL:
+                        count = full_sync(conn, service, spreadsheet_id)
+                        logger.info(f"Espelho do Sheets relido: {count} linhas ({spreadsheet_id})")
+                    else:
+                        delta_sync(conn, service, spreadsheet_id)
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(f"Falha ao sincronizar espelho do Sheets ({spreadsheet_id}): {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sync_once()
+            self._wake.wait(DELTA_INTERVAL)
+            self._wake.clear()
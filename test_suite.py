@@ -3,6 +3,8 @@ from unittest.mock import MagicMock, patch
 import sys
 import os
 import json
+import time
+from collections import OrderedDict
 
 # Add current directory to path
 sys.path.append(os.getcwd())
@@ -61,6 +63,67 @@ class TestVizoBot(unittest.TestCase):
         self.assertEqual(self.bot.user_data['whatsapp'], "96999999999")
         self.assertEqual(self.bot.state, "AGENDAMENTO_MEDICO")
 
+    def test_headless_booking_events(self):
+        from vizo_bot import VizoBot
+        bookings = []
+        self.MockGoogle.reset_mock()
+        bot = VizoBot(headless=True, on_booking=lambda data, doctor: bookings.append((data, doctor)))
+        with patch('builtins.print') as mock_print:
+            bot.start()
+            bot.take_events()
+            for text in ["Ana 96999999999", "1", "Ana Lima", "96999999999"]:
+                bot.handle(text)
+            events, running = bot.handle("2")
+        mock_print.assert_not_called()
+        self.MockGoogle.assert_not_called()
+        self.assertTrue(running)
+        self.assertEqual(bot.state, "MENU")
+        self.assertEqual(bookings, [({"info_inicial": "Ana 96999999999", "nome": "Ana Lima", "whatsapp": "96999999999"}, "Dra. Ana Catarina")])
+        self.assertIn({"type": "metric", "event": "APPOINTMENT_SCHEDULED", "details": {"doctor": "Dra. Ana Catarina"}}, events)
+        self.assertTrue(any(e["type"] == "say" and "Dra. Ana Catarina" in e["text"] for e in events))
+
+    def test_replay_benchmark(self):
+        import benchmark_bot
+        for engine in ("terminal", "whatsapp"):
+            result = benchmark_bot.run_benchmark(engine, conversations=40, threads=2)
+            # 10 conversas de cada roteiro, cada uma terminando com "0"
+            expected = sum(10 * (len(s) + 1) for s in benchmark_bot.SCRIPTS.values())
+            self.assertEqual(result["transitions"], expected)
+            self.assertGreater(result["replies"], result["transitions"])
+            self.assertGreater(result["bytes_per_session"], 0)
+
+    def test_metrics_logger_batches_in_background(self):
+        from vizo_bot import MetricsLogger
+        metrics = MetricsLogger(api_url="http://metrics.test/api/metrics", batch_size=3, flush_interval=60, max_buffer=4)
+        with patch('vizo_bot.requests.post') as mock_post, patch('builtins.print'):
+            for i in range(3):
+                metrics.log_event("STEP", {"i": i})
+            for _ in range(50):
+                if mock_post.call_count:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(mock_post.call_count, 1)
+            events = mock_post.call_args.kwargs["json"]["events"]
+            self.assertEqual([e["details"]["i"] for e in events], [0, 1, 2])
+            metrics.log_event("SESSION_END")
+            self.assertTrue(metrics.flush(timeout=2))
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual((metrics.sent, metrics.dropped), (4, 0))
+
+    def test_metrics_logger_drops_when_buffer_full(self):
+        from vizo_bot import MetricsLogger
+        import threading
+        release = threading.Event()
+        metrics = MetricsLogger(batch_size=1, flush_interval=60, max_buffer=2)
+        with patch('vizo_bot.requests.post', side_effect=lambda *a, **k: release.wait(2)), patch('builtins.print'):
+            started = time.time()
+            for i in range(10):
+                metrics.log_event("STEP", {"i": i})
+            # Nunca espera a rede: a API "travada" só faz descartar
+            self.assertLess(time.time() - started, 0.5)
+            self.assertGreaterEqual(metrics.dropped, 7)
+            release.set()
+
 class TestAppFlask(unittest.TestCase):
     
     def setUp(self):
@@ -111,5 +174,1079 @@ class TestAppFlask(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(json.loads(response.data)['reply'], "Olá, sou o Vizô!")
 
+class TestAppDatabase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import app as app_module
+        self.app_module = app_module
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_patcher = patch('app.DB_NAME', os.path.join(self.tmpdir.name, 'test.db'))
+        self.db_patcher.start()
+        self.google_patcher = patch('app.google_service', None)
+        self.google_patcher.start()
+        # Sessões do bot em cache pertencem ao banco do teste anterior
+        self.bot_cache_patcher = patch.object(app_module.whatsapp_bot, '_cache', OrderedDict())
+        self.bot_cache_patcher.start()
+        app_module.init_db()
+        self.client = app_module.app.test_client()
+
+    def tearDown(self):
+        self.bot_cache_patcher.stop()
+        self.google_patcher.stop()
+        self.db_patcher.stop()
+        self.tmpdir.cleanup()
+
+    def _save(self, **lead):
+        response = self.client.post('/api/lead/save', json=lead)
+        self.assertEqual(response.status_code, 200)
+
+    def test_overview_reads_rollup(self):
+        self._save(name="Ana", source="instagram", interest="Consulta de rotina")
+        self._save(name="Bia", source="instagram", status="Agendado", interest="Exames")
+        self._save(name="Caio", source="whatsapp")
+        data = json.loads(self.client.get('/api/dashboard/overview').data)
+        self.assertEqual(data['overview']['totalLeads'], 3)
+        self.assertEqual(data['overview']['conversions'], 1)
+        self.assertEqual(sum(data['dailyPerformance']['leads']), 3)
+        sources = dict(zip(data['leadSources']['labels'], data['leadSources']['data']))
+        self.assertEqual(sources, {'Instagram': 2, 'WhatsApp': 1})
+
+    def test_status_change_moves_rollup(self):
+        self._save(name="Ana", source="facebook")
+        import sqlite3
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            lead_id = conn.execute("SELECT id FROM patient_leads").fetchone()[0]
+        response = self.client.post('/api/lead/status', json={"id": lead_id, "status": "Confirmado"})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(self.client.get('/api/dashboard/social/facebook').data)
+        self.assertEqual(data['totalLeads'], 1)
+        self.assertEqual(data['conversionRate'], 100.0)
+
+    def test_rebuild_matches_incremental(self):
+        import sqlite3
+        import rollup_service
+        self._save(name="Ana", source="instagram", status="Agendado", interest="Cirurgia")
+        self._save(name="Bia", source="site")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            before = conn.execute("SELECT * FROM lead_daily_rollup ORDER BY 1, 2, 3, 4").fetchall()
+            self.assertEqual(rollup_service.rebuild_rollups(conn), 2)
+            after = conn.execute("SELECT * FROM lead_daily_rollup ORDER BY 1, 2, 3, 4").fetchall()
+        self.assertEqual(before, after)
+
+    def test_range_and_granularity_validation(self):
+        self._save(name="Ana", source="instagram")
+        self.assertEqual(self.client.get('/api/dashboard/overview?granularity=year').status_code, 400)
+        self.assertEqual(self.client.get('/api/dashboard/overview?from=ontem').status_code, 400)
+        data = json.loads(self.client.get('/api/dashboard/overview?from=2000-01-01&to=2000-01-31').data)
+        self.assertEqual(data['overview']['totalLeads'], 0)
+        data = json.loads(self.client.get('/api/dashboard/overview?granularity=month').data)
+        self.assertEqual(len(data['dailyPerformance']['labels'][0]), 7)
+
+    def test_response_cache_etag_and_invalidation(self):
+        self._save(name="Ana", source="instagram")
+        first = self.client.get('/api/dashboard/social/instagram')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        etag = first.headers['ETag']
+        second = self.client.get('/api/dashboard/social/instagram')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.headers['ETag'], etag)
+        not_modified = self.client.get('/api/dashboard/social/instagram', headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self._save(name="Bia", source="instagram")
+        third = self.client.get('/api/dashboard/social/instagram', headers={'If-None-Match': etag})
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(third.data)['totalLeads'], 2)
+
+    def test_leads_keyset_pagination_and_filters(self):
+        for i in range(5):
+            self._save(name=f"Paciente {i}", source="instagram" if i % 2 else "facebook", campaign="lentes_evo")
+        seen = []
+        cursor = None
+        while True:
+            url = '/api/leads?limit=2' + (f'&cursor={cursor}' if cursor else '')
+            page = json.loads(self.client.get(url).data)
+            seen.extend(lead['id'] for lead in page['leads'])
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertEqual(len(set(seen)), 5)
+        page = json.loads(self.client.get('/api/leads?source=Instagram&campaign=LENTES_EVO').data)
+        self.assertEqual(len(page['leads']), 2)
+        self.assertEqual(self.client.get('/api/leads?cursor=@@@').status_code, 400)
+
+    def test_leads_streaming_export(self):
+        self._save(name="Ana", source="instagram", interest="Exames")
+        self._save(name="Bia", source="facebook")
+        response = self.client.get('/api/leads/export?format=ndjson&source=instagram')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['name'] for r in rows], ["Ana"])
+        response = self.client.get('/api/leads/export?format=csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertTrue(lines[0].startswith("id,created_at,name"))
+        self.assertEqual(len(lines), 3)
+
+    def test_history_since_id_and_long_poll(self):
+        import threading
+        import time
+        for text in ("Oi", "Quero agendar"):
+            self.client.post('/api/log/message', json={"session_id": "s1", "sender": "user", "message": text})
+        full = json.loads(self.client.get('/api/history/s1').data)
+        self.assertEqual([m['message'] for m in full], ["Oi", "Quero agendar"])
+        page = json.loads(self.client.get('/api/history/s1?limit=1').data)
+        self.assertEqual(len(page), 1)
+        newer = json.loads(self.client.get(f"/api/history/s1?since_id={page[0]['id']}").data)
+        self.assertEqual([m['message'] for m in newer], ["Quero agendar"])
+
+        last_id = full[-1]['id']
+        writer = threading.Timer(0.2, lambda: self.app_module.app.test_client().post(
+            '/api/log/message', json={"session_id": "s1", "sender": "bot", "message": "Claro!"}))
+        started = time.monotonic()
+        writer.start()
+        polled = json.loads(self.client.get(f'/api/history/s1?since_id={last_id}&wait=5').data)
+        writer.join()
+        self.assertEqual([m['message'] for m in polled], ["Claro!"])
+        self.assertLess(time.monotonic() - started, 4)
+
+    def test_retention_archives_and_restores(self):
+        import sqlite3
+        import datetime
+        import retention_service
+        db = self.app_module.DB_NAME
+        archive_dir = os.path.join(self.tmpdir.name, 'archives')
+        with sqlite3.connect(db) as conn:
+            conn.executemany(
+                "INSERT INTO chat_logs (session_id, sender, message, timestamp) VALUES (?, ?, ?, ?)",
+                [("old", "user", f"msg {i}", f"2020-0{1 + i % 2}-10 10:00:00") for i in range(5)]
+            )
+            conn.execute("INSERT INTO chat_logs (session_id, sender, message) VALUES ('new', 'user', 'hoje')")
+        moved = retention_service.archive_table(db, "chat_logs", datetime.date(2021, 1, 1), archive_dir, batch_size=2, pause=0)
+        self.assertEqual(moved, 5)
+        with sqlite3.connect(db) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM chat_logs").fetchone()[0], 1)
+        self.assertTrue(os.path.exists(os.path.join(archive_dir, 'chat_logs', '2020-01.jsonl.gz')))
+
+        restored = retention_service.restore_month(db, "chat_logs", "2020-02", archive_dir)
+        self.assertEqual(restored, 2)
+        self.assertEqual(retention_service.restore_month(db, "chat_logs", "2020-02", archive_dir), 0)
+
+        path = os.path.join(archive_dir, 'chat_logs', '2020-01.jsonl.gz')
+        with open(path, 'r+b') as f:
+            f.seek(12)
+            f.write(b'\x00\x00')
+        with self.assertRaises(ValueError):
+            retention_service.restore_month(db, "chat_logs", "2020-01", archive_dir)
+
+        # Tabela com data em epoch e chave composta (sem coluna id)
+        old_at = datetime.datetime(2020, 3, 5, tzinfo=datetime.timezone.utc).timestamp()
+        with sqlite3.connect(db) as conn:
+            conn.executemany('''
+                INSERT INTO campaign_recipients (campaign_id, phone, lead_id, status, created_at)
+                VALUES (?, ?, ?, 'sent', ?)
+            ''', [(1, "5596999990001", 1, old_at), (1, "5596999990002", 2, old_at), (2, "5596999990001", 1, time.time())])
+        self.assertEqual(retention_service.archive_table(
+            db, "campaign_recipients", datetime.date(2021, 1, 1), archive_dir, batch_size=1, pause=0), 2)
+        with sqlite3.connect(db) as conn:
+            self.assertEqual(conn.execute("SELECT campaign_id FROM campaign_recipients").fetchall(), [(2,)])
+        self.assertEqual(retention_service.restore_month(db, "campaign_recipients", "2020-03", archive_dir), 2)
+
+        # Lead canônico arquivado: o contato mais novo do grupo assume e continua achável
+        import phone_service
+        with sqlite3.connect(db) as conn:
+            conn.executemany('''
+                INSERT INTO patient_leads (created_at, name, phone, phone_e164, status, source, consent)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [("2020-05-01 10:00:00", "Ana Souza", "96 99160-3396", "+5596991603396", "Agendado", "instagram", 1),
+                  ("2020-06-01 10:00:00", "Ana", "96991603396", "+5596991603396", "Em atendimento", "site", 0),
+                  (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()), "Ana", "5596991603396", "+5596991603396",
+                   "Em atendimento", "whatsapp", 0)])
+            phone_service.merge_phone(conn.cursor(), "+5596991603396")
+            conn.commit()
+        retention_service.archive_table(db, "patient_leads", datetime.date(2021, 1, 1), archive_dir, batch_size=1, pause=0)
+        with sqlite3.connect(db) as conn:
+            lead = phone_service.find_lead(conn.cursor(), "96 99160-3396")
+            rows = conn.execute("SELECT COUNT(*), MAX(merged_into) FROM patient_leads").fetchone()
+        self.assertEqual((lead["name"], lead["status"], lead["source"], lead["consent"]),
+                         ("Ana", "Em atendimento", "whatsapp", 1))
+        self.assertEqual(rows, (1, None))
+
+    def test_message_search_groups_sessions(self):
+        messages = [
+            ("s1", "user", "Vocês trabalham com lentes EVO?"),
+            ("s1", "bot", "Sim, as lentes EVO são uma alternativa à cirurgia."),
+            ("s2", "user", "Quero saber das LÊNTES evo <b>agora</b>"),
+            ("s3", "user", "Quero marcar consulta"),
+        ]
+        for session_id, sender, message in messages:
+            self.client.post('/api/log/message', json={"session_id": session_id, "sender": sender, "message": message})
+        data = json.loads(self.client.get('/api/search/messages?q=lentes evo').data)
+        self.assertEqual(data['total_sessions'], 2)
+        sessions = {s['session_id']: s for s in data['sessions']}
+        self.assertEqual(sessions['s1']['hits'], 2)
+        snippet = sessions['s2']['matches'][0]['snippet']
+        self.assertIn('<mark>', snippet)
+        self.assertIn('&lt;b&gt;', snippet)
+        data = json.loads(self.client.get('/api/search/messages?q=lentes&limit=1&offset=1').data)
+        self.assertEqual(len(data['sessions']), 1)
+        data = json.loads(self.client.get('/api/search/messages?q=lentes&to=2000-01-01').data)
+        self.assertEqual(data['total_sessions'], 0)
+        self.assertEqual(self.client.get('/api/search/messages').status_code, 400)
+
+    def test_sheets_outbox_batches_and_retries(self):
+        import sqlite3
+        import outbox_service
+        fake_google = MagicMock()
+        with patch('app.google_service', fake_google), patch('app.sheets_outbox'):
+            self._save(name="Ana", phone="96 99999-0000")
+            self._save(name="Bia", phone="96 98888-0000")
+        fake_google.add_lead_to_sheets.assert_not_called()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            outbox_service.enqueue_row(conn.cursor(), "contatos", ["x"], "Página1!A1")
+            conn.commit()
+
+        worker = outbox_service.SheetsOutboxWorker(lambda: self.app_module.DB_NAME, lambda: fake_google)
+        with patch.object(outbox_service, 'MIN_CALL_INTERVAL', 0):
+            worker.drain_once()
+        self.assertEqual(fake_google.append_rows.call_count, 2)
+        rows = fake_google.append_rows.call_args_list[0].args[1]
+        self.assertEqual([r[1] for r in rows], ["Ana", "Bia"])
+        status = json.loads(self.client.get('/api/sheets/outbox').data)
+        self.assertEqual((status['pending'], status['sent']), (0, 3))
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            outbox_service.enqueue_row(conn.cursor(), "contatos", ["y"])
+            conn.commit()
+        fake_google.append_rows.side_effect = RuntimeError("timeout")
+        with patch.object(outbox_service, 'MIN_CALL_INTERVAL', 0):
+            worker.drain_once()
+        status = json.loads(self.client.get('/api/sheets/outbox').data)
+        self.assertEqual((status['pending'], status['retrying']), (1, 1))
+
+        # Linha já pega por outro processo não sai de novo; só volta depois de travada
+        fake_google.append_rows.side_effect = None
+        fake_google.append_rows.reset_mock()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE sheets_outbox SET status = 'sending', claimed_at = ?, next_attempt_at = 0 WHERE status = 'pending'", (time.time(),))
+        with patch.object(outbox_service, 'MIN_CALL_INTERVAL', 0):
+            worker.drain_once()
+        fake_google.append_rows.assert_not_called()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE sheets_outbox SET claimed_at = 0 WHERE status = 'sending'")
+        with patch.object(outbox_service, 'MIN_CALL_INTERVAL', 0):
+            worker.drain_once()
+        self.assertEqual(fake_google.append_rows.call_count, 1)
+
+    def test_sheets_mirror_answers_user_checks_locally(self):
+        import sqlite3
+        import sheets_mirror_service
+        fake_google = MagicMock()
+        fake_google.get_rows.return_value = [["Data", "Nome"], ["2024-01-01", "José Silva", "jose@x.com"]]
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(sheets_mirror_service.full_sync(conn, fake_google, "sheet"), 2)
+            cursor = conn.cursor()
+            self.assertTrue(sheets_mirror_service.user_exists(cursor, "sheet", "  JOSE   silva "))
+            self.assertFalse(sheets_mirror_service.user_exists(cursor, "sheet", "maria"))
+
+            fake_google.get_rows.return_value = [["2024-01-02", "Maria"]]
+            self.assertEqual(sheets_mirror_service.delta_sync(conn, fake_google, "sheet"), 1)
+            self.assertEqual(fake_google.get_rows.call_args.args[1], "Sheet1!A3:E")
+            self.assertTrue(sheets_mirror_service.user_exists(cursor, "sheet", "maria"))
+
+        with patch('app.SPREADSHEET_ID', 'sheet'), patch('app.sheets_outbox'):
+            fake_google.get_rows.reset_mock()
+            self.assertTrue(self.app_module.user_in_sheet("Maria"))
+            self.assertFalse(self.app_module.user_in_sheet("admin"))
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                import outbox_service
+                outbox_service.enqueue_row(conn.cursor(), "sheet", ["2024-01-03", "admin"])
+                conn.commit()
+            self.assertTrue(self.app_module.user_in_sheet("admin"))
+        fake_google.get_rows.assert_not_called()
+
+    def test_morning_report_built_locally_and_sent_once(self):
+        import sqlite3
+        import datetime
+        import report_service
+        today = report_service.today()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            report_service.record_appointment(
+                conn.cursor(), "Ana", "96 99999-0000", "Dra. Lia",
+                datetime.datetime.combine(today, datetime.time(9, 30)))
+            # Leads de ontem pelo dia da clínica (UTC-3): 23h30 local já é hoje em UTC
+            conn.executemany("INSERT INTO patient_leads (name, status, created_at) VALUES (?, ?, ?)", [
+                ("Caio", "Agendado", f"{today} 02:30:00"),
+                ("Duda", "Novo Lead", f"{today - datetime.timedelta(days=1)} 04:00:00"),
+                ("Edu", "Novo Lead", f"{today - datetime.timedelta(days=1)} 02:00:00"),
+            ])
+            conn.commit()
+        first = json.loads(self.client.get('/api/sheets/report').data)["report"]
+        self.assertIn("09:30 Ana - Dra. Lia", first)
+        self.assertIn("Leads de ontem: 2 (1 convertidos)", first)
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            # GET não grava (não muda o data_version do cache do dashboard)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM daily_reports").fetchone()[0], 0)
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            report_service.record_appointment(
+                conn.cursor(), "Bia", "96 98888-0000", "Dr. Rui",
+                datetime.datetime.combine(today, datetime.time(8, 0)))
+            conn.commit()
+        second = json.loads(self.client.get('/api/sheets/report').data)["report"]
+        self.assertLess(second.index("Bia"), second.index("Ana"))
+
+        send = MagicMock(return_value=True)
+        scheduler = report_service.MorningReportScheduler(
+            lambda: self.app_module.DB_NAME, send, lambda: ["96 991503360"], at="07:00")
+        self.assertFalse(scheduler.run_once(datetime.datetime.combine(today, datetime.time(6, 0))))
+        self.assertTrue(scheduler.run_once(datetime.datetime.combine(today, datetime.time(7, 5))))
+        with patch.object(report_service, 'store_report') as rebuild:
+            self.assertFalse(scheduler.run_once(datetime.datetime.combine(today, datetime.time(8, 0))))
+        rebuild.assert_not_called()
+        send.assert_called_once_with("96 991503360", second)
+
+    def test_calendar_slots_from_freebusy_and_local_bookings(self):
+        import sqlite3
+        import datetime
+        import availability_service
+        import report_service
+        today = datetime.date.today()
+        monday = today + datetime.timedelta(days=7 - today.weekday())
+        fake_google = MagicMock()
+        fake_google.get_busy_intervals.return_value = {
+            "lia@clinica": [(f"{monday}T10:00:00Z", f"{monday}T11:00:00Z")]  # 07:00-08:00 local
+        }
+        knowledge = {
+            "contato": {"horario_funcionamento": {"segunda_a_sexta": "07h00 às 09h00", "sabado": "Fechado"}},
+            "corpo_clinico": [{"nome": "Dra. Lia", "calendar_id": "lia@clinica"}, {"nome": "Dr. Rui"}],
+        }
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            report_service.record_appointment(
+                conn.cursor(), "Ana", "96 99999-0000", "dra. lia",
+                datetime.datetime.combine(monday, datetime.time(8, 30)))
+            conn.commit()
+        cache = availability_service.AvailabilityCache(
+            lambda: self.app_module.DB_NAME, lambda: fake_google, lambda: knowledge)
+        # Dias fora do cache não esperam o Google: a resposta sai na hora e a carga vai para o fundo
+        with patch.object(cache, '_refresh_async') as load_later:
+            cache.slots("Dra. Lia", monday, 1)
+        load_later.assert_called_once_with(monday, monday + datetime.timedelta(days=13))
+        self.assertEqual(fake_google.get_busy_intervals.call_count, 0)
+        cache.refresh(monday, monday + datetime.timedelta(days=13))
+        with patch('app.availability', cache):
+            data = json.loads(self.client.get(f'/api/calendar/slots?doctor=Dra. Lia&date={monday}&days=6').data)
+            self.assertEqual(data["slots"][monday.isoformat()], ["08:00"])
+            self.assertEqual(len(data["slots"]), 5)  # sábado fechado
+            rui = json.loads(self.client.get(f'/api/calendar/slots?doctor=Dr. Rui&date={monday}&days=1').data)
+            self.assertEqual(rui["slots"][monday.isoformat()], ["07:00", "07:30", "08:00", "08:30"])
+            self.assertEqual(self.client.get('/api/calendar/slots?date=amanha').status_code, 400)
+
+            cache.add_busy("Dr. Rui", datetime.datetime.combine(monday, datetime.time(7, 30)))
+            self.assertFalse(cache.is_free("Dr. Rui", datetime.datetime.combine(monday, datetime.time(7, 30))))
+            self.assertTrue(cache.is_free("Dr. Rui", datetime.datetime.combine(monday, datetime.time(7, 0))))
+        self.assertEqual(fake_google.get_busy_intervals.call_count, 1)
+        # Outra janela soma ao cache em vez de substituir a anterior
+        later = monday + datetime.timedelta(days=28)
+        cache.refresh(later, later)
+        with patch.object(cache, '_refresh_async') as load_later:
+            self.assertFalse(cache.is_free("Dra. Lia", datetime.datetime.combine(monday, datetime.time(7, 0))))
+            cache.slots("Dra. Lia", later, 1)
+        load_later.assert_not_called()
+
+    def test_booking_ledger_rejects_double_booking_and_defers_side_effects(self):
+        import sqlite3
+        import datetime
+        import booking_service
+        day = (datetime.date.today() + datetime.timedelta(days=30)).isoformat()
+        payload = {"name": "Ana", "phone": "96 99999-0000", "doctor": "Dra. Lia", "date": day, "time": "09:00"}
+        free = MagicMock(return_value=True)
+        with patch('app.availability.is_free', free), patch('app.availability.add_busy'), \
+                patch('app.booking_jobs'), patch('app.sheets_outbox'), patch('app.whatsapp_outbox'):
+            hold = self.client.post('/api/calendar/hold', json={"doctor": "dra. lia", "date": day, "time": "09:00"})
+            token = json.loads(hold.data)["hold_token"]
+            self.assertEqual(self.client.post('/api/calendar/book', json=payload).status_code, 409)
+            first = self.client.post('/api/calendar/book', json=dict(payload, hold_token=token))
+            self.assertEqual(first.status_code, 200)
+            again = self.client.post('/api/calendar/book', json=dict(payload, name="Bia"))
+            self.assertEqual(again.status_code, 409)
+        # Sem hold_token a checagem é só no cache em memória, sem ir ao Google
+        self.assertTrue(free.call_args_list and all(c.kwargs.get("load") is False for c in free.call_args_list))
+
+        appointment_id = json.loads(first.data)["appointment_id"]
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT kind, status FROM booking_jobs ORDER BY id")
+            self.assertEqual(cursor.fetchall(), [("calendar", "pending")])
+            booking_service.enqueue_job(cursor, "calendar", {}, cursor.execute("SELECT idempotency_key FROM booking_jobs").fetchone()[0])
+            cursor.execute("SELECT COUNT(*) FROM booking_jobs")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("SELECT dedupe_key, status FROM whatsapp_outbox")
+            self.assertEqual(cursor.fetchall(), [(f"reminder-{appointment_id}", "queued")])
+            conn.commit()
+
+        fake_google = MagicMock()
+        fake_google.create_appointment.side_effect = [None, "https://calendar/evt"]
+        with patch('app.google_service', fake_google):
+            self.app_module.booking_jobs.run_once()
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                conn.execute("UPDATE booking_jobs SET next_attempt_at = 0")
+                conn.commit()
+            self.app_module.booking_jobs.run_once()
+        keys = {c.kwargs["event_id"] for c in fake_google.create_appointment.call_args_list}
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(len(keys.pop()), 32)
+        # Horário da clínica com offset, no mesmo fuso usado pelo free/busy
+        self.assertEqual(fake_google.create_appointment.call_args.args[2], f"{day}T09:00:00-03:00")
+        status = json.loads(self.client.get(f'/api/calendar/appointment/{appointment_id}').data)
+        self.assertEqual(status["link"], "https://calendar/evt")
+
+    def test_knowledge_sync_skips_unchanged_pdfs_and_grounds_chat(self):
+        import sqlite3
+        from concurrent.futures import ThreadPoolExecutor
+        import knowledge_service
+        fake_google = MagicMock()
+        fake_google.list_folder_pdfs.return_value = [
+            {"id": "f1", "name": "Preparo.pdf", "webViewLink": "http://d/f1", "md5Checksum": "a"},
+            {"id": "f2", "name": "Convenios.pdf", "webViewLink": "http://d/f2", "md5Checksum": "b"},
+        ]
+        fake_google.download_file.side_effect = lambda file_id: file_id.encode()
+        pages = {
+            b"f1": ["Para o mapeamento de retina é preciso dilatar a pupila. " * 40],
+            b"f2": ["Aceitamos Unimed e Bradesco Saúde."],
+        }
+        with patch.object(knowledge_service, 'extract_pdf_pages', side_effect=lambda data: pages[data]), \
+                ThreadPoolExecutor(2) as pool, sqlite3.connect(self.app_module.DB_NAME) as conn:
+            stats = knowledge_service.sync_folder(conn, fake_google, "pasta", pool)
+            self.assertEqual((stats["updated"], stats["unchanged"]), (2, 0))
+            fake_google.list_folder_pdfs.return_value[1]["md5Checksum"] = "c"
+            stats = knowledge_service.sync_folder(conn, fake_google, "pasta", pool)
+            self.assertEqual((stats["updated"], stats["unchanged"]), (1, 1))
+            self.assertEqual(fake_google.download_file.call_count, 3)
+
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*), MIN(start_offset) FROM knowledge_chunks WHERE file_id = 'f1'")
+            count, first = cursor.fetchone()
+            self.assertGreater(count, 1)
+            self.assertEqual(first, 0)
+            hits = knowledge_service.search_chunks(cursor, "Vocês aceitam Unimed?")
+            self.assertEqual(hits[0]["name"], "Convenios.pdf")
+
+            # PDF com erro: não é baixado de novo a cada sync, só depois do backoff
+            fake_google.list_folder_pdfs.return_value.append(
+                {"id": "f3", "name": "Quebrado.pdf", "webViewLink": "http://d/f3", "md5Checksum": "d"})
+            pages[b"f3"] = None
+            stats = knowledge_service.sync_folder(conn, fake_google, "pasta", pool)
+            self.assertEqual(stats["failed"], 1)
+            stats = knowledge_service.sync_folder(conn, fake_google, "pasta", pool)
+            self.assertEqual((stats["failed"], stats["unchanged"]), (0, 3))
+            self.assertEqual(fake_google.download_file.call_count, 4)
+            later = time.time() + knowledge_service.RETRY_BASE + 1
+            stats = knowledge_service.sync_folder(conn, fake_google, "pasta", pool, now=later)
+            self.assertEqual(stats["failed"], 1)
+            cursor.execute("SELECT attempts FROM knowledge_files WHERE file_id = 'f3'")
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+        llm = MagicMock(return_value="ok")
+        with patch('app.has_llm_provider', return_value=True), patch('app.llm_chat', llm):
+            self.client.post('/api/chat', json={"message": "Como é o mapeamento de retina?"})
+        prompt = llm.call_args.args[0][0]["content"]
+        self.assertIn("[TRECHOS DOS DOCUMENTOS]", prompt)
+        self.assertIn("dilatar a pupila", prompt)
+
+    def test_exam_index_fuzzy_lookup_and_send(self):
+        import sqlite3
+        import exam_index_service
+        files = [
+            {"id": "a", "name": "João D'Silva - 13-02-2026 - Retinografia.pdf", "webViewLink": "http://d/a", "modifiedTime": "1"},
+            {"id": "b", "name": "joao dsilva 2025-11-02 OCT.pdf", "webViewLink": "http://d/b", "modifiedTime": "1"},
+            {"id": "c", "name": "Maria Souza - 01.03.2026.pdf", "webViewLink": "http://d/c", "modifiedTime": "1"},
+        ]
+        self.assertEqual(exam_index_service.parse_file_name(files[0]["name"]), ("joao silva", "2026-02-13"))
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(exam_index_service.refresh_index(conn, files)["indexed"], 3)
+            self.assertEqual(exam_index_service.refresh_index(conn, files)["indexed"], 0)
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            results = exam_index_service.search(conn.cursor(), "Joao da Silva")
+            self.assertEqual([r["file_id"] for r in results[:2]], ["a", "b"])
+            self.assertEqual(exam_index_service.search(conn.cursor(), "mria sousa")[0]["file_id"], "c")
+        # Sem busca pública na pasta de exames
+        self.assertEqual(self.client.get('/api/exam/search?name=Joao').status_code, 404)
+
+        self._save(name="João D'Silva", phone="96 99999-0000")
+        self._save(name="Maria Souza", phone="96 98888-0000")
+        send = lambda **body: self.client.post('/api/exam/send', json=body)
+        with patch('app.whatsapp_outbox'):
+            r = send(phone="96999990000", name="joão silva")
+            self.assertEqual(r.status_code, 202)
+            self.assertNotIn("http://d/", r.get_data(as_text=True))
+            # Arquivo com o nome grafado diferente ("joao dsilva"): a data escolhe o exame
+            send(phone="(96) 99999-0000", name="Joao D'Silva", date="02/11/2025")
+            # Nome com uma letra trocada ainda acha o exame do cadastro
+            send(phone="96988880000", name="Maria Sousa")
+            # Nome de outra pessoa ou telefone sem cadastro: nada sai
+            for body in ({"phone": "96999990000", "name": "Maria Souza"},
+                         {"phone": "96 97777-0000", "name": "Maria Souza"},
+                         {"phone": "96999990000", "name": "Joao Silveira Santos"}):
+                r = send(**body)
+                self.assertEqual((r.status_code, json.loads(r.data)["status"]), (202, "accepted"))
+            self.assertEqual(send(phone="96999990000").status_code, 400)
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            sent = conn.execute("SELECT phone, message FROM whatsapp_outbox ORDER BY id").fetchall()
+        self.assertEqual(sent, [("96 99999-0000", "Aqui está o link para o seu exame: http://d/a"),
+                                ("96 99999-0000", "Aqui está o link para o seu exame: http://d/b"),
+                                ("96 98888-0000", "Aqui está o link para o seu exame: http://d/c")])
+        # Cadastro de outro paciente com nome parecido não alcança estes arquivos
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(exam_index_service.exams_for_patient(conn.cursor(), "Joana Silveira"), [])
+
+    def test_whatsapp_queue_dedupes_rate_limits_and_retries(self):
+        import whatsapp_service
+        with patch('app.whatsapp_outbox'):
+            first = self.app_module.queue_whatsapp_text("96 99999-0000", "Olá")
+            self.assertEqual(self.app_module.queue_whatsapp_text("96 99999-0000", "Olá"), first)
+            second = self.app_module.queue_whatsapp_text("96 98888-0000", "Olá")
+            third = self.app_module.queue_whatsapp_text("96 97777-0000", "Olá")
+
+        results = {
+            "5596999990000": [{"ok": True, "status": 200, "message_id": "z1"}],
+            "5596988880000": [{"ok": False, "status": 500, "error": "erro"}],
+            "5596977770000": [{"ok": False, "status": 400, "error": "inválido"}],
+        }
+        sender = MagicMock(side_effect=lambda phone, text: results[whatsapp_service.normalize_phone(phone)].pop(0))
+        worker = whatsapp_service.WhatsAppOutboxWorker(lambda: self.app_module.DB_NAME, sender, lambda: True)
+        bucket = worker.bucket()
+        with patch.object(bucket, 'acquire', return_value=True) as acquire:
+            worker.drain_once()
+        self.assertEqual(acquire.call_count, 3)
+        statuses = {i: json.loads(self.client.get(f'/api/whatsapp/messages/{i}').data) for i in (first, second, third)}
+        self.assertEqual((statuses[first]["status"], statuses[first]["zapi_message_id"]), ("sent", "z1"))
+        self.assertEqual((statuses[second]["status"], statuses[second]["attempts"]), ("queued", 1))
+        self.assertEqual(statuses[third]["status"], "failed")
+
+        # Um 'sending' recente é de outro processo; só o abandonado volta para a fila
+        import sqlite3
+        now = time.time()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE whatsapp_outbox SET status = 'sending', updated_at = ? WHERE id = ?", (now, first))
+            conn.execute("UPDATE whatsapp_outbox SET status = 'sending', updated_at = ? WHERE id = ?",
+                         (now - whatsapp_service.SEND_TIMEOUT - 1, third))
+            conn.commit()
+        worker.recover(now=now)
+        self.assertEqual(json.loads(self.client.get(f'/api/whatsapp/messages/{first}').data)["status"], "sending")
+        self.assertEqual(json.loads(self.client.get(f'/api/whatsapp/messages/{third}').data)["status"], "queued")
+
+        # Linha que sai de 'queued' entre o SELECT e o envio não é mandada
+        def cancel_before_claim(stop_event=None):
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                conn.execute("UPDATE whatsapp_outbox SET status = 'cancelled' WHERE id = ?", (third,))
+                conn.commit()
+            return True
+        sender.reset_mock()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE whatsapp_outbox SET next_attempt_at = 0 WHERE id = ?", (third,))
+            conn.commit()
+        with patch.object(bucket, 'acquire', side_effect=cancel_before_claim):
+            worker.drain_once()
+        sender.assert_not_called()
+
+        limiter = whatsapp_service.TokenBucket(rate=1000, capacity=2)
+        started = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.0015)
+
+    def test_zapi_webhook_inbox_dedupes_and_processes(self):
+        import sqlite3
+        import webhook_service
+        with patch('app.whatsapp_outbox'):
+            out_id = self.app_module.queue_whatsapp_text("96 99999-0000", "Lembrete")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE whatsapp_outbox SET status = 'sent', zapi_message_id = 'z1' WHERE id = ?", (out_id,))
+            conn.commit()
+
+        inbound = {"type": "ReceivedCallback", "messageId": "in1", "phone": "5596999990000",
+                   "fromMe": False, "text": {"message": "Quero remarcar"}}
+        events = [
+            inbound, inbound,
+            {"type": "MessageStatusCallback", "status": "READ", "ids": ["z1"]},
+            {"type": "MessageStatusCallback", "status": "RECEIVED", "ids": ["z1"]},
+        ]
+        auth = {"Client-Token": "token-teste"}
+        with patch('app.ZAPI_CLIENT_TOKEN', "token-teste"), patch('app.zapi_inbox') as inbox:
+            replies = [json.loads(self.client.post('/api/webhook/zapi', json=e, headers=auth).data) for e in events]
+            self.assertEqual(self.client.post('/api/webhook/zapi', data="[1]", content_type='application/json',
+                                              headers=auth).status_code, 400)
+            # Sem o token (ou com outro) nada chega à caixa de entrada
+            self.assertEqual(self.client.post('/api/webhook/zapi', json=inbound).status_code, 401)
+            self.assertEqual(self.client.post('/api/webhook/zapi', json=inbound,
+                                              headers={"Client-Token": "outro"}).status_code, 401)
+        self.assertEqual([r["duplicate"] for r in replies], [False, True, False, False])
+        self.assertEqual(inbox.wake.call_count, 3)
+        with patch('app.ZAPI_WEBHOOK_SECRET', "segredo"):
+            self.assertEqual(self.client.post('/api/webhook/zapi?secret=errado', json=inbound).status_code, 401)
+            self.assertEqual(self.client.post('/api/webhook/zapi?secret=segredo', json=inbound).status_code, 200)
+        # Nada configurado: recusa
+        self.assertEqual(self.client.post('/api/webhook/zapi', json=inbound, headers=auth).status_code, 401)
+
+        processor = webhook_service.WebhookInboxProcessor(lambda: self.app_module.DB_NAME, {
+            'received': self.app_module._on_zapi_received,
+            'status': self.app_module._on_zapi_status,
+        })
+        with patch.object(self.app_module.chat_notifier, 'notify') as notify:
+            self.assertEqual(processor.process_once(), 3)
+        notify.assert_called_once_with("whatsapp:5596999990000")
+        self.assertEqual(processor.process_once(), 0)
+
+        history = json.loads(self.client.get('/api/history/whatsapp:5596999990000').data)
+        self.assertEqual((history[0]["sender"], history[0]["message"]), ("user", "Quero remarcar"))
+        # Primeira mensagem do telefone: o Vizô responde com a saudação
+        self.assertEqual([m["sender"] for m in history[1:]], ["bot", "bot"])
+        # O RECEIVED atrasado não desfaz o READ
+        self.assertEqual(json.loads(self.client.get(f'/api/whatsapp/messages/{out_id}').data)["status"], "read")
+
+    def test_appointment_reminders_fire_from_heap_and_catch_up(self):
+        import sqlite3
+        import datetime
+        import reminder_service
+        clinic_tz = self.app_module.availability_service.CLINIC_TZ
+        # Horário da clínica, qualquer que seja o fuso do servidor
+        start = (datetime.datetime.now(clinic_tz) + datetime.timedelta(days=3)).replace(
+            second=0, microsecond=0, tzinfo=None)
+        start_ts = start.replace(tzinfo=clinic_tz).timestamp()
+        payload = {"name": "Ana", "phone": "96 99999-0000", "doctor": "Dra. Lia",
+                   "date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:%M")}
+        with patch('app.availability.is_free', return_value=True), patch('app.availability.add_busy'), \
+                patch('app.booking_jobs'), patch('app.sheets_outbox'), patch('app.whatsapp_outbox'):
+            appointment_id = json.loads(self.client.post('/api/calendar/book', json=payload).data)["appointment_id"]
+
+        def reminders():
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                return dict(conn.execute("SELECT kind, status FROM appointment_reminders ORDER BY kind").fetchall())
+
+        self.assertEqual(reminders(), {"24h": "pending", "2h": "pending"})
+        on_queued = MagicMock()
+        scheduler = reminder_service.ReminderScheduler(lambda: self.app_module.DB_NAME, on_queued)
+        self.assertGreater(scheduler.run_once(), 0)
+        # Horizonte de carga: nada dos próximos dias fica em memória
+        self.assertEqual(scheduler._heap, [])
+
+        day_before = start_ts - 24 * 3600 + 1
+        scheduler.run_once(now=day_before)
+        self.assertEqual(reminders(), {"24h": "sent", "2h": "pending"})
+        on_queued.assert_called_once()
+
+        # Servidor fora do ar até 1 h antes: o 2h sai no catch-up de um scheduler novo
+        restarted = reminder_service.ReminderScheduler(lambda: self.app_module.DB_NAME)
+        restarted.run_once(now=start_ts - 3600)
+        self.assertEqual(reminders(), {"24h": "sent", "2h": "sent"})
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            keys = [r[0] for r in conn.execute("SELECT dedupe_key FROM whatsapp_outbox ORDER BY id")]
+        self.assertEqual(keys, [f"reminder-{appointment_id}", f"reminder-{appointment_id}-24h",
+                                f"reminder-{appointment_id}-2h"])
+
+        # Os dois vencidos juntos: só o mais próximo da consulta é enviado; consulta passada é descartada
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            later = self.app_module.report_service.record_appointment(
+                conn.cursor(), "Bia", "96 98888-0000", "Dra. Lia", start + datetime.timedelta(days=1))
+            reminder_service.schedule_reminders(conn.cursor(), later, start + datetime.timedelta(days=1),
+                                                now=day_before)
+            conn.commit()
+        reminder_service.ReminderScheduler(lambda: self.app_module.DB_NAME).run_once(
+            now=start_ts + 23 * 3600)
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            statuses = dict(conn.execute(
+                "SELECT kind, status FROM appointment_reminders WHERE appointment_id = ?", (later,)).fetchall())
+        self.assertEqual(statuses, {"24h": "skipped", "2h": "sent"})
+
+    def test_campaign_broadcast_checkpoints_and_yields_to_chat(self):
+        import sqlite3
+        import campaign_service
+        import whatsapp_service
+        leads = [("Ana Lima", "96 99999-0001", "instagram", True), ("Bia", "96 99999-0002", "instagram", False),
+                 ("Caio", "96 99999-0003", "facebook", True), ("Duda", "5596999990004", "instagram", True),
+                 ("Duda R.", "96 99999-0004", "instagram", True), ("Eva", "96 99999-0005", "instagram", True)]
+        # Eva pediu para sair antes de virar lead: o opt-out vale mesmo com o aceite no cadastro
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.app_module._on_zapi_received(conn, {"phone": "5596999990005", "text": {"message": "SAIR"}})
+            conn.commit()
+        for name, phone, source, consent in leads:
+            self.client.post('/api/lead/save', json={"name": name, "phone": phone, "source": source,
+                                                     "interest": "óculos", "consent": consent})
+
+        with patch('app.campaign_runner'):
+            created = self.client.post('/api/campaigns/broadcasts', json={
+                "message": "Olá {nome}, temos novidades!", "filters": {"source": "instagram"}})
+        self.assertEqual(created.status_code, 201)
+        campaign = json.loads(created.data)
+        # Duda R. tem o mesmo telefone de Duda e foi mesclado no cadastro
+        self.assertEqual(campaign["total"], 3)
+
+        with patch.object(campaign_service, 'BATCH_SIZE', 2), patch.object(campaign_service, 'MAX_BULK_BACKLOG', 2):
+            campaign_service.CampaignRunner(lambda: self.app_module.DB_NAME).run_once()
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                # Fila em massa cheia: o runner para e espera o envio antes de ler mais leads
+                self.assertEqual(whatsapp_service.queued_bulk(conn.cursor()), 2)
+                first_sent = conn.execute("SELECT MIN(id) FROM whatsapp_outbox").fetchone()[0]
+                conn.execute("UPDATE whatsapp_outbox SET status = 'sent' WHERE id = ?", (first_sent,))
+                conn.commit()
+            with patch('app.whatsapp_outbox'):
+                chat_reply = self.app_module.queue_whatsapp_text("96 98888-0000", "Resposta do atendente")
+            # Processo novo: continua do checkpoint
+            campaign_service.CampaignRunner(lambda: self.app_module.DB_NAME).run_once()
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            rows = conn.execute('''
+                SELECT id, phone, message FROM whatsapp_outbox WHERE status = 'queued'
+                ORDER BY priority ASC, id ASC
+            ''').fetchall()
+        # A resposta do chat sai antes da campanha, mesmo tendo entrado depois
+        self.assertEqual(rows[0][0], chat_reply)
+        self.assertEqual([r[1] for r in rows[1:]], ["5596999990004"])
+        self.assertEqual(rows[1][2], "Olá Duda, temos novidades!")
+
+        progress = json.loads(self.client.get(f'/api/campaigns/broadcasts/{campaign["id"]}').data)
+        self.assertEqual(progress["status"], "done")
+        self.assertEqual(progress["recipients"], {"sent": 1, "queued": 1, "opted_out": 1})
+
+        # Duda pede para sair com a campanha ainda na fila: o envio em massa é
+        # cancelado, mas a resposta normal para o mesmo telefone continua
+        with patch('app.whatsapp_outbox'):
+            reply = self.app_module.queue_whatsapp_text("5596999990004", "Sua consulta está confirmada")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            campaign_service.record_opt_out(conn.cursor(), "(96) 99999-0004")
+            conn.commit()
+            outbox = dict(conn.execute("SELECT id, status FROM whatsapp_outbox WHERE id IN (?, ?)",
+                                       (rows[1][0], reply)).fetchall())
+        self.assertEqual(outbox, {rows[1][0]: "cancelled", reply: "queued"})
+        progress = json.loads(self.client.get(f'/api/campaigns/broadcasts/{campaign["id"]}').data)
+        self.assertEqual(progress["recipients"], {"sent": 1, "cancelled": 1, "opted_out": 1})
+        cancelled =self.client.post(f'/api/campaigns/broadcasts/{campaign["id"]}/cancel')
+        self.assertEqual(cancelled.status_code, 409)
+
+    def test_phone_normalization_backfill_merge_and_lookup(self):
+        import sqlite3
+        import phone_service
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            # Leads antigos, gravados antes da coluna existir
+            conn.executemany('''
+                INSERT INTO patient_leads (created_at, name, phone, status, source, campaign)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [("2026-01-05 10:00:00", "Ana", "96 99160-3396", "Em atendimento", "instagram", "verao"),
+                  ("2026-01-09 10:00:00", "Ana Souza", "5596991603396", "Agendado", "facebook", "retorno"),
+                  ("2026-01-10 10:00:00", "Caio", "123", "Em atendimento", "site", None)])
+            conn.commit()
+            with patch.object(phone_service, 'BACKFILL_BATCH', 2):
+                self.assertEqual(phone_service.backfill(conn, pause=0), 3)
+            self.assertEqual(phone_service.merge_duplicates(conn), 1)
+            plan = " ".join(r[3] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM patient_leads WHERE phone_e164 = ? AND merged_into IS NULL",
+                ("+5596991603396",)))
+            self.assertIn("idx_patient_leads_phone", plan)
+
+        # Contato novo do mesmo paciente entra direto no lead existente
+        self.client.post('/api/lead/save', json={"name": "Ana", "phone": "(96) 99160 3396", "source": "whatsapp"})
+        lead = json.loads(self.client.get('/api/leads/by-phone/+55 96 99160-3396').data)
+        self.assertEqual((lead["name"], lead["status"], lead["source"]), ("Ana", "Em atendimento", "instagram"))
+        self.assertEqual([h["source"] for h in lead["history"]], ["instagram", "facebook", "whatsapp"])
+        leads = json.loads(self.client.get('/api/leads').data)["leads"]
+        self.assertEqual(sorted(l["name"] for l in leads), ["Ana", "Caio"])
+        self.assertEqual(self.client.get('/api/leads/by-phone/123').status_code, 404)
+
+    def test_whatsapp_bot_sessions_follow_transition_table(self):
+        import sqlite3
+        import webhook_service
+        import conversation_service
+        processor = webhook_service.WebhookInboxProcessor(lambda: self.app_module.DB_NAME, {
+            'received': self.app_module._on_zapi_received,
+        })
+        counter = iter(range(1000))
+
+        def say(phone, text):
+            payload = {"type": "ReceivedCallback", "messageId": f"m{next(counter)}", "phone": phone,
+                       "text": {"message": text}}
+            with patch('app.ZAPI_CLIENT_TOKEN', "token-teste"), patch('app.zapi_inbox'):
+                self.client.post('/api/webhook/zapi', json=payload, headers={"Client-Token": "token-teste"})
+            with patch('app.whatsapp_outbox'), patch.object(self.app_module.chat_notifier, 'notify'):
+                processor.process_once()
+
+        def session(phone):
+            with sqlite3.connect(self.app_module.DB_NAME) as conn:
+                return conversation_service.load_session(conn.cursor(), phone)
+
+        for text in ("Oi", "Ana Lima", "1", "Ana Lima", "96 99999-1234", "Sim", "2"):
+            say("5596999991234", text)
+        say("5596988887777", "Olá")
+        ana = session("5596999991234")
+        self.assertEqual((ana.state, ana.doctor), ("MENU", "Dra. Ana Catarina"))
+        self.assertEqual(session("5596988887777").state, "START_DATA")
+        self.assertEqual(self.app_module.whatsapp_bot.cached_sessions(), 2)
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            lead = conn.execute("SELECT name, phone_e164, source, interest, consent FROM patient_leads").fetchone()
+            replies = conn.execute("SELECT COUNT(*) FROM whatsapp_outbox WHERE phone = '5596999991234'").fetchone()[0]
+        # O "Sim" à pergunta de campanhas vira o consentimento do lead
+        self.assertEqual(lead, ("Ana Lima", "+5596999991234", "whatsapp", "Consulta - Dra. Ana Catarina", 1))
+        self.assertGreaterEqual(replies, 6)
+
+        # Sessão sai do cache (LRU) e volta do SQLite; gravação concorrente é detectada pela versão
+        self.app_module.whatsapp_bot.forget("5596999991234")
+        stale = session("5596999991234")
+        say("5596999991234", "3")
+        self.assertEqual(session("5596999991234").state, "ESPECIALISTAS")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            with self.assertRaises(conversation_service.SessionConflict):
+                conversation_service.save_session(conn.cursor(), stale, time.time())
+
+        # Horário de atendimento humano é o da clínica (UTC-3), não o do servidor
+        import datetime
+        def wants_human(utc_hour):
+            at = datetime.datetime(2026, 3, 2, utc_hour, tzinfo=datetime.timezone.utc).timestamp()
+            engine = conversation_service.ConversationEngine(clock=lambda: at)
+            s = conversation_service.SessionState("5596900000000", state="MENU")
+            conversation_service.step(s, "4", engine)
+            return s.state
+        self.assertEqual(wants_human(12), "WAITING_HUMAN")  # 09:00 na clínica
+        self.assertEqual(wants_human(22), "MENU")  # 19:00 na clínica
+
+    def test_metrics_batch_ingestion(self):
+        batch = {"client": "web", "events": [
+            {"session_id": "s1", "timestamp": "2026-01-05T12:00:00", "event": "SESSION_START", "details": {"source": "instagram"}},
+            {"session_id": "s1", "event": "lead_converted", "details": {"nome": "Ana"}},
+            {"session_id": "s1", "details": {}},
+            {"session_id": "s1", "event": "X", "details": "não é objeto"},
+        ]}
+        response = self.client.post('/api/metrics', json=batch)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"status": "success", "accepted": 2, "rejected": 2})
+        # Formato antigo do MetricsLogger: um evento solto
+        self.client.post('/api/metrics', json={"event": "SESSION_START", "details": {}})
+        counts = json.loads(self.client.get('/api/metrics').data)["events"]
+        self.assertEqual(counts, {"SESSION_START": 2, "LEAD_CONVERTED": 1})
+        import sqlite3
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            sources = [r[0] for r in conn.execute("SELECT source FROM funnel_events ORDER BY id")]
+        self.assertEqual(sources, ["instagram", "web", None])
+        self.assertEqual(self.client.post('/api/metrics', json={"events": []}).status_code, 400)
+        with patch('metrics_service.MAX_BATCH', 2):
+            response = self.client.post('/api/metrics', json={"events": [{"event": "A"}] * 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/metrics?since=ontem').status_code, 400)
+
+    def test_super_user_login_without_google_skips_sheet(self):
+        import sqlite3
+        with patch('app.SPREADSHEET_ID', 'planilha'), patch.dict('app.SUPER_USERS', {"Admin": "segredo"}):
+            for _ in range(2):
+                r = self.client.post('/api/auth/login', json={"username": "Admin", "password": "segredo"})
+                self.assertEqual(r.status_code, 200)
+        # Sem Google a linha nunca sairia da fila
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM sheets_outbox").fetchone()[0], 0)
+
+    def test_seed_default_users_keeps_existing_accounts(self):
+        import sqlite3
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("INSERT INTO users (email, name, password_hash) VALUES ('Outra', 'Outra', 'salt:x')")
+            conn.execute("INSERT INTO users (email, name, password_hash) VALUES ('Visitante', 'Visitante', 'salt:trocada')")
+        self.assertEqual(self.app_module.seed_default_users(), 3)
+        self.assertEqual(self.app_module.seed_default_users(), 0)
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            users = dict(conn.execute("SELECT email, password_hash FROM users"))
+        self.assertEqual(len(users), 5)
+        self.assertEqual(users["Visitante"], "salt:trocada")
+        self.assertTrue(self.app_module._verify_password(users["Iran Lima"], "Iran3791"))
+
+    def test_import_is_lazy_and_startup_is_reported(self):
+        import subprocess
+        code = (
+            "import sys, app\n"
+            "print(sorted(m for m in ('openai', 'google_service', 'elevenlabs') if m in sys.modules))\n"
+            "print(app.google_service is app._NOT_LOADED, app.client is app._NOT_LOADED)\n"
+        )
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.stdout.split("\n")[:2], ["[]", "True True"], out.stderr)
+        report = json.loads(self.client.get('/api/startup').data)
+        self.assertIn("import", report)
+        self.assertIn("init_db", report)
+        # Sem SEED_DEFAULT_USERS a startup não cria usuários
+        import sqlite3
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM users").fetchone()[0], 0)
+
+    def test_handover_queue_claim_release_and_stream(self):
+        import sqlite3
+        import conversation_service
+        notify = lambda **body: json.loads(self.client.post('/api/notify_attendant', json=body).data)
+        with patch.object(self.app_module.handover_notifier, 'notify') as pushed:
+            first = notify(session_id="sess_a", name="Ana", phone="96 99999-1111")
+            again = notify(session_id="sess_a", name="Ana", phone="96 99999-1111")
+            second = notify(name="Bia", phone="96 98888-2222")
+        self.assertEqual((first["position"], first["duplicate"]), (1, False))
+        self.assertEqual((again["ticket_id"], again["duplicate"]), (first["ticket_id"], True))
+        self.assertEqual(second["position"], 2)
+        self.assertEqual(pushed.call_count, 2)
+        self.assertEqual(self.client.post('/api/notify_attendant', json={}).status_code, 400)
+
+        act = lambda ticket, action, who: self.client.post(f'/api/handover/{ticket}/{action}', json={"attendant": who})
+        self.assertEqual(act(first["ticket_id"], "claim", "Mylla").status_code, 200)
+        # Dois consoles no mesmo ticket: só o primeiro leva
+        self.assertEqual(act(first["ticket_id"], "claim", "Iran").status_code, 409)
+        self.assertEqual(act(first["ticket_id"], "close", "Iran").status_code, 409)
+        self.assertEqual(act(999, "claim", "Iran").status_code, 404)
+        self.assertEqual(act(first["ticket_id"], "claim", "").status_code, 400)
+        nxt = json.loads(self.client.post('/api/handover/next', json={"attendant": "Iran"}).data)
+        self.assertEqual((nxt["id"], nxt["session_id"]), (second["ticket_id"], "web:96 98888-2222"))
+        self.assertEqual(self.client.post('/api/handover/next', json={"attendant": "Iran"}).status_code, 404)
+        self.assertEqual(act(second["ticket_id"], "release", "Iran").status_code, 200)
+        self.assertEqual(act(first["ticket_id"], "close", "Mylla").status_code, 200)
+
+        # Tempos medidos pelo ticket
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.execute("UPDATE handover_tickets SET created_at = first_claimed_at - 30, closed_at = first_claimed_at + 125 WHERE id = ?", (first["ticket_id"],))
+            conn.execute("UPDATE handover_tickets SET created_at = first_claimed_at - 90 WHERE id = ?", (second["ticket_id"],))
+        overview = json.loads(self.client.get('/api/dashboard/overview').data)["overview"]
+        self.assertEqual((overview["avgWaitTime"], overview["avgHandleTime"]), ("1m 0s", "2m 5s"))
+        self.assertEqual(overview["waitingForAttendant"], 1)
+        queue = json.loads(self.client.get('/api/handover/queue').data)
+        self.assertEqual([t["id"] for t in queue["tickets"]], [second["ticket_id"]])
+
+        # WhatsApp: pedido pelo bot abre ticket; "cancelar" na espera abandona
+        session = conversation_service.SessionState("5596977776666", name="Caio")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.app_module._bot_handover_requested(conn.cursor(), session)
+            self.app_module._bot_handover_cancelled(conn.cursor(), session)
+            status = conn.execute("SELECT status FROM handover_tickets WHERE session_id = 'whatsapp:5596977776666'").fetchone()[0]
+        self.assertEqual(status, "abandoned")
+
+        # Atendente encerra um ticket do WhatsApp: o bot volta ao menu para esse telefone
+        waiting = conversation_service.SessionState("5596966665555", state="WAITING_HUMAN", name="Duda")
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conversation_service.save_session(conn.cursor(), waiting, time.time())
+            self.app_module._bot_handover_requested(conn.cursor(), waiting)
+            conn.commit()
+            ticket_id = conn.execute(
+                "SELECT id FROM handover_tickets WHERE session_id = 'whatsapp:5596966665555'").fetchone()[0]
+        self.app_module.whatsapp_bot.remember(waiting)
+        self.assertEqual(act(ticket_id, "claim", "Mylla").status_code, 200)
+        self.assertEqual(act(ticket_id, "close", "Mylla").status_code, 200)
+        self.assertIsNone(self.app_module.whatsapp_bot._cached("5596966665555"))
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            self.assertEqual(conversation_service.load_session(conn.cursor(), "5596966665555").state, "MENU")
+
+        # SSE: snapshot da fila ao conectar; retomando com Last-Event-ID vêm os eventos
+        response = self.client.get('/api/handover/stream')
+        snapshot = next(response.response).decode()
+        response.close()
+        self.assertIn("event: snapshot", snapshot)
+        self.assertIn('"name": "Bia"', snapshot)
+        response = self.client.get('/api/handover/stream', headers={"Last-Event-ID": "0"})
+        chunks = [next(response.response).decode() for _ in range(3)]
+        response.close()
+        self.assertTrue(all(c.startswith("id: ") and "event: ticket" in c for c in chunks))
+        self.assertIn('"kind": "opened"', chunks[0])
+        self.assertIn('"kind": "claimed"', chunks[2])
+
+    def test_session_stats_incremental_kpis(self):
+        import sqlite3
+        import time
+        import session_stats_service
+        now = time.time()
+        utc = lambda offset: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now + offset))
+        logs = [
+            ("whatsapp:5596991112222", "user", -7200), ("whatsapp:5596991112222", "attendant", -7170),
+            ("sess_web", "user", -120), ("sess_web", "bot", -116),
+            # Mesma conversa de WhatsApp depois de 2 h: sessão nova
+            ("whatsapp:5596991112222", "user", -90), ("whatsapp:5596991112222", "bot", -88),
+            ("sess_web", "user", -60),
+        ]
+        self.app_module.startup()
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            conn.executemany(
+                "INSERT INTO chat_logs (session_id, sender, message, timestamp) VALUES (?, ?, 'oi', ?)",
+                [(s, sender, utc(offset)) for s, sender, offset in logs]
+            )
+            conn.commit()
+        self.client.post('/api/metrics', json={"events": [{"event": "LEAD_CONVERTED", "session_id": "sess_web"}]})
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            # Lotes pequenos: cada um continua de onde o anterior parou
+            batches = []
+            while True:
+                result = session_stats_service.process_batch(conn, limit=3, now=now)
+                if not result["messages"] and not result["events"]:
+                    break
+                batches.append(result["messages"])
+            self.assertEqual(batches, [3, 3, 1])
+            rows = conn.execute('''
+                SELECT session_id, channel, user_messages, bot_messages + attendant_messages,
+                       ROUND(first_response_seconds), ROUND(ended_at - started_at), lead_captured
+                FROM chat_sessions ORDER BY started_at
+            ''').fetchall()
+        self.assertEqual(rows, [
+            ("whatsapp:5596991112222", "whatsapp", 1, 1, 30.0, 30.0, 0),
+            ("sess_web", "web", 2, 1, 4.0, 60.0, 1),
+            ("whatsapp:5596991112222", "whatsapp", 1, 1, 2.0, 2.0, 0),
+        ])
+
+        with sqlite3.connect(self.app_module.DB_NAME) as conn:
+            kpis = session_stats_service.kpis(conn.cursor(), now=now)
+        self.assertEqual((kpis["sessions"], kpis["active_chats"], kpis["leads"]), (3, 2, 1))
+        self.assertAlmostEqual(kpis["avg_first_response"], 12.0, places=0)
+        overview = json.loads(self.client.get('/api/dashboard/overview').data)["overview"]
+        self.assertEqual((overview["activeChats"], overview["chatSessions"]), (2, 3))
+        self.assertEqual((overview["avgSessionDuration"], overview["avgFirstResponseTime"]), ("31s", "12s"))
+        self.assertEqual(overview["leadCaptureRate"], 33.3)
+
+
+class TestGoogleServiceClients(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        import google_service
+        self.google_service = google_service
+        with patch.object(google_service.GoogleService, 'authenticate'):
+            self.gs = google_service.GoogleService()
+        self.gs.creds = MagicMock()
+        self.gs.creds.token = "token"
+        self.gs.creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def test_resources_built_once_per_thread(self):
+        import threading
+        with patch.object(self.google_service, 'build') as mock_build:
+            self.gs.add_lead_to_sheets("sheet", ["a"])
+            self.gs.add_lead_to_sheets("sheet", ["b"])
+            self.gs.list_knowledge_files("folder")
+            self.assertEqual(mock_build.call_count, 2)
+            self.assertTrue(all(c.kwargs.get('static_discovery') for c in mock_build.call_args_list))
+            worker = threading.Thread(target=self.gs.add_lead_to_sheets, args=("sheet", ["c"]))
+            worker.start()
+            worker.join()
+            self.assertEqual(mock_build.call_count, 3)
+        self.gs.creds.refresh.assert_not_called()
+
+    def test_token_refreshed_before_expiry(self):
+        import datetime
+        self.gs.creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        with patch.object(self.google_service, 'build'):
+            self.gs.add_lead_to_sheets("sheet", ["a"])
+        self.gs.creds.refresh.assert_called_once()
+
+    def test_duplicate_event_lookup_failure_is_absorbed(self):
+        from googleapiclient.errors import HttpError
+
+        def http_error(status):
+            return HttpError(MagicMock(status=status), b'{}')
+
+        with patch.object(self.google_service, 'build') as mock_build:
+            events = mock_build.return_value.events.return_value
+            events.insert.return_value.execute.side_effect = http_error(409)
+            events.get.return_value.execute.return_value = {"htmlLink": "https://calendar/evt"}
+            self.assertEqual(self.gs.create_appointment(
+                "s", "d", "2026-02-13T10:00:00-03:00", event_id="abc"), "https://calendar/evt")
+            events.get.return_value.execute.side_effect = http_error(404)
+            self.assertIsNone(self.gs.create_appointment(
+                "s", "d", "2026-02-13T10:00:00-03:00", event_id="abc"))
+
 if __name__ == '__main__':
     unittest.main()
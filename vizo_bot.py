@@ -3,64 +3,228 @@ import sys
 import json
 import requests
 import os
+import uuid
+import queue
+import threading
 from datetime import datetime
+import importlib
 from dotenv import load_dotenv
-from voice_service import VoiceService
-from google_service import GoogleService
-from openai import OpenAI
+from conversation_service import ESPECIALISTAS
 
 load_dotenv()
 
+# Voz (elevenlabs), Google e DeepSeek (openai) só são importados e criados no
+# primeiro uso, então o terminal abre na hora. Os nomes ficam no módulo para
+# poderem ser substituídos nos testes.
+_NOT_LOADED = object()
+VoiceService = GoogleService = OpenAI = _NOT_LOADED
+_LAZY_IMPORTS = {
+    "VoiceService": ("voice_service", "VoiceService"),
+    "GoogleService": ("google_service", "GoogleService"),
+    "OpenAI": ("openai", "OpenAI"),
+}
+
+
+def _lazy(name):
+    if globals()[name] is _NOT_LOADED:
+        module, attr = _LAZY_IMPORTS[name]
+        try:
+            globals()[name] = getattr(importlib.import_module(module), attr)
+        except Exception:
+            globals()[name] = None
+    return globals()[name]
+
 class MetricsLogger:
-    def __init__(self, api_url="http://localhost:5000/api/metrics"):
-        self.api_url = api_url
+    """Envia os eventos do funil para /api/metrics em lotes, numa thread própria.
+
+    log_event() nunca espera a rede: o evento entra num buffer limitado e a
+    thread envia quando junta `batch_size` eventos ou a cada `flush_interval`
+    segundos. Com o buffer cheio (API fora do ar, rede lenta) o evento é
+    descartado e contado em `dropped`; um lote que falha também é descartado.
+    """
+
+    def __init__(self, api_url=None, sink=None, batch_size=20, flush_interval=5.0, max_buffer=1000):
+        self.api_url = api_url or os.getenv("VIZO_METRICS_URL", "http://localhost:5000/api/metrics")
+        self.session_id = f"term_{uuid.uuid4().hex[:12]}"
         self.session_start = None
+        # Modo headless: os eventos vão para `sink(evento, detalhes)` em vez do terminal
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sent = 0
+        self.dropped = 0
+        self._buffer = queue.Queue(maxsize=max_buffer)
+        self._thread = None
+        self._lock = threading.Lock()
 
     def log_event(self, event_type, details=None):
+        if self.sink:
+            self.sink(event_type, details or {})
+            return
         payload = {
+            "session_id": self.session_id,
             "timestamp": datetime.now().isoformat(),
             "event": event_type,
             "details": details or {}
         }
-        # Em produção, descomentar o envio real:
-        # try:
-        #     requests.post(self.api_url, json=payload, timeout=2)
-        # except:
-        #     pass # Falha silenciosa para não travar o bot
-        
+        self._enqueue(payload)
         # Para debug local:
         print(f"\n[METRICS] Event: {event_type} | Data: {json.dumps(details)}")
 
+    def flush(self, timeout=2.0):
+        """Pede o envio imediato do que está no buffer e espera até `timeout` segundos."""
+        if not self._thread:
+            return True
+        done = threading.Event()
+        if not self._enqueue(done):
+            return False
+        return done.wait(timeout)
+
+    def _enqueue(self, item):
+        try:
+            self._buffer.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self._ensure_thread()
+        return True
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="metrics-logger", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch, flushed = [], []
+            item = self._buffer.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    flushed.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self._buffer.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._send(batch)
+            for done in flushed:
+                done.set()
+
+    def _send(self, batch):
+        try:
+            response = requests.post(self.api_url, json={"client": "terminal", "events": batch}, timeout=2)
+            response.raise_for_status()
+            self.sent += len(batch)
+        except Exception:
+            # Falha silenciosa para não travar o bot
+            self.dropped += len(batch)
+
 class VizoBot:
-    def __init__(self):
+    """Bot do terminal. Com headless=True não imprime, não fala e não dorme: cada
+    resposta vira um evento {"type": "say"|"text"|"metric", ...} em self.events
+    (veja handle()), e os efeitos colaterais vêm injetados pelo construtor.
+    """
+
+    def __init__(self, headless=False, google_service=None, ai_client=None, voice_service=None,
+                 on_booking=None, on_handover=None, clock=None):
+        self.headless = headless
         self.state = "MENU"
         self.user_data = {}
-        self.metrics = MetricsLogger()
+        self.events = []
+        self.metrics = MetricsLogger(sink=self._emit_metric if headless else None)
         self.start_time = None
-        self.especialistas = [
-            "Dr. Lucas Rezende", "Dra. Ana Catarina", "Dr. Tarcísio Guerra",
-            "Dr. Augusto Almeida", "Dra. Nabila Demachki", "Dra. Roseni Lopes",
-            "Dra. Michele Gonçalves"
-        ]
+        self._on_booking = on_booking
+        # on_handover(user_data) -> {"ticket_id", "position"} | None; sem ele, o terminal
+        # chama /api/notify_attendant (headless: ninguém é avisado)
+        self._on_handover = on_handover or (None if headless else self._notify_attendant)
+        self._clock = clock or datetime.now
+        # Lista compartilhada com o bot do WhatsApp (não é copiada por sessão)
+        self.especialistas = ESPECIALISTAS
+
+        if headless:
+            # Nada de OAuth, rede ou áudio: só o que foi injetado
+            self._google_service = google_service
+            self._deepseek_client = ai_client
+            self._voice_service = voice_service
+            self.voice_enabled = False
+            return
 
-        # Initialize Google Service
-        try:
-            self.google_service = GoogleService()
-        except:
-            self.google_service = None
-            
-        # Initialize DeepSeek
-        deepseek_key = os.getenv("DEEPSEEK_API_KEY")
-        self.deepseek_client = OpenAI(api_key=deepseek_key, base_url="https://api.deepseek.com") if deepseek_key else None
-        
-        # Initialize Voice Service
-        self.voice_service = VoiceService()
+        # Criados no primeiro uso (veja as propriedades abaixo)
+        self._google_service = google_service or _NOT_LOADED
+        self._deepseek_client = ai_client or _NOT_LOADED
+        self._voice_service = voice_service or _NOT_LOADED
         self.voice_enabled = True
 
+    @property
+    def google_service(self):
+        if self._google_service is _NOT_LOADED:
+            try:
+                service_class = _lazy("GoogleService")
+                self._google_service = service_class() if service_class else None
+            except Exception:
+                self._google_service = None
+        return self._google_service
+
+    @google_service.setter
+    def google_service(self, value):
+        self._google_service = value
+
+    @property
+    def deepseek_client(self):
+        if self._deepseek_client is _NOT_LOADED:
+            deepseek_key = os.getenv("DEEPSEEK_API_KEY")
+            openai_class = _lazy("OpenAI") if deepseek_key else None
+            self._deepseek_client = openai_class(api_key=deepseek_key, base_url="https://api.deepseek.com") if openai_class else None
+        return self._deepseek_client
+
+    @deepseek_client.setter
+    def deepseek_client(self, value):
+        self._deepseek_client = value
+
+    @property
+    def voice_service(self):
+        if self._voice_service is _NOT_LOADED:
+            voice_class = _lazy("VoiceService")
+            self._voice_service = voice_class() if voice_class else None
+        return self._voice_service
+
+    @voice_service.setter
+    def voice_service(self, value):
+        self._voice_service = value
+
+    def _emit_metric(self, event_type, details):
+        self.events.append({"type": "metric", "event": event_type, "details": details})
+
+    def show(self, text):
+        """Texto só de tela (listas, opções): no terminal é impresso, sem voz."""
+        if self.headless:
+            self.events.append({"type": "text", "text": text.strip("\n")})
+        else:
+            print(text)
+
+    def take_events(self):
+        events, self.events = self.events, []
+        return events
+
+    def handle(self, user_input):
+        """Processa uma entrada e devolve (eventos de resposta, conversa continua?)."""
+        running = self.process_input(user_input)
+        return self.take_events(), running
 
     def print_slow(self, text):
+        if self.headless:
+            self.events.append({"type": "say", "text": text.strip("\n")})
+            return
         print(text)
-        if self.voice_enabled:
+        if self.voice_enabled and self.voice_service:
             # Clean text for speech (remove emojis if needed, though TucujuLabs handles some well or ignores them)
             # Remove markdown bolding **
             clean_text = text.replace("**", "")
@@ -98,15 +262,15 @@ class VizoBot:
         # Campaign Check
         settings = self.load_campaign_settings()
         if settings.get('active_campaign'):
-            print(f"\n📢 DESTAQUE: {settings.get('campaign_message')}")
-
-        print("\n1️⃣ Agendar consulta")
-        print("2️⃣ Saber sobre exames")
-        print("3️⃣ Conhecer nossos especialistas")
-        print("4️⃣ Falar com atendente humano")
-        print("5️⃣ Capacidades Técnicas (QD Synapse)")
-        print("0️⃣ Sair")
-        print(self.disclaimer())
+            self.show(f"\n📢 DESTAQUE: {settings.get('campaign_message')}")
+
+        self.show("\n1️⃣ Agendar consulta")
+        self.show("2️⃣ Saber sobre exames")
+        self.show("3️⃣ Conhecer nossos especialistas")
+        self.show("4️⃣ Falar com atendente humano")
+        self.show("5️⃣ Capacidades Técnicas (QD Synapse)")
+        self.show("0️⃣ Sair")
+        self.show(self.disclaimer())
         self.state = "MENU"
 
     def process_input(self, user_input):
@@ -122,7 +286,7 @@ class VizoBot:
         if user_input == "0":
             duration = time.time() - self.start_time if self.start_time else 0
             self.metrics.log_event("SESSION_END", {"duration_seconds": round(duration, 2)})
-            print("\n👁️ Obrigado por falar com a Pró-Visão! Até logo. 🌿")
+            self.show("\n👁️ Obrigado por falar com a Pró-Visão! Até logo. 🌿")
             return False
 
         if self.state == "START_DATA":
@@ -164,7 +328,7 @@ class VizoBot:
                             ]
                         )
                         self.print_slow(resp.choices[0].message.content)
-                        print("\nComo mais posso ajudar?")
+                        self.show("\nComo mais posso ajudar?")
                     except:
                         self.print_slow("\nEstou com dificuldades para pensar... Vamos usar o menu?")
                         self.show_menu()
@@ -197,8 +361,10 @@ class VizoBot:
                     self.metrics.log_event("APPOINTMENT_SCHEDULED", {"doctor": medico})
                     self.print_slow(f"\nÓtima escolha! Agendamento pré-confirmado com {medico}. 👩‍⚕️✨")
                     
+                    if self._on_booking:
+                        self._on_booking(dict(self.user_data), medico)
                     # Sincronização Google REAL
-                    if self.google_service:
+                    elif self.google_service:
                         summary = f"Cons. Terminal: {self.user_data.get('nome')}"
                         desc = f"Fone: {self.user_data.get('whatsapp')}\nVia Terminal Vizo"
                         now = datetime.now().isoformat() + 'Z'
@@ -231,7 +397,7 @@ class VizoBot:
         return True
 
     def initiate_handover(self):
-        now = datetime.now()
+        now = self._clock()
         hour = now.hour
         if hour < 7 or hour >= 18:
             self.print_slow("\nNeste momento estamos fora do nosso horário de atendimento humano (7h00 às 18h00).")
@@ -243,14 +409,16 @@ class VizoBot:
         self.print_slow("\n🔄 Buscando um especialista disponível...")
         self.state = "WAITING_HUMAN"
         
-        atendente_numero = "96 99160-3396"
-        self.print_slow("Um de nossos atendentes humanos irá assumir em breve. Por favor, aguarde... ⏳")
-        
-        time.sleep(2)
+        ticket = self._on_handover(dict(self.user_data)) if self._on_handover else None
         
         link_whatsapp = "https://wa.me/5596991603396?text=Olá,%20vim%20pelo%20site%20e%20gostaria%20de%20atendimento."
         
-        self.print_slow(f"\n🔔 *Atendente notificado!*\n")
+        if ticket:
+            position = ticket.get("position")
+            self.print_slow(f"\n🔔 *Atendente notificado!*{f' Você é o {position}º da fila.' if position else ''}\n")
+            self.print_slow("Um de nossos atendentes humanos irá assumir em breve. Por favor, aguarde... ⏳")
+        else:
+            self.print_slow("\nNão consegui avisar a equipe agora.")
         self.print_slow(f"Caso prefira agilizar, copie e acesse o link abaixo no seu navegador para chamar diretamente no WhatsApp:")
         self.print_slow(f"\n👉 {link_whatsapp}\n")
         self.print_slow("(Copie e cole este link no seu navegador para iniciar a conversa real)")
@@ -258,39 +426,57 @@ class VizoBot:
         self.print_slow("\nPressione Enter para voltar ao menu principal...")
         self.state = "MENU"
 
+    def _notify_attendant(self, user_data):
+        info = user_data.get("info_inicial", "")
+        try:
+            response = requests.post(
+                os.getenv("VIZO_API_URL", "http://localhost:5000") + "/api/notify_attendant",
+                json={
+                    "session_id": self.metrics.session_id,
+                    "channel": "terminal",
+                    "name": user_data.get("nome") or info or "Visitante",
+                    "phone": user_data.get("whatsapp"),
+                },
+                timeout=2,
+            )
+            response.raise_for_status()
+            return response.json()
+        except Exception:
+            return None
+
     def show_exames(self):
         self.print_slow("\nAqui na Pró-Visão, nós cuidamos de tudo em um só lugar! 👁️✨")
         self.print_slow("Dispomos de equipamentos novos de altíssima precisão. Realizamos:")
-        print("- Topografia de Córnea")
-        print("- Mapeamento de Retina")
-        print("- Campimetria Computadorizada")
-        print("- Biometria Óptica")
-        print("- Tomografia de Coerência Óptica (OCT)")
+        self.show("- Topografia de Córnea")
+        self.show("- Mapeamento de Retina")
+        self.show("- Campimetria Computadorizada")
+        self.show("- Biometria Óptica")
+        self.show("- Tomografia de Coerência Óptica (OCT)")
         self.print_slow("\nDeseja agendar exames? (1=Sim / 2=Voltar)")
         self.state = "EXAMES"
 
     def show_especialistas(self):
         self.print_slow("\nConheça nossos especialistas:")
         for medico in self.especialistas:
-            print(f"👨‍⚕️ {medico}")
+            self.show(f"👨‍⚕️ {medico}")
         self.print_slow("\nDeseja agendar? (1=Sim / 2=Voltar)")
         self.state = "ESPECIALISTAS"
 
     def show_especialistas_list(self):
-        print("\nEscolha o especialista:")
+        self.show("\nEscolha o especialista:")
         for i, medico in enumerate(self.especialistas):
-            print(f"{i+1}️⃣ {medico}")
-        print("8️⃣ Qualquer especialista")
+            self.show(f"{i+1}️⃣ {medico}")
+        self.show("8️⃣ Qualquer especialista")
 
     def show_tech_capabilities(self):
         self.print_slow("\n🚀 **Capacidades Técnicas do Vizô (QD Synapse)** 🌿")
         self.print_slow("A QD Synapse é uma startup orgulhosamente amazônida! 🇧🇷")
         self.print_slow("O Vizô pode ser personalizado para atender diversas necessidades, como:")
-        print("- Integração com sistemas de agendamento e prontuários (ERP/CRM)")
-        print("- Dashboards de métricas em tempo real para gestão")
-        print("- Personalização avançada de fluxos de conversa (NLP/IA)")
-        print("- Suporte Omnichannel (WhatsApp, Web, Instagram, Telegram)")
-        print("- Automação de follow-up e pesquisa de satisfação")
+        self.show("- Integração com sistemas de agendamento e prontuários (ERP/CRM)")
+        self.show("- Dashboards de métricas em tempo real para gestão")
+        self.show("- Personalização avançada de fluxos de conversa (NLP/IA)")
+        self.show("- Suporte Omnichannel (WhatsApp, Web, Instagram, Telegram)")
+        self.show("- Automação de follow-up e pesquisa de satisfação")
         self.print_slow("\nEntre em contato conosco para transformar o atendimento da sua clínica!")
         self.print_slow("\nPressione Enter para voltar ao menu principal...")
         self.state = "MENU"
@@ -312,3 +498,5 @@ if __name__ == "__main__":
         except (KeyboardInterrupt, EOFError):
             print("\nEncerrando...")
             break
+    # Envia o que ficou no buffer antes de sair
+    bot.metrics.flush()
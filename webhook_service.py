@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Entrada dos webhooks do Z-API. O endpoint só valida o payload, grava em
+# zapi_inbox (chave única por evento, então reenvios do Z-API são
+# descartados) e responde; o processamento fica com o WebhookInboxProcessor,
+# um pool de threads que pega lotes de eventos pendentes e chama o handler
+# de cada tipo: recebida, status, entrega.
+
+WORKERS = int(os.getenv("ZAPI_INBOX_WORKERS", "2"))
+MAX_ATTEMPTS = int(os.getenv("ZAPI_INBOX_MAX_ATTEMPTS", "5"))
+CLAIM_BATCH = 20
+# Evento em 'processing' há mais que isso é considerado abandonado (worker caiu)
+STALE_CLAIM_SECONDS = 300
+DONE_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+def init_webhook_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS zapi_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_at REAL,
+            received_at REAL NOT NULL,
+            processed_at REAL,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_zapi_inbox_status ON zapi_inbox (status, id)")
+
+
+def classify(payload):
+    """Tipo do evento: 'received', 'status', 'delivery' ou 'other'."""
+    kind = str(payload.get("type") or payload.get("event") or "")
+    if kind == "ReceivedCallback":
+        return "received"
+    if kind == "MessageStatusCallback":
+        return "status"
+    if kind == "DeliveryCallback":
+        return "delivery"
+    return "other"
+
+
+def event_key(kind, payload, raw):
+    """Chave de deduplicação: o id da mensagem no Z-API (mais o status, para recibos)."""
+    if kind == "status" and payload.get("ids"):
+        return f"status:{payload.get('status')}:{','.join(sorted(map(str, payload['ids'])))}"
+    message_id = payload.get("messageId") or payload.get("zaapId")
+    if message_id:
+        return f"{kind}:{message_id}"
+    return "raw:" + hashlib.sha1(raw).hexdigest()
+
+
+def ingest(cursor, raw):
+    """Grava o webhook na caixa de entrada (sem commit). Retorna (id, duplicado)."""
+    try:
+        payload = json.loads(raw or b"")
+    except ValueError:
+        raise InvalidPayload("JSON inválido")
+    if not isinstance(payload, dict):
+        raise InvalidPayload("Payload deve ser um objeto")
+    kind = classify(payload)
+    key = event_key(kind, payload, raw)
+    cursor.execute('''
+        INSERT OR IGNORE INTO zapi_inbox (event_key, kind, payload, received_at)
+        VALUES (?, ?, ?, ?)
+    ''', (key, kind, raw.decode("utf-8", "replace") if isinstance(raw, bytes) else raw, time.time()))
+    if cursor.rowcount:
+        return cursor.lastrowid, False
+    return None, True
+
+
+def backlog(cursor):
+    cursor.execute("SELECT status, COUNT(*) FROM zapi_inbox GROUP BY status")
+    return dict(cursor.fetchall())
+
+
+class WebhookInboxProcessor:
+    """Pool de threads que processa zapi_inbox.
+
+    `handlers` mapeia kind -> função(conn, payload). A função roda dentro da
+    transação que marca o evento como 'done', então efeito e marcação são
+    gravados juntos; se ela devolver uma função, esta é chamada depois do
+    commit (para acordar quem espera). Exceção = nova tentativa (até
+    MAX_ATTEMPTS).
+    """
+
+    def __init__(self, db_path_getter, handlers, workers=WORKERS):
+        self._db_path_getter = db_path_getter
+        self.handlers = handlers
+        self.workers = max(1, workers)
+        self._wake = threading.Condition()
+        self._pending_signal = 0
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"zapi-inbox-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        self.wake()
+
+    def wake(self):
+        with self._wake:
+            self._pending_signal += 1
+            self._wake.notify()
+
+    def _claim(self, conn):
+        now = time.time()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE zapi_inbox SET status = 'processing', claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM zapi_inbox
+                WHERE status = 'pending' OR (status = 'processing' AND claimed_at < ?)
+                ORDER BY id ASC
+                LIMIT ?
+            )
+            RETURNING id, kind, payload, attempts
+        ''', (now, now - STALE_CLAIM_SECONDS, CLAIM_BATCH))
+        rows = cursor.fetchall()
+        conn.commit()
+        return sorted(rows)
+
+    def process_once(self):
+        """Processa um lote. Retorna quantos eventos foram pegos."""
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            rows = self._claim(conn)
+            for event_id, kind, payload, attempts in rows:
+                handler = self.handlers.get(kind)
+                after_commit = None
+                try:
+                    if handler:
+                        after_commit = handler(conn, json.loads(payload))
+                    conn.execute(
+                        "UPDATE zapi_inbox SET status = 'done', processed_at = ?, last_error = NULL WHERE id = ?",
+                        (time.time(), event_id)
+                    )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    attempts += 1
+                    logger.warning(f"Webhook Z-API #{event_id} ({kind}) falhou: {e}")
+                    conn.execute('''
+                        UPDATE zapi_inbox SET status = ?, attempts = ?, last_error = ?
+                        WHERE id = ?
+                    ''', ('failed' if attempts >= MAX_ATTEMPTS else 'pending', attempts, str(e)[:500], event_id))
+                    conn.commit()
+                    continue
+                if callable(after_commit):
+                    after_commit()
+            if not rows:
+                conn.execute(
+                    "DELETE FROM zapi_inbox WHERE status = 'done' AND processed_at < ?",
+                    (time.time() - DONE_RETENTION_SECONDS,)
+                )
+                conn.commit()
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.process_once()
+            except Exception as e:
+                logger.error(f"Erro no processamento de webhooks Z-API: {e}")
+                claimed = 0
+            if claimed:
+                continue
+            with self._wake:
+                if not self._pending_signal:
+                    self._wake.wait(30)
+                self._pending_signal = max(0, self._pending_signal - 1)
@@ -0,0 +1,320 @@
+import os
+import re
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fila persistente de mensagens de saída do WhatsApp (Z-API). Quem envia
+# grava em whatsapp_outbox e recebe o id na hora; o WhatsAppOutboxWorker
+# manda as mensagens respeitando um token bucket por instância, com novas
+# tentativas e backoff. A dedupe_key é UNIQUE: um clique duplo (ou a mesma
+# tarefa repetida) devolve o id da mensagem que já está na fila.
+#
+# A entrega é "pelo menos uma vez": se o processo cair no meio de um envio,
+# a mensagem volta para a fila ao reiniciar.
+
+RATE_PER_SECOND = float(os.getenv("ZAPI_RATE_PER_SECOND", "1"))
+BURST = int(os.getenv("ZAPI_BURST", "5"))
+MAX_ATTEMPTS = int(os.getenv("WHATSAPP_MAX_ATTEMPTS", "6"))
+BASE_BACKOFF = float(os.getenv("WHATSAPP_BACKOFF", "5"))
+MAX_BACKOFF = 1800
+DEDUPE_WINDOW = int(os.getenv("WHATSAPP_DEDUPE_WINDOW", "600"))
+BATCH_SIZE = 50
+# Uma mensagem em 'sending' há mais que isso foi abandonada por um processo
+# que caiu (o envio ao Z-API tem timeout bem menor).
+SEND_TIMEOUT = float(os.getenv("WHATSAPP_SEND_TIMEOUT", "120"))
+# Prioridades da fila: menor sai primeiro. Envios em massa (campanhas) usam
+# PRIORITY_BULK e nunca passam na frente de respostas e lembretes.
+PRIORITY_NORMAL = 0
+PRIORITY_BULK = 10
+
+
+def init_whatsapp_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS whatsapp_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT NOT NULL UNIQUE,
+            phone TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            zapi_message_id TEXT,
+            priority INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at REAL,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(whatsapp_outbox)")
+    if "priority" not in [c[1] for c in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE whatsapp_outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_whatsapp_outbox_due ON whatsapp_outbox (status, next_attempt_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_whatsapp_outbox_priority ON whatsapp_outbox (status, priority, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_whatsapp_outbox_zapi ON whatsapp_outbox (zapi_message_id)")
+
+
+def normalize_phone(p):
+    digits = re.sub(r"\D+", "", str(p or ""))
+    if not digits:
+        return ""
+    if digits.startswith("55") and len(digits) >= 12:
+        return digits
+    if len(digits) in (10, 11) and not digits.startswith("55"):
+        return "55" + digits
+    if not digits.startswith("55"):
+        digits = "55" + digits
+    return digits
+
+
+def default_dedupe_key(phone, message, now=None):
+    """Mesmo telefone + mesmo texto dentro de DEDUPE_WINDOW segundos = mesma mensagem."""
+    bucket = int((now or time.time()) // DEDUPE_WINDOW)
+    raw = f"{normalize_phone(phone)}|{message}|{bucket}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def enqueue_message(cursor, phone, message, dedupe_key=None, priority=PRIORITY_NORMAL):
+    """Coloca a mensagem na fila (sem commit) e devolve o id dela, novo ou já existente."""
+    key = dedupe_key or default_dedupe_key(phone, message)
+    cursor.execute('''
+        INSERT OR IGNORE INTO whatsapp_outbox (dedupe_key, phone, message, priority, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (key, str(phone or ""), str(message or ""), priority, time.time()))
+    if cursor.rowcount:
+        return cursor.lastrowid
+    cursor.execute("SELECT id FROM whatsapp_outbox WHERE dedupe_key = ?", (key,))
+    return cursor.fetchone()[0]
+
+
+def get_message(cursor, message_id):
+    cursor.execute('''
+        SELECT id, phone, status, attempts, last_error, zapi_message_id, created_at, sent_at
+        FROM whatsapp_outbox WHERE id = ?
+    ''', (message_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {
+        "id": row[0], "phone": row[1], "status": row[2], "attempts": row[3],
+        "last_error": row[4], "zapi_message_id": row[5], "created_at": row[6], "sent_at": row[7],
+    }
+
+
+# Status de entrega vindos do webhook do Z-API, em ordem de progresso
+_DELIVERY_STATUS = {"SENT": "sent", "RECEIVED": "delivered", "READ": "read", "PLAYED": "read"}
+_STATUS_RANK = {"queued": 0, "sending": 1, "sent": 2, "delivered": 3, "read": 4}
+
+
+def update_delivery_status(cursor, zapi_message_ids, zapi_status):
+    """Aplica um recibo do Z-API às mensagens da fila. Retorna quantas linhas mudaram.
+
+    Nunca volta o status para trás: um 'RECEIVED' atrasado não desfaz um 'READ'.
+    """
+    status = _DELIVERY_STATUS.get(str(zapi_status or "").upper())
+    if not status or not zapi_message_ids:
+        return 0
+    lower = [s for s, rank in _STATUS_RANK.items() if rank < _STATUS_RANK[status]]
+    changed = 0
+    for zapi_id in zapi_message_ids:
+        cursor.execute(f'''
+            UPDATE whatsapp_outbox SET status = ?, updated_at = ?
+            WHERE zapi_message_id = ? AND status IN ({", ".join("?" for _ in lower)})
+        ''', [status, time.time(), str(zapi_id)] + lower)
+        changed += cursor.rowcount
+    return changed
+
+
+def backlog(cursor):
+    cursor.execute("SELECT status, COUNT(*) FROM whatsapp_outbox GROUP BY status")
+    return dict(cursor.fetchall())
+
+
+def queued_bulk(cursor):
+    """Quantas mensagens em massa ainda estão na fila (para controlar o ritmo das campanhas)."""
+    cursor.execute("SELECT COUNT(*) FROM whatsapp_outbox WHERE status = 'queued' AND priority >= ?", (PRIORITY_BULK,))
+    return cursor.fetchone()[0]
+
+
+class TokenBucket:
+    """Limita a taxa de chamadas: `rate` por segundo, com rajadas de até `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, stop_event=None):
+        """Bloqueia até haver uma ficha. Retorna False se `stop_event` for sinalizado antes."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if stop_event is not None:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds):
+        """Zera as fichas e adia a próxima por `seconds` (ex.: depois de um 429)."""
+        with self._lock:
+            self._tokens = -seconds * self.rate
+            self._updated = time.monotonic()
+
+
+def _backoff(attempts):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** max(0, attempts - 1)))
+    return delay * (0.5 + random.random() / 2)
+
+
+class WhatsAppOutboxWorker:
+    """Envia whatsapp_outbox em segundo plano.
+
+    `sender(phone, message)` faz o envio e retorna um dict com `ok`,
+    `message_id`, `status` (HTTP) e `error`. `instance_getter` identifica a
+    instância do Z-API, que tem o seu próprio token bucket.
+    """
+
+    def __init__(self, db_path_getter, sender, enabled_getter, instance_getter=lambda: "default"):
+        self._db_path_getter = db_path_getter
+        self._sender = sender
+        self._enabled_getter = enabled_getter
+        self._instance_getter = instance_getter
+        self._buckets = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def bucket(self):
+        instance = self._instance_getter()
+        with self._lock:
+            if instance not in self._buckets:
+                self._buckets[instance] = TokenBucket(RATE_PER_SECOND, BURST)
+            return self._buckets[instance]
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="whatsapp-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def recover(self, now=None):
+        """Devolve à fila mensagens presas em 'sending' há mais de SEND_TIMEOUT (processo caiu no meio do envio).
+
+        Mensagens em 'sending' recentes podem estar sendo enviadas por outro
+        processo agora; essas ficam como estão.
+        """
+        now = now or time.time()
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            conn.execute(
+                "UPDATE whatsapp_outbox SET status = 'queued', updated_at = ? WHERE status = 'sending' AND updated_at < ?",
+                (now, now - SEND_TIMEOUT)
+            )
+            conn.commit()
+
+    def _run(self):
+        try:
+            self.recover()
+        except Exception as e:
+            logger.error(f"Erro ao recuperar fila do WhatsApp: {e}")
+        while not self._stop.is_set():
+            try:
+                delay = self.drain_once()
+            except Exception as e:
+                logger.error(f"Erro no worker do WhatsApp: {e}")
+                delay = 30
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def drain_once(self):
+        """Envia as mensagens vencidas. Retorna quantos segundos esperar até a próxima rodada."""
+        if not self._enabled_getter():
+            return 300
+        with sqlite3.connect(self._db_path_getter(), timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, phone, message, attempts, priority
+                FROM whatsapp_outbox
+                WHERE status = 'queued' AND next_attempt_at <= ?
+                ORDER BY priority ASC, id ASC
+                LIMIT ?
+            ''', (time.time(), BATCH_SIZE))
+            due = cursor.fetchall()
+            bucket = self.bucket()
+            for msg_id, phone, message, attempts, priority in due:
+                if priority >= PRIORITY_BULK and self._wake.is_set():
+                    # Chegou mensagem nova: ela pode ter prioridade maior que o resto do lote
+                    return 0
+                if not bucket.acquire(self._stop):
+                    break
+                # Só envia quem conseguir marcar a linha: outro worker (ou um
+                # cancelamento) pode ter mexido nela depois do SELECT.
+                cursor.execute(
+                    "UPDATE whatsapp_outbox SET status = 'sending', updated_at = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), msg_id)
+                )
+                claimed = cursor.rowcount
+                conn.commit()
+                if not claimed:
+                    continue
+                try:
+                    result = self._sender(phone, message)
+                except Exception as e:
+                    result = {"ok": False, "status": None, "error": str(e)}
+                now = time.time()
+                if result.get("ok"):
+                    cursor.execute('''
+                        UPDATE whatsapp_outbox
+                        SET status = 'sent', sent_at = ?, updated_at = ?, zapi_message_id = ?, last_error = NULL,
+                            attempts = attempts + 1
+                        WHERE id = ?
+                    ''', (now, now, result.get("message_id"), msg_id))
+                else:
+                    status = result.get("status")
+                    attempts += 1
+                    if status == 429:
+                        bucket.pause(30)
+                    retryable = status is None or status == 429 or status >= 500
+                    final = not retryable or attempts >= MAX_ATTEMPTS
+                    logger.warning(f"WhatsApp #{msg_id} falhou ({status or result.get('error')}); "
+                                   f"{'desistindo' if final else 'nova tentativa agendada'}")
+                    cursor.execute('''
+                        UPDATE whatsapp_outbox
+                        SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                        WHERE id = ?
+                    ''', ('failed' if final else 'queued', attempts, now + _backoff(attempts),
+                          str(result.get("error") or status)[:500], now, msg_id))
+                conn.commit()
+            if len(due) == BATCH_SIZE:
+                return 0
+            cursor.execute("SELECT MIN(next_attempt_at) FROM whatsapp_outbox WHERE status = 'queued'")
+            next_at = cursor.fetchone()[0]
+        return max(1.0, next_at - time.time()) if next_at else 300